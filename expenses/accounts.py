@@ -0,0 +1,52 @@
+"""
+Account lookups for transaction writes.
+
+Which accounts a user owns changes rarely, so the ids are kept in the
+shared cache and writes validate and store an account id without loading
+the account. An id missing from the cached set is checked against the database
+before it is refused. A per-process cache would keep deleted accounts'
+ids after another worker dropped them, so without a shared cache the ids
+are read once per request instead. Balances are adjusted with UPDATE ... SET balance = balance + delta,
+which needs only the id and cannot lose a concurrent write.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from tracker.checks import cache_is_shared
+from .models import Account
+
+ACCOUNTS_KEY = 'accounts:{}'
+
+
+def account_ids(user_id, refresh=False):
+    """Ids of the user's accounts, cached until one is added or removed."""
+    key = ACCOUNTS_KEY.format(user_id)
+    shared = cache_is_shared()
+    ids = cache.get(key) if shared and not refresh else None
+    if ids is None:
+        ids = frozenset(Account.objects.filter(user_id=user_id).values_list('pk', flat=True))
+        if shared:
+            cache.set(key, ids, settings.ACCOUNT_CACHE_SECONDS)
+    return ids
+
+
+def forget_accounts(user_id):
+    cache.delete(ACCOUNTS_KEY.format(user_id))
+
+
+def balance_delta(type_, amount):
+    return -amount if type_ == 'expense' else amount
+
+
+def adjust_balance(account_id, delta):
+    if delta:
+        Account.objects.filter(pk=account_id).update(balance=F('balance') + delta, updated_at=timezone.now())
+
+
+def account_changed(sender, instance, using, created=True, **kwargs):
+    # Membership only changes on create and delete.
+    if created:
+        transaction.on_commit(lambda: forget_accounts(instance.user_id), using=using)
@@ -2,9 +2,12 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.utils.timezone import now
-from django.db.models import Sum
 from datetime import timedelta
-from .models import Expense
+from dateutil.relativedelta import relativedelta
+from .models import Account, Category, Expense
+from .serializers import SpendingSeriesQuerySerializer
+from .spending import daily_totals, category_totals, recent_amounts, series
+from .top_expenses import month_top
 
 class WeeklySpendingView(APIView):
     permission_classes = [IsAuthenticated]
@@ -13,10 +16,12 @@ class WeeklySpendingView(APIView):
         today = now().date()
         start_of_week = today - timedelta(days=today.weekday())  # Monday
 
+        totals = daily_totals(request.user, start_of_week, start_of_week + timedelta(days=6))
+
         data = []
         for i in range(7):
             day = start_of_week + timedelta(days=i)
-            total = Expense.objects.filter(user=request.user, date=day).aggregate(sum=Sum('amount'))['sum'] or 0
+            total = totals.get(day, 0)
             data.append({
                 "day": day.strftime('%a'),
                 "amount": float(total),
@@ -29,14 +34,14 @@ class TopExpensesView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        today = now().date()
-        start_of_month = today.replace(day=1)
-        expenses = Expense.objects.filter(user=request.user, date__gte=start_of_month).order_by('-amount')[:5]
+        ids = month_top(request.user.pk, now().date().replace(day=1), limit=5)
+        found = Expense.objects.filter(user=request.user).select_related('category').in_bulk(ids)
+        expenses = [found[pk] for pk in ids if pk in found]
         data = [{
-            "name": exp.description or exp.category,
+            "name": exp.title or exp.description or exp.category.name,
             "amount": float(exp.amount),
             "date": str(exp.date),
-            "category": exp.category
+            "category": exp.category.name
         } for exp in expenses]
         return Response(data)
 
@@ -48,19 +53,73 @@ class CategorySpendingView(APIView):
         today = now().date()
         start_of_month = today.replace(day=1)
 
-        category_totals = Expense.objects.filter(
-            user=request.user,
-            date__gte=start_of_month
-        ).values('category').annotate(amount=Sum('amount'))
+        totals = category_totals(request.user, start=start_of_month)
 
-        total = sum(ct['amount'] for ct in category_totals)
+        total = sum(ct['amount'] for ct in totals)
         data = [{
             "category": ct['category'],
             "amount": float(ct['amount']),
             "percentage": round((ct['amount'] / total) * 100, 2) if total > 0 else 0
-        } for ct in category_totals]
+        } for ct in totals]
+        return Response(data)
+
+
+class SpendingSeriesView(APIView):
+    """
+    Totals per day/week/month/year over any range, optionally grouped by
+    category, account or type and compared with the previous period or year.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        query = SpendingSeriesQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        start, end = params['start'], params['end']
+
+        data = {
+            'granularity': params['granularity'],
+            'group_by': params.get('group_by'),
+            'type': params['type'],
+            **self._series(request.user, start, end, params),
+        }
+        if params.get('compare') == 'previous_year':
+            data['comparison'] = self._series(
+                request.user, start - relativedelta(years=1), end - relativedelta(years=1), params
+            )
+        elif params.get('compare') == 'previous_period':
+            length = end - start + timedelta(days=1)
+            data['comparison'] = self._series(request.user, start - length, end - length, params)
         return Response(data)
 
+    def _series(self, user, start, end, params):
+        periods, keys, totals = series(
+            user, start, end, params['granularity'], params.get('group_by'), params['type']
+        )
+        labels = self._labels(user, params.get('group_by'), keys)
+        rows = [{
+            'key': labels[key],
+            'values': [cents / 100 for cents in row.tolist()],
+            'total': int(row.sum()) / 100,
+        } for key, row in zip(keys, totals)]
+        rows.sort(key=lambda row: -row['total'])
+        return {'start': str(start), 'end': str(end), 'periods': [str(p) for p in periods], 'series': rows}
+
+    def _labels(self, user, group_by, keys):
+        if group_by == 'category':
+            return dict(Category.objects.filter(user=user, pk__in=keys).values_list('pk', 'name'))
+        if group_by == 'account':
+            labels = {
+                pk: f"{bank_name} ({number[-4:]})"
+                for pk, bank_name, number in Account.objects.filter(user=user, pk__in=keys)
+                .values_list('pk', 'bank_name', 'account_number')
+            }
+            labels[None] = 'Archived'
+            return labels
+        if group_by == 'type':
+            return {key: key for key in keys}
+        return {None: 'total'}
+
 
 class PredictionView(APIView):
     permission_classes = [IsAuthenticated]
@@ -68,13 +127,13 @@ class PredictionView(APIView):
     def get(self, request):
         # Pretend ML model: take last 3 weeks and average them
         today = now().date()
-        past_expenses = Expense.objects.filter(user=request.user, date__lte=today).order_by('-date')[:21]
+        past_amounts = recent_amounts(request.user, end=today, limit=21)
 
         weekly_totals = [0, 0, 0]
         for i in range(21):
-            if i < len(past_expenses):
+            if i < len(past_amounts):
                 week_index = i // 7
-                weekly_totals[week_index] += past_expenses[i].amount
+                weekly_totals[week_index] += past_amounts[i]
 
         avg = sum(weekly_totals) / 3 if weekly_totals else 0
         next_month_prediction = avg * 4  # crude estimate
@@ -0,0 +1,102 @@
+"""
+Streaming anomaly detection for expenses.
+
+CategoryStats keeps a running mean and variance of every (user, category)
+pair. Each new expense is scored against the statistics as they were
+before it, flagged into Notification if it is an outlier, and then folded
+in, all in O(1). Editing or deleting an expense takes its old amount back
+out. `manage.py rebuild_category_stats` recomputes the statistics from
+history in one vectorized pass.
+"""
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+
+from .models import CategoryStats, Notification, Transaction
+
+
+def is_outlier(stats, amount):
+    """An amount is unusual when it is far above the mean in both z-score and ratio."""
+    if stats.count < settings.ANOMALY_MIN_SAMPLES or stats.mean <= 0:
+        return False
+    std = stats.std
+    z_score = (amount - stats.mean) / std if std > 0 else float('inf')
+    return z_score >= settings.ANOMALY_Z_THRESHOLD and amount >= settings.ANOMALY_MIN_RATIO * stats.mean
+
+
+def observe_expense(expense):
+    """Score a newly created expense against its category and update the statistics."""
+    amount = float(expense.amount)
+    with transaction.atomic(using=expense._state.db):
+        stats, _ = CategoryStats.objects.db_manager(expense._state.db).select_for_update().get_or_create(
+            user_id=expense.user_id, category_id=expense.category_id
+        )
+        if is_outlier(stats, amount):
+            category = expense.category.name
+            Notification.objects.db_manager(expense._state.db).create(
+                user_id=expense.user_id,
+                title=f"Unusual spending in {category}"[:255],
+                message=(
+                    f"You spent ${expense.amount} on {category} on {expense.date}, "
+                    f"about {amount / stats.mean:.1f}x your usual ${stats.mean:.2f}."
+                ),
+            )
+        stats.add(amount)
+        stats.save()
+
+
+def category_amount(state):
+    """(user_id, category_id, amount) of a Transaction.spending_state() tuple, or None."""
+    if state is None or state[3] is None:
+        return None
+    return state[0], state[3], float(state[2])
+
+
+def record_stats_change(old, new, using):
+    """
+    Move an updated or deleted expense between category statistics, from
+    `old` to `new`, each a Transaction.spending_state() tuple or None.
+    """
+    old, new = category_amount(old), category_amount(new)
+    if old == new:
+        return
+    stats = CategoryStats.objects.db_manager(using).select_for_update()
+    with transaction.atomic(using=using):
+        if old is not None:
+            user_id, category_id, amount = old
+            stat = stats.filter(user_id=user_id, category_id=category_id).first()
+            if stat is not None:
+                stat.remove(amount)
+                if stat.count:
+                    stat.save()
+                else:
+                    stat.delete()
+        if new is not None:
+            user_id, category_id, amount = new
+            stat, _ = stats.get_or_create(user_id=user_id, category_id=category_id)
+            stat.add(amount)
+            stat.save()
+
+
+def rebuild_stats(alias, user_ids):
+    """Recompute CategoryStats of the given users on `alias` from their expense history."""
+    rows = (
+        Transaction.objects.using(alias)
+        .filter(user_id__in=user_ids, type='expense')
+        .order_by().values_list('user_id', 'category_id', 'amount')
+    )
+    df = pd.DataFrame.from_records(list(rows), columns=['user_id', 'category', 'amount'])
+    stats = []
+    if not df.empty:
+        df['amount'] = df['amount'].astype(float)
+        grouped = df.groupby(['user_id', 'category'])['amount'].agg(n='count', mean='mean', var='var')
+        # pandas' var is the sample variance; m2 is the sum of squared deviations
+        grouped['m2'] = grouped['var'].fillna(0) * (grouped['n'] - 1)
+        stats = [
+            CategoryStats(user_id=row.user_id, category_id=row.category, count=row.n, mean=row.mean, m2=row.m2)
+            for row in grouped.reset_index().itertuples(index=False)
+        ]
+    with transaction.atomic(using=alias):
+        CategoryStats.objects.using(alias).filter(user_id__in=user_ids).delete()
+        CategoryStats.objects.using(alias).bulk_create(stats, batch_size=1000)
+    return len(stats)
@@ -1,6 +1,33 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save, pre_delete
 
 
 class ExpensesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'expenses'
+
+    def ready(self):
+        import tracker.checks  # noqa: F401  registers the checks
+        from .accounts import account_changed
+        from .sharding import _user_saved, _user_deleting
+        from .signals import account_deleted, transaction_saved, transaction_deleted
+        from .sync import account_deleting, row_deleted
+
+        post_save.connect(_user_saved, sender=self.get_model('User'), dispatch_uid='shard_user_saved')
+        pre_delete.connect(_user_deleting, sender=self.get_model('User'), dispatch_uid='shard_user_deleting')
+        post_save.connect(account_changed, sender=self.get_model('Account'), dispatch_uid='account_saved')
+        post_delete.connect(account_changed, sender=self.get_model('Account'), dispatch_uid='account_deleted')
+        post_delete.connect(account_deleted, sender=self.get_model('Account'), dispatch_uid='account_rebuild')
+
+        # Expense is a proxy of Transaction, and signals are sent with the proxy as sender.
+        for model_name in ('Transaction', 'Expense'):
+            post_save.connect(transaction_saved, sender=self.get_model(model_name),
+                              dispatch_uid=f'{model_name}_saved')
+            post_delete.connect(transaction_deleted, sender=self.get_model(model_name),
+                                dispatch_uid=f'{model_name}_deleted')
+
+        # Tombstones for delta sync.
+        pre_delete.connect(account_deleting, sender=self.get_model('Account'), dispatch_uid='account_tombstones')
+        for model_name in ('Transaction', 'Expense', 'Account', 'SavingsGoal', 'Notification'):
+            post_delete.connect(row_deleted, sender=self.get_model(model_name),
+                                dispatch_uid=f'{model_name}_tombstone')
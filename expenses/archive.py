@@ -0,0 +1,98 @@
+"""
+Hot/cold archival of old transactions.
+
+Rows dated before the cut-off month are copied to ArchivedTransaction in
+batches, folded into MonthlySummary and removed from the hot table. Only
+whole months are archived, so every month is either entirely hot or
+entirely summarised.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+
+from .ml_utils import adjust_bucket, period_start
+from .models import Transaction, ArchivedTransaction, MonthlySummary, TopExpenses
+from .snapshot import invalidate
+
+ARCHIVED_FIELDS = ['user_id', 'account_id', 'amount', 'category_id', 'description', 'date', 'type', 'title']
+
+
+def archive_cutoff(horizon_days=None):
+    """First day of the month that contains today - horizon_days."""
+    if horizon_days is None:
+        horizon_days = settings.ARCHIVE_HORIZON_DAYS
+    return (now().date() - timedelta(days=horizon_days)).replace(day=1)
+
+
+def archive_batch(alias, cutoff, batch_size=1000):
+    """Archive up to batch_size transactions dated before `cutoff`. Returns the row count."""
+    with transaction.atomic(using=alias):
+        rows = list(
+            Transaction.objects.using(alias).select_for_update()
+            .filter(date__lt=cutoff).order_by('pk')
+            .values('pk', *ARCHIVED_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return 0
+
+        ArchivedTransaction.objects.using(alias).bulk_create([
+            ArchivedTransaction(original_id=row['pk'], **{name: row[name] for name in ARCHIVED_FIELDS})
+            for row in rows
+        ])
+
+        totals = {}
+        for row in rows:
+            key = (row['user_id'], row['date'].replace(day=1), row['type'], row['category_id'])
+            total, count = totals.get(key, (0, 0))
+            totals[key] = (total + row['amount'], count + 1)
+
+        existing = MonthlySummary.objects.using(alias).filter(
+            user_id__in={key[0] for key in totals},
+            month__in={key[1] for key in totals},
+        )
+        updated = []
+        for summary in existing:
+            key = (summary.user_id, summary.month, summary.type, summary.category_id)
+            if key in totals:
+                total, count = totals.pop(key)
+                summary.total += total
+                summary.count += count
+                updated.append(summary)
+        MonthlySummary.objects.using(alias).bulk_update(updated, ['total', 'count'])
+        MonthlySummary.objects.using(alias).bulk_create([
+            MonthlySummary(user_id=user_id, month=month, type=type_, category_id=category_id, total=total, count=count)
+            for (user_id, month, type_, category_id), (total, count) in totals.items()
+        ])
+
+        # Monthly spending buckets carry forward through the summaries, but
+        # weekly history only covers hot rows.
+        weeks = {}
+        for row in rows:
+            if row['type'] == 'expense':
+                key = (row['user_id'], period_start(row['date'], 'weekly'))
+                total, count = weeks.get(key, (0, 0))
+                weeks[key] = (total + row['amount'], count + 1)
+        for (user_id, start), (total, count) in weeks.items():
+            adjust_bucket(user_id, 'weekly', start, -total, -count, alias)
+        # Top lists cover hot months only.
+        TopExpenses.objects.using(alias).filter(
+            user_id__in={user_id for user_id, _ in weeks}, month__lt=cutoff
+        ).delete()
+
+        # A raw delete skips delete signals: the rows are moved, not removed
+        # from the user's history, so nothing else derived from them changes.
+        Transaction.objects.using(alias).filter(pk__in=[row['pk'] for row in rows])._raw_delete(alias)
+        transaction.on_commit(lambda: invalidate({row['user_id'] for row in rows}), using=alias)
+    return len(rows)
+
+
+def archive_history(alias, cutoff, batch_size=1000):
+    """Archive every hot transaction before `cutoff` on `alias`. Returns the row count."""
+    total = 0
+    while True:
+        archived = archive_batch(alias, cutoff, batch_size)
+        if not archived:
+            return total
+        total += archived
@@ -0,0 +1,73 @@
+"""
+Profile picture thumbnails.
+
+An upload is decoded once, off the request path, cropped to a square and
+re-encoded as WebP at each of AVATAR_SIZES. Thumbnails are named by a hash
+of their content, so a URL never changes meaning and can be cached
+forever; a new upload gets new names.
+"""
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .models import User
+
+AVATAR_DIR = 'avatars'
+
+
+def render_thumbnails(source):
+    """{size: encoded bytes} for an open image file."""
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        side = min(image.size)
+        image = ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+        thumbnails = {}
+        # Largest first, each resized from the previous, which is far cheaper than from the original.
+        for size in sorted(settings.AVATAR_SIZES, reverse=True):
+            if image.width > size:
+                image = image.resize((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            out = io.BytesIO()
+            image.save(out, 'WEBP', quality=settings.AVATAR_QUALITY, method=6)
+            thumbnails[size] = out.getvalue()
+    return thumbnails
+
+
+def process_profile_picture(user_id, stale=()):
+    """
+    Store thumbnails of the user's current picture and record their names.
+    `stale` are files of an earlier picture to delete.
+    """
+    user = User.objects.only('profile_picture', 'profile_thumbnails').get(pk=user_id)
+    picture = user.profile_picture.name
+    names = {}
+    if picture:
+        with default_storage.open(picture, 'rb') as source:
+            thumbnails = render_thumbnails(source)
+        for size, data in thumbnails.items():
+            digest = hashlib.sha256(data).hexdigest()[:16]
+            name = f'{AVATAR_DIR}/{user_id}/{digest}-{size}.webp'
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(data))
+            names[str(size)] = name
+
+    # Only if the picture was not replaced meanwhile; the replacement has its own job.
+    if User.objects.filter(pk=user_id, profile_picture=picture).update(profile_thumbnails=names):
+        stale = set(stale) | set(user.profile_thumbnails.values())
+        keep = set(names.values())
+    else:
+        # Nothing refers to what was just written, unless the replacement's
+        # job already stored identical thumbnails under the same names.
+        current = User.objects.filter(pk=user_id).values_list('profile_thumbnails', flat=True).first()
+        keep = set((current or {}).values())
+        stale = set(stale) | set(names.values())
+    for name in stale - keep:
+        default_storage.delete(name)
+
+
+def thumbnail_urls(user):
+    return {size: default_storage.url(name) for size, name in user.profile_thumbnails.items()}
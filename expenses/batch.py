@@ -0,0 +1,202 @@
+"""
+Batched transaction writes for clients syncing offline edits.
+
+A batch is a list of create, update and delete operations. All of them
+are validated first; if any is invalid nothing is written. Otherwise
+they are applied in order, in one database transaction, with bulk
+inserts, updates and deletes and one balance update per account. The
+derived data the save and delete receivers would have maintained row by
+row is then updated once per spending bucket, category and month the
+batch touched.
+"""
+from collections import defaultdict
+
+from django.db import router, transaction
+from django.utils import timezone
+
+from .accounts import adjust_balance, balance_delta
+from .anomalies import category_amount, is_outlier
+from .categorizer import DEFAULT_CATEGORY, predict_categories
+from .ml_utils import record_spending_changes
+from .models import Category, CategoryStats, Notification, Transaction
+from .serializers import TransactionSerializer
+from .snapshot import invalidate
+from .sync import record_deletions
+from .top_expenses import rebuild_months
+
+OPERATIONS = ('create', 'update', 'delete')
+ROW_FIELDS = ('title', 'description', 'amount', 'type')
+
+
+def _pk(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def validate(request, operations):
+    """
+    Returns (items, errors): items are (op, instance, validated data) in
+    order; errors maps the index of each invalid operation to its errors.
+    """
+    context = {'request': request, 'defer_category': True}
+    ids = {_pk(op.get('id')) for op in operations if isinstance(op, dict) and op.get('op') in ('update', 'delete')}
+    existing = Transaction.objects.filter(user=request.user, pk__in=ids - {None}).select_related('category').in_bulk()
+    deleted = set()
+    items, errors = [], {}
+    for index, op in enumerate(operations):
+        kind = op.get('op') if isinstance(op, dict) else None
+        if kind not in OPERATIONS:
+            errors[index] = {'op': [f"Must be one of: {', '.join(OPERATIONS)}."]}
+            continue
+        instance = None
+        if kind != 'create':
+            instance = existing.get(_pk(op.get('id')))
+            if instance is None or instance.pk in deleted:
+                errors[index] = {'id': ['Not found.']}
+                continue
+        if kind == 'delete':
+            deleted.add(instance.pk)
+            items.append((kind, instance, None))
+            continue
+        serializer = TransactionSerializer(instance, data=op.get('data'), partial=kind == 'update', context=context)
+        if serializer.is_valid():
+            items.append((kind, instance, serializer.validated_data))
+        else:
+            errors[index] = serializer.errors
+    return items, errors
+
+
+def _fill_categories(items):
+    """Predict, in one batch, the categories that were left out."""
+    pending = [
+        (data, instance) for kind, instance, data in items
+        if data is not None and not data.get('category') and (kind == 'create' or 'category' in data)
+    ]
+    rows = [[data.get(name, getattr(instance, name, None)) for name in ROW_FIELDS] for data, instance in pending]
+    for (data, _), category in zip(pending, predict_categories(rows)):
+        data['category'] = category or DEFAULT_CATEGORY
+
+
+def _update_stats(user_id, created, changes, using):
+    """
+    Move updated and deleted expenses between category statistics, then
+    score new expenses like observe_expense, with the statistics loaded and
+    saved once.
+    """
+    expenses = [row for row in created if row.type == 'expense']
+    moves = [(category_amount(old), category_amount(new)) for old, new in changes]
+    moves = [(old, new) for old, new in moves if old != new]
+    categories = {row.category_id for row in expenses}
+    categories.update(state[1] for move in moves for state in move if state is not None)
+    stats = {
+        stat.category_id: stat for stat in
+        CategoryStats.objects.using(using).select_for_update().filter(user_id=user_id, category_id__in=categories)
+    }
+
+    def stat_for(category_id):
+        return stats.setdefault(category_id, CategoryStats(user_id=user_id, category_id=category_id))
+
+    for old, new in moves:
+        if old is not None:
+            stat_for(old[1]).remove(old[2])
+        if new is not None:
+            stat_for(new[1]).add(new[2])
+
+    notifications = []
+    for row in expenses:
+        stat = stat_for(row.category_id)
+        amount = float(row.amount)
+        if is_outlier(stat, amount):
+            notifications.append(Notification(
+                user_id=user_id,
+                title=f"Unusual spending in {row.category.name}"[:255],
+                message=(
+                    f"You spent ${row.amount} on {row.category.name} on {row.date}, "
+                    f"about {amount / stat.mean:.1f}x your usual ${stat.mean:.2f}."
+                ),
+            ))
+        stat.add(amount)
+    Notification.objects.using(using).bulk_create(notifications)
+
+    now = timezone.now()
+    for stat in stats.values():
+        stat.updated_at = now
+    CategoryStats.objects.using(using).bulk_update(
+        [stat for stat in stats.values() if stat.pk and stat.count], ['count', 'mean', 'm2', 'updated_at']
+    )
+    CategoryStats.objects.using(using).bulk_create([stat for stat in stats.values() if not stat.pk and stat.count])
+    emptied = [stat.pk for stat in stats.values() if stat.pk and not stat.count]
+    if emptied:
+        CategoryStats.objects.using(using).filter(pk__in=emptied).delete()
+
+
+def apply(user, items):
+    """Write validated items. Returns (op, transaction) per item, in order."""
+    _fill_categories(items)
+    using = router.db_for_write(Transaction)
+    categories = Category.objects.db_manager(using).resolve(
+        user.pk, {data['category'] for _, _, data in items if data is not None and 'category' in data}
+    )
+    categories = {name: Category(pk=pk, user_id=user.pk, name=name) for name, pk in categories.items()}
+
+    results, created, updated, deleted = [], [], {}, set()
+    fields = set()
+    balances = defaultdict(int)
+    # Spending states of existing rows as loaded, before the batch changes them.
+    loaded = {instance.pk: instance._loaded_spending for kind, instance, _ in items if instance is not None}
+    for kind, instance, data in items:
+        if kind == 'delete':
+            balances[instance.account_id] -= balance_delta(instance.type, instance.amount)
+            updated.pop(instance.pk, None)
+            deleted.add(instance.pk)
+            results.append((kind, instance))
+            continue
+        data = dict(data)
+        if 'category' in data:
+            data['category'] = categories[data['category']]
+        if kind == 'create':
+            row = Transaction(user_id=user.pk, **data)
+            created.append(row)
+        else:
+            row = instance
+            balances[row.account_id] -= balance_delta(row.type, row.amount)
+            for name, value in data.items():
+                setattr(row, name, value)
+            fields.update(data)
+            updated[row.pk] = row
+        # Same default as Transaction.save().
+        if not row.title:
+            row.title = row.description
+            fields.add('title')
+        balances[row.account_id] += balance_delta(row.type, row.amount)
+        results.append((kind, row))
+
+    with transaction.atomic(using=using):
+        Transaction.objects.using(using).bulk_create(created, batch_size=500)
+        if updated:
+            # bulk_update does not stamp auto_now fields.
+            now = timezone.now()
+            for row in updated.values():
+                row.updated_at = now
+            Transaction.objects.using(using).bulk_update(updated.values(), sorted(fields | {'updated_at'}), batch_size=500)
+        if deleted:
+            # Raw: the delete receivers' work is redone below for the whole batch.
+            Transaction.objects.using(using).filter(pk__in=deleted)._raw_delete(using)
+            record_deletions('transactions', user.pk, sorted(deleted), using)
+        for account_id, delta in balances.items():
+            adjust_balance(account_id, delta)
+
+        changes = (
+            [(loaded[pk], None) for pk in deleted]
+            + [(loaded[pk], row.spending_state()) for pk, row in updated.items()]
+        )
+        _update_stats(user.pk, created, changes, using)
+        changes += [(None, row.spending_state()) for row in created]
+        record_spending_changes(changes, using)
+        rebuild_months(using, user.pk, {
+            state[1].replace(day=1) for change in changes for state in change if state is not None
+        })
+        transaction.on_commit(lambda: invalidate([user.pk]), using=using)
+    return results
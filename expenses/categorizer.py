@@ -0,0 +1,182 @@
+"""
+Auto-categorization of transactions.
+
+A linear model is trained on the (title, description, amount, type) ->
+category pairs users have already entered and stored as a joblib artifact
+at CATEGORIZER_MODEL_PATH. Training streams those pairs from each shard a
+batch at a time, so its memory does not grow with the table. Text is hashed rather than fitted to a
+vocabulary, so the artifact is little more than the coefficient matrix;
+each worker memory-maps it once and shares the pages with the other
+workers on the host. Inference takes whole batches, so a backlog of a
+million rows is a few vectorized predict calls.
+"""
+import math
+import os
+import threading
+from collections import Counter
+
+import joblib
+import numpy as np
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import make_pipeline
+
+from .anomalies import rebuild_stats
+from .models import Category, Transaction
+from .parallel import chunked
+from .snapshot import invalidate
+
+DEFAULT_CATEGORY = 'Other'
+# Categories that mean "nobody picked one"; never learned, and re-categorized.
+UNCATEGORIZED = ('', 'Other', 'Uncategorized')
+
+_lock = threading.Lock()
+_loaded = (None, None)  # (artifact path and mtime, model)
+
+
+def document(title, description, amount, type_):
+    """The text the model sees: words plus coarse amount and type tokens."""
+    amount = float(amount or 0)
+    scale = int(math.floor(math.log2(amount))) if amount > 0 else 0
+    return f"{title or ''} {description or ''} __{type_ or 'expense'} __amount{scale}"
+
+
+def build_model():
+    return make_pipeline(
+        HashingVectorizer(n_features=2 ** 18, alternate_sign=False, ngram_range=(1, 2)),
+        SGDClassifier(loss='log_loss', alpha=1e-6, max_iter=20, tol=1e-3, random_state=0),
+    )
+
+
+def train(aliases, min_samples=5, batch_size=None, epochs=5, min_users=None):
+    """
+    Fit a model on the categorized transactions of `aliases`, read and
+    learned `batch_size` rows at a time. Returns (model, samples).
+
+    Only categories that at least `min_users` users have are learned, so a
+    name one user made up is never suggested to, or created for, others.
+    """
+    batch_size = batch_size or settings.CATEGORIZER_BATCH_SIZE
+    min_users = settings.CATEGORIZER_MIN_USERS if min_users is None else min_users
+    counts, users = Counter(), Counter()
+    for alias in aliases:
+        rows = (
+            Transaction.objects.using(alias).exclude(category__name__in=UNCATEGORIZED).order_by()
+            .values_list('category__name').annotate(Count('pk'), Count('user_id', distinct=True))
+        )
+        # A user's rows are all on one shard, so the per-shard user counts add up.
+        for name, count, user_count in rows:
+            counts[name] += count
+            users[name] += user_count
+    keep = sorted(name for name, count in counts.items() if count >= min_samples and users[name] >= min_users)
+    samples = sum(counts[name] for name in keep)
+    if len(keep) < 2:
+        return None, samples
+    model = build_model()
+    vectorizer, classifier = model[0].fit([]), model[-1]
+    classes = np.array(keep)
+    keep = set(keep)
+    for _ in range(epochs):
+        for alias in aliases:
+            for rows in _categorized(alias, batch_size):
+                rows = [row for row in rows if row[5] in keep]
+                if rows:
+                    classifier.partial_fit(
+                        vectorizer.transform([document(*row[1:5]) for row in rows]),
+                        [row[5] for row in rows], classes=classes,
+                    )
+    return model, samples
+
+
+def _categorized(alias, batch_size):
+    """Batches of (pk, title, description, amount, type, category) rows on `alias`, in pk order."""
+    rows = (
+        Transaction.objects.using(alias).exclude(category__name__in=UNCATEGORIZED).order_by('pk')
+        .values_list('pk', 'title', 'description', 'amount', 'type', 'category__name')
+    )
+    last_pk = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return
+        last_pk = batch[-1][0]
+        yield batch
+
+
+def save_model(model, path=None):
+    path = path or settings.CATEGORIZER_MODEL_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write next to the target and rename, so workers that have the old
+    # artifact mapped keep reading a complete file.
+    tmp = f'{path}.{os.getpid()}.tmp'
+    joblib.dump(model, tmp)  # uncompressed, so the arrays can be memory-mapped
+    os.replace(tmp, path)
+
+
+def get_model():
+    """This worker's model, loaded on first use and again when the artifact changes."""
+    global _loaded
+    path = settings.CATEGORIZER_MODEL_PATH
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    if _loaded[0] != key:
+        with _lock:
+            if _loaded[0] != key:
+                _loaded = (key, joblib.load(path, mmap_mode='r'))
+    return _loaded[1]
+
+
+def predict_categories(rows, batch_size=None):
+    """
+    Categories for (title, description, amount, type) rows, in order. A row
+    gets None when there is no model or it is less sure than
+    CATEGORIZER_MIN_CONFIDENCE.
+    """
+    rows = list(rows)
+    model = get_model()
+    if model is None:
+        return [None] * len(rows)
+    batch_size = batch_size or settings.CATEGORIZER_BATCH_SIZE
+    classes = model.classes_
+    predicted = []
+    for start in range(0, len(rows), batch_size):
+        probabilities = model.predict_proba([document(*row) for row in rows[start:start + batch_size]])
+        best = probabilities.argmax(axis=1)
+        confident = probabilities[np.arange(len(best)), best] >= settings.CATEGORIZER_MIN_CONFIDENCE
+        predicted.extend(str(classes[i]) if ok else None for i, ok in zip(best, confident))
+    return predicted
+
+
+def recategorize(alias, batch_size=None):
+    """Fill in the category of uncategorized transactions on `alias`. Returns the number changed."""
+    batch_size = batch_size or settings.CATEGORIZER_BATCH_SIZE
+    pending = Transaction.objects.using(alias).filter(category__name__in=UNCATEGORIZED).order_by('pk')
+    fields = ['pk', 'user_id', 'title', 'description', 'amount', 'type']
+    changed, last_pk, users = 0, 0, set()
+    while True:
+        rows = list(pending.filter(pk__gt=last_pk).values_list(*fields)[:batch_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        predicted, now = {}, timezone.now()
+        for (pk, user_id, *_), category in zip(rows, predict_categories([row[2:] for row in rows], batch_size)):
+            if category is not None:
+                predicted.setdefault(user_id, []).append((pk, category))
+        updates = []
+        for user_id, pairs in predicted.items():
+            ids = Category.objects.db_manager(alias).resolve(user_id, {category for _, category in pairs})
+            updates.extend(Transaction(pk=pk, category_id=ids[category], updated_at=now) for pk, category in pairs)
+        users.update(predicted)
+        Transaction.objects.using(alias).bulk_update(updates, ['category', 'updated_at'], batch_size=1000)
+        changed += len(updates)
+
+    # bulk_update skips the save receivers; refresh what they keep up to date.
+    for chunk in chunked(sorted(users), 1000):
+        rebuild_stats(alias, chunk)
+    invalidate(users)
+    return changed
@@ -0,0 +1,213 @@
+"""
+Spending forecasts from the model that backtests best for each user.
+
+A user's spending buckets form a regular series of weekly or monthly
+totals, with periods without spending as zero. Four models forecast the
+next period from it: the last value (naive), the value one season earlier
+(seasonal naive), simple exponential smoothing and a least-squares linear
+trend. Each model is backtested by rolling origin. For each of the last
+BACKTEST_ORIGINS periods it forecasts that period from the ones before.
+The model with the lowest mean absolute error is stored as the user's
+ForecastChoice, and predict_next uses it.
+
+The code works on matrices of many users' series, right-aligned and
+padded with NaN, so a chunk of users is backtested with a few array
+operations. The trend's forecasts from every origin come from cumulative
+sums, and smoothing's from one pass over time, not from a refit per
+origin. `manage.py backtest_forecasts` runs this for every user across a
+process pool. `manage.py benchmark_forecasts` measures its speed and
+accuracy on synthetic series.
+"""
+from itertools import groupby
+
+import numpy as np
+from django.db import transaction
+
+from tracker.routers import shard_for_user
+from .models import ForecastChoice, SpendingBucket
+
+MODELS = ('naive', 'seasonal_naive', 'exponential_smoothing', 'linear_trend')
+SEASON = {'weekly': 52, 'monthly': 12}
+BACKTEST_ORIGINS = {'weekly': 26, 'monthly': 12}
+# Fewest backtested periods a model needs to be chosen.
+MIN_ORIGINS = 3
+SMOOTHING_LEVELS = np.array([0.1, 0.2, 0.3, 0.5, 0.7, 0.9])
+
+
+def to_series(starts, amounts, period):
+    """Bucket starts and amounts as a regular series from the first bucket to the last."""
+    if not starts:
+        return np.empty(0)
+    if period == 'weekly':
+        index = [(start - starts[0]).days // 7 for start in starts]
+    else:
+        index = [(start.year - starts[0].year) * 12 + start.month - starts[0].month for start in starts]
+    series = np.zeros(index[-1] + 1)
+    series[index] = [float(amount) for amount in amounts]
+    return series
+
+
+def align(series):
+    """Right-align series of different lengths into one matrix, padded with NaN."""
+    length = max((len(values) for values in series), default=0)
+    matrix = np.full((len(series), length), np.nan)
+    for row, values in zip(matrix, series):
+        if len(values):
+            row[length - len(values):] = values
+    return matrix
+
+
+def _empty(Y):
+    return np.full((Y.shape[0], Y.shape[1] + 1), np.nan)
+
+
+def _naive(Y, period):
+    P = _empty(Y)
+    P[:, 1:] = Y
+    return P
+
+
+def _seasonal_naive(Y, period):
+    season = SEASON[period]
+    P = _empty(Y)
+    if Y.shape[1] >= season:
+        P[:, season:] = Y[:, :Y.shape[1] + 1 - season]
+    return P
+
+
+def _smoothing(Y, levels):
+    """Forecasts for each smoothing level, shaped levels x rows x (periods + 1)."""
+    alpha = np.asarray(levels, dtype=float)[:, None]
+    level = np.full((len(alpha), Y.shape[0]), np.nan)
+    P = np.empty((len(alpha), Y.shape[0], Y.shape[1] + 1))
+    for t in range(Y.shape[1]):
+        P[:, :, t] = level
+        # The level starts at the first value; padding only ever precedes it.
+        level = np.where(np.isnan(level), Y[:, t], alpha * Y[:, t] + (1 - alpha) * level)
+    P[:, :, -1] = level
+    return P
+
+
+def _before(values):
+    """Sums of values[:, :t] for t = 0..periods."""
+    sums = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(values, axis=1, out=sums[:, 1:])
+    return sums
+
+
+def _linear_trend(Y, period):
+    valid = ~np.isnan(Y)
+    x = np.where(valid, np.arange(Y.shape[1], dtype=float), 0.0)
+    y = np.where(valid, Y, 0.0)
+    n, sum_x, sum_y = _before(valid.astype(float)), _before(x), _before(y)
+    sum_xy, sum_xx = _before(x * y), _before(x * x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = n * sum_xx - sum_x ** 2
+        slope = np.where(denominator > 0, (n * sum_xy - sum_x * sum_y) / denominator, 0.0)
+        P = (sum_y - slope * sum_x) / n + slope * np.arange(Y.shape[1] + 1)
+    # As many points as predict_next asks for.
+    P[n < 3] = np.nan
+    return P
+
+
+def forecasts(Y, period, model, smoothing=None):
+    """
+    One-step forecasts of `model` for every row of Y from every origin:
+    column t forecasts Y[:, t] from the periods before it, and the last
+    column forecasts the period after Y. NaN where there is too little history.
+    """
+    if model == 'exponential_smoothing':
+        return _smoothing(Y, [smoothing])[0]
+    return {'naive': _naive, 'seasonal_naive': _seasonal_naive, 'linear_trend': _linear_trend}[model](Y, period)
+
+
+def _errors(P, Y, origins):
+    """Mean absolute error of P against the last `origins` periods of Y; NaN with fewer than MIN_ORIGINS."""
+    window = slice(max(Y.shape[1] - origins, 0), Y.shape[1])
+    errors = np.abs(P[..., window] - Y[:, window])
+    counted = (~np.isnan(errors)).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.nansum(errors, axis=-1) / counted
+    return np.where(counted >= MIN_ORIGINS, mean, np.nan)
+
+
+def _argmin(errors, axis):
+    return np.argmin(np.where(np.isnan(errors), np.inf, errors), axis=axis)
+
+
+def select(Y, period):
+    """
+    Backtest every model on every row of Y. Returns (index into MODELS,
+    smoothing level, next-period forecast, rows x MODELS errors); rows
+    with too little history for any model get -1 and NaN.
+    """
+    origins = BACKTEST_ORIGINS[period]
+    rows = np.arange(Y.shape[0])
+    smoothed = _smoothing(Y, SMOOTHING_LEVELS)
+    level = _argmin(_errors(smoothed, Y, origins), axis=0)
+    P = np.stack([
+        _naive(Y, period), _seasonal_naive(Y, period), smoothed[level, rows], _linear_trend(Y, period),
+    ])
+    errors = _errors(P, Y, origins).T
+    usable = ~np.isnan(errors).all(axis=1)
+    best = np.where(usable, _argmin(errors, axis=1), -1)
+    return best, SMOOTHING_LEVELS[level], np.where(usable, P[best, rows, -1], np.nan), errors
+
+
+def select_rows(args):
+    """Pool task: select() for a matrix of series. Returns the next-period forecasts."""
+    Y, period = args
+    return select(Y, period)[2]
+
+
+def forecast_next(starts, amounts, period, choice):
+    """The next-period forecast of the chosen model from a user's buckets, or None."""
+    Y = to_series(starts, amounts, period)[None, :]
+    value = forecasts(Y, period, choice.model, choice.smoothing)[0, -1]
+    return None if np.isnan(value) else float(value)
+
+
+def backtest_users(args):
+    """
+    Pool task: backtest users' `period` buckets and store their choices.
+    Users with too little history lose theirs. Returns (users, {model: users},
+    total error of the chosen models, total error of the trend, users with both).
+    """
+    user_ids, period = args
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for_user(user_id), []).append(user_id)
+
+    chosen = {}
+    error = trend_error = compared = 0
+    trend = MODELS.index('linear_trend')
+    for alias, ids in by_shard.items():
+        buckets = (
+            SpendingBucket.objects.using(alias).filter(user_id__in=ids, period=period)
+            .order_by('user_id', 'start').values_list('user_id', 'start', 'amount')
+        )
+        series = dict.fromkeys(ids, np.empty(0))
+        for user_id, rows in groupby(buckets, key=lambda row: row[0]):
+            starts, amounts = zip(*((start, amount) for _, start, amount in rows))
+            series[user_id] = to_series(list(starts), amounts, period)
+        best, levels, _, errors = select(align(list(series.values())), period)
+
+        choices = []
+        for user_id, model, level, row in zip(series, best, levels, errors):
+            if model < 0:
+                continue
+            name = MODELS[model]
+            chosen[name] = chosen.get(name, 0) + 1
+            choices.append(ForecastChoice(
+                user_id=user_id, period=period, model=name,
+                smoothing=float(level) if name == 'exponential_smoothing' else None,
+                error=float(row[model]), trend_error=None if np.isnan(row[trend]) else float(row[trend]),
+            ))
+            if not np.isnan(row[trend]):
+                error += row[model]
+                trend_error += row[trend]
+                compared += 1
+        with transaction.atomic(using=alias):
+            ForecastChoice.objects.using(alias).filter(user_id__in=ids, period=period).delete()
+            ForecastChoice.objects.using(alias).bulk_create(choices)
+    return len(user_ids), chosen, float(error), float(trend_error), compared
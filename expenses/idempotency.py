@@ -0,0 +1,89 @@
+"""
+Idempotency-Key support for POST endpoints that write.
+
+A client that may retry a POST sends an Idempotency-Key header. The first
+request with a given key for a user inserts an IdempotencyKey row and
+runs the view in the same database transaction, then stores the response
+on the row. A retry finds the row and gets the stored response back,
+marked with Idempotent-Replayed, without the view running again.
+
+The row is inserted before the view runs. A concurrent duplicate's insert
+therefore waits on the unique (user, key) index until the first request
+commits, then replays its response. If the first request fails, its row
+is rolled back with its writes, and the duplicate runs the view itself.
+Responses with a 5xx status are not kept, so those can be retried.
+
+A key reused with a different request is refused with 422. Keys expire
+after IDEMPOTENCY_KEY_TTL_SECONDS (`manage.py prune_idempotency_keys`).
+"""
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from tracker.routers import shard_for_user
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+def fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def _replay(stored, digest):
+    if stored.fingerprint != digest:
+        return Response({'detail': f'{HEADER} was already used for a different request.'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response(stored.response, status=stored.status_code, headers={REPLAYED_HEADER: 'true'})
+
+
+def run_once(request, key, handler):
+    """The stored response for (request.user, key), or handler()'s, stored for next time."""
+    if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+        return Response({'detail': f'{HEADER} is too long.'}, status=status.HTTP_400_BAD_REQUEST)
+    user_id = request.user.pk
+    alias = shard_for_user(user_id)
+    keys = IdempotencyKey.objects.using(alias)
+    digest = fingerprint(request)
+    expired = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL_SECONDS)
+
+    stored = keys.filter(user_id=user_id, key=key, created_at__gte=expired).first()
+    if stored is not None:
+        return _replay(stored, digest)
+    with transaction.atomic(using=alias):
+        keys.filter(user_id=user_id, key=key, created_at__lt=expired).delete()
+        try:
+            with transaction.atomic(using=alias):
+                record = keys.create(user_id=user_id, key=key, fingerprint=digest)
+        except IntegrityError:
+            # A concurrent request with the key has committed; the insert waited for it.
+            return _replay(keys.get(user_id=user_id, key=key), digest)
+
+        response = handler()
+        if response.status_code >= 500:
+            transaction.set_rollback(True, using=alias)
+            return response
+        record.status_code = response.status_code
+        record.response = response.data
+        record.save(update_fields=['status_code', 'response'])
+    return response
+
+
+def idempotent(post):
+    """Decorates a view's post() to honour Idempotency-Key."""
+    @functools.wraps(post)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return post(self, request, *args, **kwargs)
+        return run_once(request, key, lambda: post(self, request, *args, **kwargs))
+    return wrapper
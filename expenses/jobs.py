@@ -0,0 +1,164 @@
+"""
+Database-backed background jobs.
+
+Jobs are rows of Job on the default database. enqueue() adds one. Workers
+(`manage.py run_jobs`) claim the most urgent runnable job with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of them can poll the
+same table without handing a job out twice. A job that raises is
+retried with exponential backoff until it runs out of attempts; one whose
+worker died is handed out again once JOB_TIMEOUT has passed.
+
+Handlers are registered with @job in expenses/tasks.py and receive the
+payload as keyword arguments. What a handler returns is kept as the job's
+result, so other processes can read it from the table.
+"""
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from tracker import metrics
+from .models import Job
+
+JOB_DURATION_BUCKETS = (0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+_handlers = {}
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def job(name):
+    """Register a handler under `name`."""
+    def register(func):
+        _handlers[name] = func
+        return func
+    return register
+
+
+def get_handler(name):
+    from . import tasks  # noqa: F401  registers the handlers
+    return _handlers[name]
+
+
+def enqueue(name, payload=None, priority=0, delay=None, key='', max_attempts=None):
+    """
+    Queue a job. With a key, nothing is queued while a job with the same
+    key is still waiting or running; that job is returned instead.
+    """
+    jobs = Job.objects.using('default')
+    if key:
+        pending = jobs.filter(key=key, status__in=('queued', 'running')).first()
+        if pending is not None:
+            return pending
+    return jobs.create(
+        name=name,
+        payload=payload or {},
+        priority=priority,
+        key=key,
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+        run_at=timezone.now() + (delay or timedelta()),
+    )
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim(worker):
+    """Lock and return the next runnable job, or None."""
+    now = timezone.now()
+    # Running past the timeout (plus slack for the worker to record it) means the worker died.
+    abandoned = Q(status='running', started_at__lt=now - timedelta(seconds=settings.JOB_TIMEOUT + 60))
+    jobs = Job.objects.using('default')
+    jobs.filter(abandoned, attempts__gte=F('max_attempts')).update(
+        status='failed', finished_at=now, locked_by='', last_error='Worker lost.'
+    )
+    with transaction.atomic(using='default'):
+        job = (
+            jobs.select_for_update(skip_locked=True)
+            .filter(Q(status='queued', run_at__lte=now) | abandoned)
+            .order_by('-priority', 'run_at', 'pk').first()
+        )
+        if job is None:
+            return None
+        metrics.observe('tracker_job_wait_seconds', [('job', job.name)],
+                        (now - job.run_at).total_seconds(), JOB_DURATION_BUCKETS)
+        job.status = 'running'
+        job.attempts += 1
+        job.locked_by = worker
+        job.started_at = now
+        job.save(update_fields=['status', 'attempts', 'locked_by', 'started_at'])
+    return job
+
+
+def backoff(attempts):
+    """Delay before retry number `attempts`: exponential, capped, with jitter."""
+    delay = min(settings.JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.JOB_RETRY_MAX_SECONDS)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def _finish(job, status, duration, error=''):
+    job.status = status
+    job.finished_at = timezone.now()
+    job.duration = duration
+    job.last_error = error
+    job.locked_by = ''
+
+
+def _alarm(signum, frame):
+    raise JobTimeout(f'Exceeded JOB_TIMEOUT ({settings.JOB_TIMEOUT}s).')
+
+
+def run(job):
+    """Run a claimed job and record the outcome. Returns True on success."""
+    # SIGALRM only works in the main thread, which is where the worker runs jobs.
+    alarm = hasattr(signal, 'SIGALRM') and signal.getsignal(signal.SIGALRM) in (signal.SIG_DFL, _alarm)
+    start = time.perf_counter()
+    try:
+        handler = get_handler(job.name)
+    except KeyError:
+        handler = None
+    try:
+        if handler is None:
+            raise LookupError(f'No job handler named {job.name!r}.')
+        if alarm:
+            signal.signal(signal.SIGALRM, _alarm)
+            signal.alarm(settings.JOB_TIMEOUT)
+        result = handler(**job.payload)
+    except Exception as exc:
+        duration = time.perf_counter() - start
+        error = ''.join(traceback.format_exception(exc))
+        if job.attempts < job.max_attempts and handler is not None:
+            _finish(job, 'queued', duration, error)
+            job.finished_at = None
+            job.run_at = timezone.now() + backoff(job.attempts)
+            outcome = 'retry'
+        else:
+            _finish(job, 'failed', duration, error)
+            outcome = 'failed'
+    else:
+        duration = time.perf_counter() - start
+        _finish(job, 'done', duration)
+        job.result = result
+        outcome = 'done'
+    finally:
+        if alarm:
+            signal.alarm(0)
+
+    job.save(using='default', update_fields=[
+        'status', 'finished_at', 'duration', 'last_error', 'locked_by', 'run_at', 'result',
+    ])
+    metrics.inc('tracker_jobs_total', [('job', job.name), ('outcome', outcome)])
+    metrics.observe('tracker_job_duration_seconds', [('job', job.name)], duration, JOB_DURATION_BUCKETS)
+    metrics.maybe_flush()
+    return outcome == 'done'
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses.archive import archive_cutoff, archive_history
+from expenses.models import Transaction
+
+
+class Command(BaseCommand):
+    help = 'Move transactions older than the archive horizon into the archive table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ARCHIVE_HORIZON_DAYS,
+                            help='Archive whole months older than this many days.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would move.')
+
+    def handle(self, *args, **options):
+        if options['days'] < 62:
+            raise CommandError('The horizon must be at least 62 days so the current and previous months stay hot.')
+        cutoff = archive_cutoff(options['days'])
+        self.stdout.write(f'Archiving rows dated before {cutoff}')
+
+        for alias in settings.DATABASE_SHARDS:
+            if options['dry_run']:
+                count = Transaction.objects.using(alias).filter(date__lt=cutoff).count()
+                self.stdout.write(f'{alias}: {count} transaction(s) would be archived')
+                continue
+            count = archive_history(alias, cutoff, batch_size=options['batch_size'])
+            self.stdout.write(f'{alias}: archived {count} transaction(s)')
+        self.stdout.write(self.style.SUCCESS('Done'))
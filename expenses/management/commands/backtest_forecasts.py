@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from expenses.forecasting import backtest_users
+from expenses.ml_utils import PERIOD_DAYS
+from expenses.parallel import chunked, pool_map
+
+
+class Command(BaseCommand):
+    help = 'Backtest the forecasting models on every user and keep the best one per user and period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', choices=sorted(PERIOD_DAYS), help='Only this period (default: both).')
+        parser.add_argument('--user', type=int, help='Only process this user id.')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count).')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Users per task.')
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.using('default').order_by('pk').values_list('pk', flat=True)
+        if options['user'] is not None:
+            users = users.filter(pk=options['user'])
+        periods = [options['period']] if options['period'] else list(PERIOD_DAYS)
+        # Chunks are collected before the pool starts so no connection is open when it forks.
+        chunks = list(chunked(users.iterator(chunk_size=options['chunk_size']), options['chunk_size']))
+
+        for period in periods:
+            total = compared = 0
+            error = trend_error = 0.0
+            chosen = {}
+            for users_done, models, chunk_error, chunk_trend_error, chunk_compared in pool_map(
+                backtest_users, [(chunk, period) for chunk in chunks], options['workers']
+            ):
+                total += users_done
+                error += chunk_error
+                trend_error += chunk_trend_error
+                compared += chunk_compared
+                for model, count in models.items():
+                    chosen[model] = chosen.get(model, 0) + count
+
+            self.stdout.write(f'{period}: {sum(chosen.values())} of {total} user(s) have enough history')
+            for model, count in sorted(chosen.items(), key=lambda item: -item[1]):
+                self.stdout.write(f'  {model}: {count}')
+            if compared:
+                self.stdout.write(
+                    f'  mean backtest error {error / compared:.2f} with the chosen models, '
+                    f'{trend_error / compared:.2f} with the linear trend alone'
+                )
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,82 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from expenses.forecasting import MODELS, SEASON, align, forecasts, select, select_rows
+from expenses.ml_utils import PERIOD_DAYS
+from expenses.parallel import pool_map
+
+
+def synthetic(users, periods, period, seed):
+    """Spending series mixing level, trend, seasonality and noise, of varying lengths."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(periods)
+    level = rng.uniform(200, 2000, (users, 1))
+    trend = rng.normal(0, 0.01, (users, 1)) * level
+    seasonal = rng.uniform(0, 0.4, (users, 1)) * level * (rng.random((users, 1)) < 0.5)
+    phase = rng.uniform(0, 2 * np.pi, (users, 1))
+    noise = rng.uniform(0.05, 0.3, (users, 1)) * level * rng.standard_normal((users, periods))
+    Y = np.clip(level + trend * t + seasonal * np.sin(2 * np.pi * t / SEASON[period] + phase) + noise, 0, None)
+    lengths = rng.integers(periods // 4, periods + 1, users)
+    return align([row[periods - length:] for row, length in zip(Y, lengths)])
+
+
+class Command(BaseCommand):
+    help = 'Measure the speed and accuracy of the forecast backtest on synthetic spending series.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--periods', type=int, default=60, help='Longest history, in periods.')
+        parser.add_argument('--period', choices=sorted(PERIOD_DAYS), default='monthly')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count).')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Users per task.')
+        parser.add_argument('--loop-sample', type=int, default=200, help='Users to time one at a time.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        period = options['period']
+        Y = synthetic(options['users'], options['periods'], period, options['seed'])
+        history, actual = Y[:, :-1], Y[:, -1]
+        users = len(Y)
+
+        start = time.perf_counter()
+        best, _, predicted, _ = select(history, period)
+        vectorized = time.perf_counter() - start
+
+        chunks = [(history[i:i + options['chunk_size']], period) for i in range(0, users, options['chunk_size'])]
+        start = time.perf_counter()
+        pooled_predicted = np.concatenate(list(pool_map(select_rows, chunks, options['workers'])))
+        pooled = time.perf_counter() - start
+
+        sample = history[:options['loop_sample']]
+        start = time.perf_counter()
+        for row in sample:
+            select(row[None, ~np.isnan(row)], period)
+        looped = (time.perf_counter() - start) / max(len(sample), 1) * users
+
+        self.stdout.write(f'{users} {period} series of up to {options["periods"] - 1} periods')
+        self.stdout.write(f'  vectorized, one process: {vectorized:.3f}s ({users / vectorized:,.0f} users/s)')
+        self.stdout.write(f'  vectorized, pool:        {pooled:.3f}s ({users / pooled:,.0f} users/s)')
+        self.stdout.write(f'  one user at a time:      {looped:.3f}s (estimated from {len(sample)} users)')
+        assert np.allclose(predicted, pooled_predicted, equal_nan=True)
+
+        # Accuracy on the held-out last period, for users every model can forecast.
+        scored = ~np.isnan(predicted)
+        for model in MODELS:
+            if model == 'exponential_smoothing':
+                continue
+            scored &= ~np.isnan(forecasts(history, period, model)[:, -1])
+        self.stdout.write(f'Mean absolute error on the held-out period ({scored.sum()} users):')
+        self.stdout.write(f'  chosen per user: {np.abs(predicted - actual)[scored].mean():.2f}')
+        for index, model in enumerate(MODELS):
+            if model == 'exponential_smoothing':
+                fixed = forecasts(history, period, model, smoothing=0.3)[:, -1]
+                label = f'{model} (0.3)'
+            else:
+                fixed = forecasts(history, period, model)[:, -1]
+                label = model
+            share = (best[scored] == index).mean()
+            self.stdout.write(
+                f'  {label}: {np.abs(fixed - actual)[scored].mean():.2f} (chosen for {share:.0%})'
+            )
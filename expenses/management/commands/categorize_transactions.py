@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses.categorizer import recategorize, save_model, train
+
+
+class Command(BaseCommand):
+    help = 'Train the auto-categorization model, or categorize transactions that have no category.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--train', action='store_true', help='Retrain the model from categorized transactions.')
+        parser.add_argument('--min-samples', type=int, default=5,
+                            help='Ignore categories with fewer examples when training.')
+        parser.add_argument('--min-users', type=int, default=settings.CATEGORIZER_MIN_USERS,
+                            help='Ignore categories fewer users have when training.')
+        parser.add_argument('--batch-size', type=int, default=settings.CATEGORIZER_BATCH_SIZE,
+                            help='Rows per training step or predict call.')
+        parser.add_argument('--epochs', type=int, default=5,
+                            help='Passes over the categorized transactions when training.')
+
+    def handle(self, *args, **options):
+        if options['train']:
+            model, samples = train(
+                settings.DATABASE_SHARDS, options['min_samples'], options['batch_size'], options['epochs'],
+                options['min_users'],
+            )
+            if model is None:
+                raise CommandError('Not enough categorized transactions to train on.')
+            save_model(model)
+            self.stdout.write(self.style.SUCCESS(
+                f'Trained on {samples} transaction(s) across {len(model.classes_)} categories'
+            ))
+            return
+
+        total = 0
+        for alias in settings.DATABASE_SHARDS:
+            total += recategorize(alias, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Categorized {total} transaction(s)'))
@@ -0,0 +1,28 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from expenses.parallel import chunked, pool_map
+from expenses.recurring import refresh_users
+
+
+class Command(BaseCommand):
+    help = 'Detect recurring payments (subscriptions and bills) for every user, in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Only process this user id.')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count).')
+        parser.add_argument('--chunk-size', type=int, default=200, help='Users per task.')
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.using('default').order_by('pk').values_list('pk', flat=True)
+        if options['user'] is not None:
+            users = users.filter(pk=options['user'])
+
+        total_users = total_series = 0
+        chunks = chunked(users.iterator(chunk_size=options['chunk_size']), options['chunk_size'])
+        for processed, found in pool_map(refresh_users, list(chunks), options['workers']):
+            total_users += processed
+            total_series += found
+        self.stdout.write(self.style.SUCCESS(
+            f'Found {total_series} recurring payment(s) across {total_users} user(s)'
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from expenses.avatars import process_profile_picture
+from expenses.models import User
+
+
+class Command(BaseCommand):
+    help = 'Generate profile picture thumbnails for users whose picture has none yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Only process this user id.')
+        parser.add_argument('--all', action='store_true', help='Regenerate existing thumbnails too.')
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(profile_picture='').exclude(profile_picture=None).order_by('pk')
+        if options['user'] is not None:
+            users = users.filter(pk=options['user'])
+        if not options['all']:
+            users = users.filter(profile_thumbnails={})
+        count = 0
+        for user_id in users.values_list('pk', flat=True).iterator():
+            process_profile_picture(user_id)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Generated thumbnails for {count} user(s)'))
@@ -0,0 +1,18 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from expenses.reporting import build_report
+
+
+class Command(BaseCommand):
+    help = 'Platform-wide report: active users, volume per category and forecast accuracy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--active-days', type=int, default=30, help='Window for counting a user as active.')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count).')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users per task.')
+
+    def handle(self, *args, **options):
+        report = build_report(options['active_days'], options['chunk_size'], options['workers'])
+        self.stdout.write(json.dumps(report, indent=2))
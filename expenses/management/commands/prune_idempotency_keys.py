@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from expenses.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete stored Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL_SECONDS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL_SECONDS)
+        for alias in settings.DATABASE_SHARDS:
+            old = IdempotencyKey.objects.using(alias).filter(created_at__lt=cutoff)
+            count = 0
+            while True:
+                pks = list(old.order_by('pk').values_list('pk', flat=True)[:options['batch_size']])
+                if not pks:
+                    break
+                count += IdempotencyKey.objects.using(alias).filter(pk__in=pks)._raw_delete(alias)
+            self.stdout.write(f'{alias}: deleted {count} expired key(s)')
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from expenses.models import Tombstone
+
+
+class Command(BaseCommand):
+    help = 'Delete delta-sync tombstones older than SYNC_TOMBSTONE_DAYS; older cursors get a full resync.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+        for alias in settings.DATABASE_SHARDS:
+            old = Tombstone.objects.using(alias).filter(deleted_at__lt=cutoff)
+            count = 0
+            while True:
+                pks = list(old.order_by('pk').values_list('pk', flat=True)[:options['batch_size']])
+                if not pks:
+                    break
+                count += Tombstone.objects.using(alias).filter(pk__in=pks)._raw_delete(alias)
+            self.stdout.write(f'{alias}: deleted {count} tombstone(s)')
+        self.stdout.write(self.style.SUCCESS('Done'))
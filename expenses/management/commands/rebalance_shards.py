@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from tracker.routers import home_shard, shard_for_user, sharding_enabled
+from expenses.sharding import move_user
+
+
+class Command(BaseCommand):
+    help = "Move users' rows to their home shard, or move one user to a given shard."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Only move this user id.')
+        parser.add_argument('--to', dest='target', help='Target shard alias (defaults to the home shard).')
+        parser.add_argument('--dry-run', action='store_true', help='Report moves without performing them.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not sharding_enabled():
+            raise CommandError('Sharding is not enabled; set DATABASE_SHARD_URLS.')
+        target = options['target']
+        if target and target not in settings.DATABASE_SHARDS:
+            raise CommandError(f'Unknown shard "{target}". Choose from {settings.DATABASE_SHARDS}.')
+
+        users = get_user_model().objects.using('default').order_by('pk')
+        if options['user'] is not None:
+            users = users.filter(pk=options['user'])
+            if not users.exists():
+                raise CommandError(f'User {options["user"]} does not exist.')
+
+        moves = 0
+        for user in users.only('pk', 'username').iterator(chunk_size=1000):
+            source = shard_for_user(user.pk)
+            destination = target or home_shard(user.pk)
+            if source == destination:
+                continue
+            moves += 1
+            if options['dry_run']:
+                self.stdout.write(f'user {user.pk}: {source} -> {destination}')
+                continue
+            moved = move_user(user, destination, batch_size=options['batch_size'])
+            rows = sum(moved.values())
+            self.stdout.write(f'user {user.pk}: {source} -> {destination} ({rows} rows)')
+
+        verb = 'would move' if options['dry_run'] else 'moved'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {moves} user(s)'))
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from expenses.anomalies import rebuild_stats
+from expenses.parallel import chunked
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-category spending statistics used for anomaly detection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users per vectorized pass.')
+
+    def handle(self, *args, **options):
+        user_ids = get_user_model().objects.using('default').order_by('pk').values_list('pk', flat=True)
+        total = 0
+        for chunk in chunked(user_ids.iterator(chunk_size=options['chunk_size']), options['chunk_size']):
+            for alias in settings.DATABASE_SHARDS:
+                total += rebuild_stats(alias, chunk)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {total} category statistic(s)'))
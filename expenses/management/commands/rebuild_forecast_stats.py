@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from expenses.ml_utils import PERIOD_DAYS, batch_predict, forecast, rebuild_forecast_stats
+from expenses.models import ForecastStats
+from tracker.routers import shard_for_user, user_context
+
+
+class Command(BaseCommand):
+    help = 'Recompute the spending buckets and running sums behind expense forecasts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Only rebuild this user.')
+        parser.add_argument('--verify', action='store_true',
+                            help='Compare each incremental forecast with a full refit instead of rebuilding.')
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.using('default').order_by('pk')
+        if options['user']:
+            users = users.filter(pk=options['user'])
+
+        mismatches = total = 0
+        for user in users.iterator():
+            alias = shard_for_user(user.pk)
+            with user_context(user.pk):
+                if not options['verify']:
+                    rebuild_forecast_stats(user.pk, alias)
+                    total += 1
+                    continue
+                for period in PERIOD_DAYS:
+                    stats = ForecastStats.objects.using(alias).filter(user_id=user.pk, period=period).first()
+                    expected = batch_predict(user, period)
+                    actual = forecast(stats, period) if stats and stats.n >= 3 else None
+                    total += 1
+                    if (expected is None) != (actual is None) or (
+                        expected is not None and abs(expected - actual) > 0.01
+                    ):
+                        mismatches += 1
+                        self.stdout.write(f'user {user.pk} {period}: stored {actual}, refit {expected}')
+
+        if options['verify']:
+            style = self.style.SUCCESS if not mismatches else self.style.ERROR
+            self.stdout.write(style(f'{mismatches} of {total} forecast(s) differ from a full refit'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt forecast statistics for {total} user(s)'))
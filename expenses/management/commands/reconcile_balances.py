@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from expenses.reconcile import reconcile_balances
+
+
+class Command(BaseCommand):
+    help = 'Compare every account balance with its opening balance plus transactions, and optionally fix drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Overwrite drifted balances with the expected ones.')
+        parser.add_argument('--adopt', action='store_true',
+                            help='Take the current balances of accounts without an opening balance as correct.')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Accounts per task.')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count).')
+
+    def handle(self, *args, **options):
+        checked = drifted = unanchored = 0
+        total_drift = 0
+        for alias, count, rows, unknown in reconcile_balances(
+            options['fix'], options['chunk_size'], options['workers'], options['adopt']
+        ):
+            checked += count
+            drifted += len(rows)
+            unanchored += len(unknown)
+            for pk, user_id, stored, expected in rows:
+                total_drift += abs(stored - expected)
+                self.stdout.write(f'{alias}: account {pk} (user {user_id}) stored {stored}, expected {expected}')
+            for pk, user_id, stored, net in unknown:
+                self.stdout.write(
+                    f'{alias}: account {pk} (user {user_id}) has no opening balance; stored {stored}, '
+                    f'transactions net {net:.2f}'
+                )
+
+        action = 'fixed' if options['fix'] else 'found'
+        style = self.style.SUCCESS if not drifted or options['fix'] else self.style.ERROR
+        self.stdout.write(style(
+            f'Checked {checked} account(s); {action} {drifted} with drift totalling {total_drift}'
+        ))
+        if unanchored:
+            self.stdout.write(self.style.WARNING(
+                f'Adopted the current balances of {unanchored} account(s) without an opening balance'
+                if options['adopt'] else
+                f'{unanchored} account(s) have no opening balance; check them, then run with --adopt '
+                'to take their current balances as correct'
+            ))
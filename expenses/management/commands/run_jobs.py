@@ -0,0 +1,42 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from expenses.jobs import claim, run, worker_name
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs. Start as many as needed; they never pick the same job.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is runnable.')
+        parser.add_argument('--max-jobs', type=int, default=None, help='Exit after running this many jobs.')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        worker = worker_name()
+        done = failed = 0
+        while not self.stopping:
+            close_old_connections()
+            job = claim(worker)
+            if job is None:
+                if options['burst']:
+                    break
+                time.sleep(settings.JOB_POLL_SECONDS)
+                continue
+            if run(job):
+                done += 1
+            else:
+                failed += 1
+            if options['max_jobs'] is not None and done + failed >= options['max_jobs']:
+                break
+        self.stdout.write(self.style.SUCCESS(f'{worker}: {done} job(s) run, {failed} not completed'))
+
+    def stop(self, signum, frame):
+        # Finish the current job, then exit.
+        self.stopping = True
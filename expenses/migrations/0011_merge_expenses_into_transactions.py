@@ -0,0 +1,137 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def merge_expenses(apps, schema_editor):
+    """
+    Copy Expense and ArchivedExpense rows into the transaction tables. The
+    expenses get new ids, since Transaction already uses the old ones;
+    LegacyExpenseId records the old id of each.
+    """
+    alias = schema_editor.connection.alias
+    Expense = apps.get_model('expenses', 'Expense')
+    Transaction = apps.get_model('expenses', 'Transaction')
+    LegacyExpenseId = apps.get_model('expenses', 'LegacyExpenseId')
+    ArchivedExpense = apps.get_model('expenses', 'ArchivedExpense')
+    ArchivedTransaction = apps.get_model('expenses', 'ArchivedTransaction')
+    MonthlySummary = apps.get_model('expenses', 'MonthlySummary')
+
+    def copy(batch):
+        # bulk_create sets the new ids (RETURNING on PostgreSQL and SQLite 3.35+).
+        Transaction.objects.using(alias).bulk_create([row for _, row in batch])
+        LegacyExpenseId.objects.using(alias).bulk_create([
+            LegacyExpenseId(user_id=row.user_id, transaction_id=row.pk, expense_id=old_id) for old_id, row in batch
+        ])
+
+    batch = []
+    for expense in Expense.objects.using(alias).order_by('pk').iterator(chunk_size=BATCH_SIZE):
+        batch.append((expense.pk, Transaction(
+            user_id=expense.user_id, account_id=expense.account_id, amount=expense.amount,
+            category=expense.category, description=expense.description, date=expense.date,
+            type='expense', title=expense.description[:255],
+        )))
+        if len(batch) >= BATCH_SIZE:
+            copy(batch)
+            batch = []
+    copy(batch)
+
+    batch = []
+    for expense in ArchivedExpense.objects.using(alias).order_by('pk').iterator(chunk_size=BATCH_SIZE):
+        batch.append(ArchivedTransaction(
+            original_id=expense.original_id, user_id=expense.user_id, account_id=expense.account_id,
+            amount=expense.amount, category=expense.category, description=expense.description,
+            date=expense.date, type='expense', title=expense.description[:255],
+        ))
+        if len(batch) >= BATCH_SIZE:
+            ArchivedTransaction.objects.using(alias).bulk_create(batch)
+            batch = []
+    ArchivedTransaction.objects.using(alias).bulk_create(batch)
+
+    summaries = MonthlySummary.objects.using(alias)
+    for summary in summaries.filter(source='expense').iterator(chunk_size=BATCH_SIZE):
+        merged, created = summaries.get_or_create(
+            user_id=summary.user_id, month=summary.month, source='transaction',
+            type='expense', category=summary.category,
+            defaults={'total': summary.total, 'count': summary.count},
+        )
+        if not created:
+            merged.total += summary.total
+            merged.count += summary.count
+            merged.save(update_fields=['total', 'count'])
+    summaries.filter(source='expense').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0010_archive'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'type', 'date'], name='expenses_tr_user_id_81a5db_idx'),
+        ),
+        migrations.CreateModel(
+            name='LegacyExpenseId',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expense_id', models.BigIntegerField()),
+                ('transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='legacy_id', to='expenses.transaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='legacy_expense_ids', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'expense_id')},
+            },
+        ),
+        migrations.RunPython(merge_expenses, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='archivedexpense',
+            name='account',
+        ),
+        migrations.RemoveField(
+            model_name='archivedexpense',
+            name='user',
+        ),
+        migrations.RemoveField(
+            model_name='expense',
+            name='account',
+        ),
+        migrations.RemoveField(
+            model_name='expense',
+            name='user',
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlysummary',
+            unique_together={('user', 'month', 'type', 'category')},
+        ),
+        migrations.DeleteModel(
+            name='ArchivedExpense',
+        ),
+        migrations.DeleteModel(
+            name='Expense',
+        ),
+        migrations.RemoveField(
+            model_name='monthlysummary',
+            name='source',
+        ),
+        migrations.CreateModel(
+            name='Expense',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'Expense',
+                'verbose_name_plural': 'Expenses',
+                'ordering': ['-date'],
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('expenses.transaction',),
+        ),
+    ]
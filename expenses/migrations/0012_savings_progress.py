@@ -0,0 +1,65 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:41
+
+import math
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def project_completion(goal):
+    # As SavingsGoal.project_completion(), which historical models lack.
+    if not goal.progress or goal.saved <= 0:
+        return None
+    for day, cumulative in goal.progress:
+        if Decimal(cumulative) >= goal.target:
+            return date.fromisoformat(day)
+    last_day = date.fromisoformat(goal.progress[-1][0])
+    elapsed = max((last_day - goal.created_at.date()).days + 1, 1)
+    daily_rate = goal.saved / elapsed
+    return last_day + timedelta(days=math.ceil((goal.target - goal.saved) / daily_rate))
+
+
+def backfill_progress(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    SavingsGoal = apps.get_model('expenses', 'SavingsGoal')
+    SavingsContribution = apps.get_model('expenses', 'SavingsContribution')
+
+    for goal in SavingsGoal.objects.using(alias).iterator():
+        contributions = list(
+            SavingsContribution.objects.using(alias).filter(goal=goal).order_by('date', 'pk').values('date', 'amount')
+        )
+        # Whatever was saved before the first contribution is the starting point
+        cumulative = goal.saved - sum(c['amount'] for c in contributions)
+        progress = []
+        for contribution in contributions:
+            cumulative += contribution['amount']
+            point = [contribution['date'].isoformat(), str(cumulative)]
+            if progress and progress[-1][0] == point[0]:
+                progress[-1] = point
+            else:
+                progress.append(point)
+        goal.progress = progress
+        goal.projected_completion = project_completion(goal)
+        goal.save(update_fields=['progress', 'projected_completion'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0011_merge_expenses_into_transactions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savingsgoal',
+            name='progress',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='savingsgoal',
+            name='projected_completion',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_progress, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0012_savings_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringPayment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255)),
+                ('category', models.CharField(blank=True, max_length=100)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('period', models.CharField(choices=[('weekly', 'Weekly'), ('monthly', 'Monthly'), ('yearly', 'Yearly')], max_length=10)),
+                ('occurrences', models.PositiveIntegerField()),
+                ('last_date', models.DateField()),
+                ('next_date', models.DateField()),
+                ('detected_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_payments', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['next_date'],
+                'indexes': [models.Index(fields=['user', 'next_date'], name='expenses_re_user_id_844c29_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 10000
+
+
+def backfill_stats(apps, schema_editor):
+    # Mirrors expenses.anomalies.rebuild_stats with historical models: one
+    # pass over the expenses in (user, category) order, folding each amount
+    # in as CategoryStats.add does.
+    alias = schema_editor.connection.alias
+    Transaction = apps.get_model('expenses', 'Transaction')
+    CategoryStats = apps.get_model('expenses', 'CategoryStats')
+
+    rows = (
+        Transaction.objects.using(alias).filter(type='expense')
+        .order_by('user_id', 'category').values_list('user_id', 'category', 'amount')
+    )
+    batch, stats = [], None
+    for user_id, category, amount in rows.iterator(chunk_size=BATCH_SIZE):
+        if stats is None or (stats.user_id, stats.category) != (user_id, category):
+            stats = CategoryStats(user_id=user_id, category=category, count=0, mean=0.0, m2=0.0)
+            batch.append(stats)
+            if len(batch) > BATCH_SIZE:
+                CategoryStats.objects.using(alias).bulk_create(batch[:-1])
+                batch = batch[-1:]
+        amount = float(amount)
+        stats.count += 1
+        delta = amount - stats.mean
+        stats.mean += delta / stats.count
+        stats.m2 += delta * (amount - stats.mean)
+    CategoryStats.objects.using(alias).bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0013_recurringpayment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=100)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('mean', models.FloatField(default=0)),
+                ('m2', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='category_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'category')},
+            },
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
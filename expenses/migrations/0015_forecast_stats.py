@@ -0,0 +1,90 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:44
+
+from datetime import date
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+
+
+def backfill_buckets(apps, schema_editor):
+    # Mirrors expenses.ml_utils.rebuild_forecast_stats with historical models.
+    alias = schema_editor.connection.alias
+    Transaction = apps.get_model('expenses', 'Transaction')
+    MonthlySummary = apps.get_model('expenses', 'MonthlySummary')
+    SpendingBucket = apps.get_model('expenses', 'SpendingBucket')
+    ForecastStats = apps.get_model('expenses', 'ForecastStats')
+    epoch = date(2000, 1, 1)
+
+    expenses = Transaction.objects.using(alias).filter(type='expense').order_by()
+    for period, trunc in (('weekly', TruncWeek('date')), ('monthly', TruncMonth('date'))):
+        totals = {}
+        rows = expenses.annotate(start=trunc).values('user_id', 'start').annotate(amount=Sum('amount'), count=Count('id'))
+        for row in rows:
+            totals[row['user_id'], row['start']] = [row['amount'], row['count']]
+        if period == 'monthly':
+            summaries = MonthlySummary.objects.using(alias).filter(type='expense').order_by()
+            for row in summaries.values('user_id', 'month').annotate(amount=Sum('total'), count=Sum('count')):
+                total = totals.setdefault((row['user_id'], row['month']), [0, 0])
+                total[0] += row['amount']
+                total[1] += row['count']
+
+        buckets, stats = [], {}
+        for (user_id, start), (amount, count) in totals.items():
+            buckets.append(SpendingBucket(user_id=user_id, period=period, start=start, amount=amount, count=count))
+            x = (start - epoch).days
+            s = stats.setdefault(user_id, ForecastStats(user_id=user_id, period=period, sum_y=0, sum_xy=0))
+            s.n += 1
+            s.sum_x += x
+            s.sum_y += amount
+            s.sum_xy += x * amount
+            s.sum_xx += x * x
+            if s.last_start is None or start > s.last_start:
+                s.last_start = start
+        SpendingBucket.objects.using(alias).bulk_create(buckets, batch_size=1000)
+        ForecastStats.objects.using(alias).bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0014_categorystats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForecastStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('weekly', 'Weekly'), ('monthly', 'Monthly')], max_length=10)),
+                ('n', models.PositiveIntegerField(default=0)),
+                ('sum_x', models.BigIntegerField(default=0)),
+                ('sum_y', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('sum_xy', models.DecimalField(decimal_places=2, default=0, max_digits=28)),
+                ('sum_xx', models.BigIntegerField(default=0)),
+                ('last_start', models.DateField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='forecast_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'period')},
+            },
+        ),
+        migrations.CreateModel(
+            name='SpendingBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('weekly', 'Weekly'), ('monthly', 'Monthly')], max_length=10)),
+                ('start', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='spending_buckets', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['start'],
+                'unique_together': {('user', 'period', 'start')},
+            },
+        ),
+        migrations.RunPython(backfill_buckets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:50
+
+from django.db import migrations, transaction
+from django.db.models import Max, OuterRef, Subquery
+
+BATCH_SIZE = 10000
+MODELS = ('Transaction', 'ArchivedTransaction', 'MonthlySummary', 'CategoryStats')
+
+
+def pk_ranges(queryset):
+    last = queryset.aggregate(last=Max('pk'))['last'] or 0
+    for start in range(0, last + 1, BATCH_SIZE):
+        yield queryset.filter(pk__gte=start, pk__lt=start + BATCH_SIZE)
+
+
+def populate_categories(apps, schema_editor):
+    """Create a Category per distinct (user, name) and point every row at it, in batches."""
+    alias = schema_editor.connection.alias
+    Category = apps.get_model('expenses', 'Category')
+
+    for name in MODELS:
+        rows = apps.get_model('expenses', name).objects.using(alias).order_by()
+        pairs = rows.filter(category_ref__isnull=True).values_list('user_id', 'category').distinct()
+        batch = []
+        for user_id, category in pairs.iterator(chunk_size=BATCH_SIZE):
+            batch.append(Category(user_id=user_id, name=category))
+            if len(batch) >= BATCH_SIZE:
+                Category.objects.using(alias).bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        Category.objects.using(alias).bulk_create(batch, ignore_conflicts=True)
+
+    # Commit per batch so a large table is not rewritten in one transaction;
+    # rows already pointed at their category are skipped on a re-run.
+    category_id = Category.objects.using(alias).filter(
+        user_id=OuterRef('user_id'), name=OuterRef('category')
+    ).values('pk')[:1]
+    for name in MODELS:
+        rows = apps.get_model('expenses', name).objects.using(alias).order_by()
+        for batch in pk_ranges(rows):
+            with transaction.atomic(using=alias):
+                batch.filter(category_ref__isnull=True).update(category_ref=Subquery(category_id))
+
+
+def restore_names(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    Category = apps.get_model('expenses', 'Category')
+    name = Category.objects.using(alias).filter(pk=OuterRef('category_ref')).values('name')[:1]
+    for model_name in MODELS:
+        rows = apps.get_model('expenses', model_name).objects.using(alias).order_by()
+        for batch in pk_ranges(rows):
+            with transaction.atomic(using=alias):
+                batch.update(category=Subquery(name))
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('expenses', '0016_category'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_categories, restore_names),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 5.2.2 on 2026-10-19 14:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0017_populate_categories'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='monthlysummary',
+            unique_together=set(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='categorystats',
+            unique_together=set(),
+        ),
+        # A default lets the old columns be re-added when migrating backwards.
+        migrations.AlterField(
+            model_name='transaction',
+            name='category',
+            field=models.CharField(default='', max_length=100, verbose_name='category'),
+        ),
+        migrations.AlterField(
+            model_name='archivedtransaction',
+            name='category',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='monthlysummary',
+            name='category',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='categorystats',
+            name='category',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='category',
+        ),
+        migrations.RemoveField(
+            model_name='archivedtransaction',
+            name='category',
+        ),
+        migrations.RemoveField(
+            model_name='monthlysummary',
+            name='category',
+        ),
+        migrations.RemoveField(
+            model_name='categorystats',
+            name='category',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.RenameField(
+            model_name='archivedtransaction',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.RenameField(
+            model_name='monthlysummary',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.RenameField(
+            model_name='categorystats',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, related_name='transactions', to='expenses.category', verbose_name='category'),
+        ),
+        migrations.AlterField(
+            model_name='archivedtransaction',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, related_name='archived_transactions', to='expenses.category'),
+        ),
+        migrations.AlterField(
+            model_name='monthlysummary',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, related_name='monthly_summaries', to='expenses.category'),
+        ),
+        migrations.AlterField(
+            model_name='categorystats',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='expenses.category'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlysummary',
+            unique_together={('user', 'month', 'type', 'category')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='categorystats',
+            unique_together={('user', 'category')},
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.2 on 2026-10-19 15:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0019_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='date',
+            field=models.DateField(default=django.utils.timezone.localdate, verbose_name='date'),
+        ),
+    ]
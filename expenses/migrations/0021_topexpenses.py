@@ -0,0 +1,48 @@
+# Generated by Django 5.2.2 on 2026-10-19 15:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber, TruncMonth
+
+
+def backfill_top_expenses(apps, schema_editor):
+    # Mirrors expenses.top_expenses.derive_all with historical models.
+    alias = schema_editor.connection.alias
+    Transaction = apps.get_model('expenses', 'Transaction')
+    TopExpenses = apps.get_model('expenses', 'TopExpenses')
+    ranked = Transaction.objects.using(alias).filter(type='expense').annotate(
+        month=TruncMonth('date'),
+        rank=Window(RowNumber(), partition_by=[F('user_id'), TruncMonth('date')], order_by=[F('amount').desc(), 'pk']),
+    ).filter(rank__lte=settings.TOP_EXPENSES_SIZE).order_by()
+    lists = {}
+    for user_id, month, amount, pk in ranked.values_list('user_id', 'month', 'amount', 'pk'):
+        lists.setdefault((user_id, month), []).append([round(amount * 100), pk])
+    TopExpenses.objects.using(alias).bulk_create([
+        TopExpenses(user_id=user_id, month=month, entries=sorted(entries, key=lambda entry: (-entry[0], entry[1])))
+        for (user_id, month), entries in lists.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0020_transaction_date_localdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopExpenses',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('entries', models.JSONField(default=list)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='top_expenses', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'month')},
+            },
+        ),
+        migrations.RunPython(backfill_top_expenses, migrations.RunPython.noop),
+    ]
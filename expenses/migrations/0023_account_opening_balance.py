@@ -0,0 +1,18 @@
+# Generated by Django 5.2.2 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0022_user_profile_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='opening_balance',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True, verbose_name='opening balance'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.2 on 2026-10-19 15:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0025_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForecastChoice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('weekly', 'Weekly'), ('monthly', 'Monthly')], max_length=10)),
+                ('model', models.CharField(max_length=30)),
+                ('smoothing', models.FloatField(blank=True, null=True)),
+                ('error', models.FloatField()),
+                ('trend_error', models.FloatField(blank=True, null=True)),
+                ('backtested_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='forecast_choices', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'period')},
+            },
+        ),
+    ]
@@ -1,39 +1,155 @@
 # ml_utils.py
 
 import pandas as pd
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
 from django.utils.timezone import now
-from datetime import timedelta
-from .models import Expense
+from datetime import date, datetime, time, timedelta
+from .spending import period_totals
 from sklearn.linear_model import LinearRegression
 import numpy as np
-from .models import PredictionLog
+from .models import PredictionLog, SpendingBucket, ForecastChoice, ForecastStats, Transaction, MonthlySummary
+from .forecasting import forecast_next
+
+PERIOD_DAYS = {'weekly': 7, 'monthly': 30}
+# Origin of the x axis of ForecastStats. The fit does not depend on it.
+FORECAST_EPOCH = date(2000, 1, 1)
 
 
 def get_expense_dataframe(user, period='monthly'):
-    expenses = Expense.objects.filter(user=user)
+    # Archived months only survive as monthly summaries, so they can
+    # extend the monthly history but not the weekly one.
+    starts, cents = period_totals(user, period, include_archived_months=(period != 'weekly'))
 
-    if not expenses.exists():
+    if not len(starts):
         return None
 
-    df = pd.DataFrame(list(expenses.values('amount', 'date')))
-    df['date'] = pd.to_datetime(df['date'])
+    return pd.DataFrame({'period': starts.astype('datetime64[ns]'), 'amount': cents / 100})
 
-    if period == 'weekly':
-        df['week'] = df['date'].dt.to_period('W').apply(lambda r: r.start_time)
-        grouped = df.groupby('week')['amount'].sum().reset_index()
-        grouped = grouped.rename(columns={'week': 'period'})
-    else:
-        df['month'] = df['date'].dt.to_period('M').apply(lambda r: r.start_time)
-        grouped = df.groupby('month')['amount'].sum().reset_index()
-        grouped = grouped.rename(columns={'month': 'period'})
 
-    return grouped
+def batch_predict(user, period='monthly'):
+    """Refit the trend from the full history. Reference for the incremental forecast."""
+    df = get_expense_dataframe(user, period)
+    if df is None or len(df) < 3:
+        return None
+
+    df['timestamp'] = (df['period'] - df['period'].min()).dt.days
+    model = LinearRegression()
+    model.fit(df[['timestamp']], df['amount'])
+
+    next_timestamp = df['timestamp'].max() + PERIOD_DAYS[period]
+    return model.predict(pd.DataFrame({'timestamp': [next_timestamp]}))[0]
+
+
+def period_start(day, period):
+    if period == 'weekly':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def adjust_bucket(user_id, period, start, amount, count, using):
+    """Add amount/count (negative to remove) to one bucket and keep ForecastStats in step."""
+    x = (start - FORECAST_EPOCH).days
+    with transaction.atomic(using=using):
+        buckets = SpendingBucket.objects.db_manager(using).select_for_update()
+        all_stats = ForecastStats.objects.db_manager(using).select_for_update()
+        if count > 0:
+            bucket, _ = buckets.get_or_create(user_id=user_id, period=period, start=start)
+            stats, _ = all_stats.get_or_create(user_id=user_id, period=period)
+        else:
+            bucket = buckets.filter(user_id=user_id, period=period, start=start).first()
+            stats = all_stats.filter(user_id=user_id, period=period).first()
+            if bucket is None or stats is None:
+                return
+
+        if bucket.count:
+            stats.add(x, bucket.amount, sign=-1)
+        bucket.amount += amount
+        bucket.count += count
+        if bucket.count > 0:
+            bucket.save()
+            stats.add(x, bucket.amount)
+            if stats.last_start is None or start > stats.last_start:
+                stats.last_start = start
+        else:
+            bucket.delete()
+            if start == stats.last_start:
+                stats.last_start = SpendingBucket.objects.using(using).filter(
+                    user_id=user_id, period=period
+                ).aggregate(last=Max('start'))['last']
+        stats.save()
+
+
+def record_spending_changes(changes, using):
+    """
+    Update the buckets of expenses that went from old to new, for (old, new)
+    pairs of Transaction.spending_state() tuples or None (created / deleted).
+    Each bucket touched is adjusted once.
+    """
+    for period in PERIOD_DAYS:
+        totals = {}
+        for old, new in changes:
+            for state, sign in ((old, -1), (new, 1)):
+                if state is not None:
+                    user_id, day, amount, _ = state
+                    key = (user_id, period_start(day, period))
+                    total, count = totals.get(key, (0, 0))
+                    totals[key] = (total + sign * amount, count + sign)
+        for (user_id, start), (amount, count) in sorted(totals.items()):
+            if amount or count:
+                adjust_bucket(user_id, period, start, amount, count, using)
+
+
+def record_spending_change(old, new, using):
+    record_spending_changes([(old, new)], using)
+
+
+def rebuild_forecast_stats(user_id, using):
+    """Recompute a user's buckets and ForecastStats from their history."""
+    expenses = Transaction.objects.using(using).filter(user_id=user_id, type='expense').order_by()
+    buckets, all_stats = [], []
+    for period, trunc in (('weekly', TruncWeek('date')), ('monthly', TruncMonth('date'))):
+        totals = {
+            row['start']: [row['amount'], row['count']]
+            for row in expenses.annotate(start=trunc).values('start').annotate(amount=Sum('amount'), count=Count('id'))
+        }
+        if period == 'monthly':
+            summaries = MonthlySummary.objects.using(using).filter(user_id=user_id, type='expense')
+            for row in summaries.values('month').annotate(amount=Sum('total'), count=Sum('count')):
+                total = totals.setdefault(row['month'], [0, 0])
+                total[0] += row['amount']
+                total[1] += row['count']
+
+        stats = ForecastStats(user_id=user_id, period=period, last_start=max(totals, default=None))
+        for start, (amount, count) in totals.items():
+            buckets.append(SpendingBucket(user_id=user_id, period=period, start=start, amount=amount, count=count))
+            stats.add((start - FORECAST_EPOCH).days, amount)
+        all_stats.append(stats)
+
+    with transaction.atomic(using=using):
+        SpendingBucket.objects.using(using).filter(user_id=user_id).delete()
+        ForecastStats.objects.using(using).filter(user_id=user_id).delete()
+        SpendingBucket.objects.using(using).bulk_create(buckets, batch_size=1000)
+        ForecastStats.objects.using(using).bulk_create(all_stats)
+
+
+def forecast(stats, period):
+    """Least-squares trend evaluated one period after the last bucket, in O(1)."""
+    n = stats.n
+    mean_x = stats.sum_x / n
+    mean_y = float(stats.sum_y) / n
+    # Exact integer/decimal arithmetic keeps the numerator and denominator free of cancellation.
+    denominator = n * stats.sum_xx - stats.sum_x ** 2
+    slope = float(n * stats.sum_xy - stats.sum_x * stats.sum_y) / denominator if denominator else 0.0
+    next_x = (stats.last_start - FORECAST_EPOCH).days + PERIOD_DAYS[period]
+    return mean_y + slope * (next_x - mean_x)
 
 
 def predict_next(user, period='monthly'):
-    df = get_expense_dataframe(user, period)
+    stats = ForecastStats.objects.filter(user=user, period=period).first()
 
-    if df is None or len(df) < 3:
+    if stats is None or stats.n < 3:
         return {
             "success": False,
             "message": f"Not enough {period} data to make predictions. At least 3 data points required.",
@@ -41,19 +157,17 @@ def predict_next(user, period='monthly'):
             "history": []
         }
 
-    df['timestamp'] = (df['period'] - df['period'].min()).dt.days
-    X = df[['timestamp']]
-    y = df['amount']
-
-    model = LinearRegression()
-    model.fit(X, y)
-
-    # Predict the next period
-    last_timestamp = df['timestamp'].max()
-    next_timestamp = last_timestamp + (7 if period == 'weekly' else 30)
-    next_amount = model.predict([[next_timestamp]])[0]
-
-    next_period_start = (df['period'].max() + pd.Timedelta(days=(7 if period == 'weekly' else 30))).date()
+    buckets = list(SpendingBucket.objects.filter(user=user, period=period).order_by('start'))
+    # The model that backtested best (manage.py backtest_forecasts); the
+    # incremental trend otherwise, or when that model has too little history.
+    choice = ForecastChoice.objects.filter(user=user, period=period).first()
+    model, next_amount = 'linear_trend', None
+    if choice is not None and choice.model != 'linear_trend':
+        model = choice.model
+        next_amount = forecast_next([b.start for b in buckets], [b.amount for b in buckets], period, choice)
+    if next_amount is None:
+        model, next_amount = 'linear_trend', forecast(stats, period)
+    next_period_start = stats.last_start + timedelta(days=PERIOD_DAYS[period])
 
     PredictionLog.objects.create(
         user=user,
@@ -62,13 +176,16 @@ def predict_next(user, period='monthly'):
         target_period_start=next_period_start
     )
 
-    prediction_series = df[['period', 'amount']].copy()
-    prediction_series = prediction_series.rename(columns={"amount": "actual"})
-    prediction_series['predicted'] = None
+    history = [{
+        "period": datetime.combine(bucket.start, time()),
+        "actual": bucket.amount,
+        "predicted": None,
+    } for bucket in buckets]
 
     return {
         "success": True,
         "prediction": round(next_amount, 2),
-        "history": prediction_series.to_dict(orient='records'),
+        "model": model,
+        "history": history,
         "next_period": str(next_period_start)
-    }
\ No newline at end of file
+    }
@@ -1,13 +1,20 @@
+import math
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
 from django.conf import settings
-from django.utils.timezone import now
+from django.utils.timezone import localdate, now
 
 
 class User(AbstractUser):
 
     profile_picture = models.ImageField(upload_to='profile_pics/', null=True, blank=True)
+    # {size: storage name} of WebP thumbnails of profile_picture; see expenses.avatars
+    profile_thumbnails = models.JSONField(default=dict, blank=True)
     """
     Custom user model extending Django's AbstractUser.
     Add custom fields here if needed in the future.
@@ -23,32 +30,6 @@ class User(AbstractUser):
 
  
 
-class Expense(models.Model):
-    user = models.ForeignKey(
-        settings.AUTH_USER_MODEL,
-        on_delete=models.CASCADE,
-        related_name='expenses',
-        verbose_name='user'  # Adds a human-readable name in admin
-    )
-    account = models.ForeignKey('Account', on_delete=models.CASCADE, related_name='expenses') 
-    amount = models.DecimalField(
-        max_digits=10,
-        decimal_places=2,
-        validators=[MinValueValidator(0.01)],
-        verbose_name='amount'
-    )
-    category = models.CharField(max_length=100, verbose_name='category')
-    description = models.TextField(blank=True, verbose_name='description')
-    date = models.DateField(default=now, verbose_name='date')
-    
-    class Meta:
-        verbose_name = 'Expense'
-        verbose_name_plural = 'Expenses'
-        ordering = ['-date']  # Default ordering
-    
-    def __str__(self):
-        return f"{self.date}: {self.category} - ${self.amount}"
-
 class Account(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -70,15 +51,60 @@ class Account(models.Model):
         default=0,
         verbose_name='balance'
     )
+    # Balance before any recorded transaction; see expenses/reconcile.py.
+    # Unknown (None) for accounts that predate it.
+    opening_balance = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        verbose_name='opening balance'
+    )
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         verbose_name = 'Account'
         verbose_name_plural = 'Accounts'
         unique_together = [['user', 'account_number']]  # Prevent duplicate accounts
+        indexes = [models.Index(fields=['user', 'updated_at'])]
     
     def __str__(self):
         return f"{self.bank_name} ({self.account_number[-4:]}) - ${self.balance}"
 
+    def save(self, *args, **kwargs):
+        # A new account has no transactions yet, so it opens at its balance.
+        if self._state.adding and self.opening_balance is None:
+            self.opening_balance = self.balance
+        super().save(*args, **kwargs)
+
+class CategoryManager(models.Manager):
+    def resolve(self, user_id, names):
+        """{name: id} of the user's categories with these names, creating the missing ones."""
+        names = set(names)
+        found = dict(self.filter(user_id=user_id, name__in=names).values_list('name', 'pk'))
+        missing = names - found.keys()
+        if missing:
+            self.bulk_create([self.model(user_id=user_id, name=name) for name in missing], ignore_conflicts=True)
+            found.update(self.filter(user_id=user_id, name__in=missing).values_list('name', 'pk'))
+        return found
+
+
+class Category(models.Model):
+    """A user's spending or income category; transactions reference it by id."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='categories')
+    name = models.CharField(max_length=100)
+
+    objects = CategoryManager()
+
+    class Meta:
+        unique_together = ('user', 'name')
+        ordering = ['name']
+        verbose_name_plural = 'Categories'
+
+    def __str__(self):
+        return self.name
+
+
 class Transaction(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -93,16 +119,18 @@ class Transaction(models.Model):
         validators=[MinValueValidator(0.01)],
         verbose_name='amount'
     )
-    category = models.CharField(max_length=100, verbose_name='category')
+    category = models.ForeignKey(Category, on_delete=models.RESTRICT, related_name='transactions', verbose_name='category')
     description = models.TextField(blank=True, verbose_name='description')
-    date = models.DateField(default=now, verbose_name='date')
+    date = models.DateField(default=localdate, verbose_name='date')
     type = models.CharField(max_length=10, choices=[('income', 'Income'), ('expense', 'Expense')], verbose_name='type')
     title = models.CharField(max_length=255, blank=True, verbose_name='title')
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Transaction'
         verbose_name_plural = 'Transactions'
         ordering = ['-date']
+        indexes = [models.Index(fields=['user', 'type', 'date']), models.Index(fields=['user', 'updated_at'])]
 
     def __str__(self):
         return f"{self.date}: {self.type} - ${self.amount}"
@@ -112,6 +140,66 @@ class Transaction(models.Model):
             self.title = self.description
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what was loaded so receivers can undo its effect on an update.
+        instance._loaded_spending = instance.spending_state()
+        return instance
+
+    def spending_state(self):
+        """(user_id, date, amount, category_id) if this is a fully loaded expense, else None."""
+        fields = self.__dict__
+        if fields.get('type') != 'expense' or 'date' not in fields or 'amount' not in fields:
+            return None
+        day = fields['date']
+        if isinstance(day, datetime):
+            day = day.date()
+        return (fields.get('user_id'), day, fields['amount'], fields.get('category_id'))
+
+
+class ExpenseManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().filter(type='expense')
+
+
+class Expense(Transaction):
+    """
+    Expense-type transactions, kept so the /expenses/ API keeps working.
+    All spending is stored in the Transaction table.
+    """
+    objects = ExpenseManager()
+
+    class Meta:
+        proxy = True
+        verbose_name = 'Expense'
+        verbose_name_plural = 'Expenses'
+        ordering = ['-date']
+
+    def __str__(self):
+        return f"{self.date}: {self.category} - ${self.amount}"
+
+    def save(self, *args, **kwargs):
+        self.type = 'expense'
+        super().save(*args, **kwargs)
+
+
+class LegacyExpenseId(models.Model):
+    """
+    The id an expense had in the old Expense table. Migration 0011 moved
+    expenses into Transaction under new ids; this maps the old ones over.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='legacy_expense_ids')
+    transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, related_name='legacy_id')
+    expense_id = models.BigIntegerField()
+
+    class Meta:
+        unique_together = [['user', 'expense_id']]
+
+    def __str__(self):
+        return f"expense {self.expense_id} -> transaction {self.transaction_id} (user {self.user_id})"
+
+
 class Budget(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='budgets')
     month = models.PositiveSmallIntegerField()  # 1-12
@@ -134,10 +222,39 @@ class SavingsGoal(models.Model):
     saved = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
     deadline = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # [[iso date, cumulative saved], ...], one point per day with contributions
+    progress = models.JSONField(default=list, blank=True)
+    projected_completion = models.DateField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'updated_at'])]
 
     def __str__(self):
         return f"{self.title} (${self.saved}/${self.target})"
 
+    def add_contribution(self, amount, day):
+        """Apply a contribution to saved, the progress series and the projection. Call with the row locked."""
+        self.saved += amount
+        point = [day.isoformat(), str(self.saved)]
+        if self.progress and self.progress[-1][0] == point[0]:
+            self.progress[-1] = point
+        else:
+            self.progress.append(point)
+        self.projected_completion = self.project_completion()
+
+    def project_completion(self):
+        """Date the target is (or was) reached at the average daily rate since the goal was created."""
+        if not self.progress or self.saved <= 0:
+            return None
+        for day, cumulative in self.progress:
+            if Decimal(cumulative) >= self.target:
+                return date.fromisoformat(day)
+        last_day = date.fromisoformat(self.progress[-1][0])
+        elapsed = max((last_day - self.created_at.date()).days + 1, 1)
+        daily_rate = self.saved / elapsed
+        return last_day + timedelta(days=math.ceil((self.target - self.saved) / daily_rate))
+
 class SavingsContribution(models.Model):
     goal = models.ForeignKey(SavingsGoal, on_delete=models.CASCADE, related_name='contributions')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -146,7 +263,8 @@ class SavingsContribution(models.Model):
     note = models.CharField(max_length=255, blank=True)
 
     def __str__(self):
-        return f"{self.user.username} contributed ${self.amount} to {self.goal.title} on {self.date}"
+        # Ids only, so listing contributions never loads their goal and user.
+        return f"${self.amount} to goal {self.goal_id} on {self.date} (user {self.user_id})"
     
 class PredictionLog(models.Model):
     PERIOD_CHOICES = [
@@ -174,6 +292,272 @@ class Notification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'updated_at'])]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.title[:30]}"
+
+
+class Tombstone(models.Model):
+    """A deleted synced row, kept so delta sync can tell clients to drop it (see expenses/sync.py)."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='tombstones')
+    kind = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'deleted_at'])]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} deleted (user {self.user_id})"
+
+
+class IdempotencyKey(models.Model):
+    """The first response to a POST sent with an Idempotency-Key header (see expenses/idempotency.py)."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    # Hash of the method, path and body the key was first used with.
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = [['user', 'key']]
+
+    def __str__(self):
+        return f"{self.key} (user {self.user_id})"
+
+
+class ShardAssignment(models.Model):
+    """Which database holds a user's rows. Lives on the default database only."""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='shard_assignment')
+    alias = models.CharField(max_length=50)
+    assigned_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id} -> {self.alias}"
+
+
+class ArchivedTransaction(models.Model):
+    """Transaction moved out of the hot table by `manage.py archive_history`."""
+    original_id = models.BigIntegerField(db_index=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='archived_transactions')
+    account = models.ForeignKey('Account', on_delete=models.CASCADE, related_name='archived_transactions')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    category = models.ForeignKey(Category, on_delete=models.RESTRICT, related_name='archived_transactions')
+    description = models.TextField(blank=True)
+    date = models.DateField()
+    type = models.CharField(max_length=10, choices=[('income', 'Income'), ('expense', 'Expense')])
+    title = models.CharField(max_length=255, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-date']
+        indexes = [models.Index(fields=['user', 'date'])]
+
+    def __str__(self):
+        return f"{self.date}: {self.type} - ${self.amount} (archived)"
+
+
+class MonthlySummary(models.Model):
+    """Monthly totals of archived transactions, kept for analytics and forecasting."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='monthly_summaries')
+    month = models.DateField()  # first day of the month
+    type = models.CharField(max_length=10, choices=[('income', 'Income'), ('expense', 'Expense')])
+    category = models.ForeignKey(Category, on_delete=models.RESTRICT, related_name='monthly_summaries')
+    total = models.DecimalField(max_digits=14, decimal_places=2)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('user', 'month', 'type', 'category')
+        ordering = ['-month']
+
+    def __str__(self):
+        return f"{self.user_id} {self.month:%Y-%m} {self.type}/{self.category_id}: ${self.total}"
+
+
+class RecurringPayment(models.Model):
+    """Subscription or recurring bill detected in a user's expense history."""
+    PERIOD_CHOICES = [
+        ('weekly', 'Weekly'),
+        ('monthly', 'Monthly'),
+        ('yearly', 'Yearly'),
+    ]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='recurring_payments')
+    title = models.CharField(max_length=255)
+    category = models.CharField(max_length=100, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES)
+    occurrences = models.PositiveIntegerField()
+    last_date = models.DateField()
+    next_date = models.DateField()
+    detected_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['next_date']
+        indexes = [models.Index(fields=['user', 'next_date'])]
+
+    def __str__(self):
+        return f"{self.title} - ${self.amount} {self.period}"
+
+
+class CategoryStats(models.Model):
+    """Running mean/variance (Welford) of a user's expense amounts in one category."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='category_stats')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='stats')
+    count = models.PositiveIntegerField(default=0)
+    mean = models.FloatField(default=0)
+    m2 = models.FloatField(default=0)  # sum of squared deviations from the mean
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'category')
+
+    def __str__(self):
+        return f"{self.user_id} {self.category_id}: n={self.count} mean={self.mean:.2f}"
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def add(self, amount):
+        self.count += 1
+        delta = amount - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (amount - self.mean)
+
+    def remove(self, amount):
+        """Undo add(amount)."""
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = amount - self.mean
+        self.count -= 1
+        self.mean -= delta / self.count
+        # Rounding can take it just below zero.
+        self.m2 = max(self.m2 - delta * (amount - self.mean), 0.0)
+
+
+class SpendingBucket(models.Model):
+    """Total expenses of a user in one week (starting Monday) or calendar month."""
+    PERIOD_CHOICES = PredictionLog.PERIOD_CHOICES
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='spending_buckets')
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES)
+    start = models.DateField()
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'period', 'start')
+        ordering = ['start']
+
+    def __str__(self):
+        return f"{self.user_id} {self.period} {self.start}: ${self.amount}"
+
+
+class ForecastStats(models.Model):
+    """
+    Sufficient statistics of a linear regression of bucket amount (y) on
+    bucket start in days since FORECAST_EPOCH (x), over a user's buckets.
+    Kept exact (integers and decimals) so they never drift.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='forecast_stats')
+    period = models.CharField(max_length=10, choices=PredictionLog.PERIOD_CHOICES)
+    n = models.PositiveIntegerField(default=0)
+    sum_x = models.BigIntegerField(default=0)
+    sum_y = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    sum_xy = models.DecimalField(max_digits=28, decimal_places=2, default=0)
+    sum_xx = models.BigIntegerField(default=0)
+    last_start = models.DateField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('user', 'period')
+
+    def __str__(self):
+        return f"{self.user_id} {self.period}: n={self.n}"
+
+    def add(self, x, y, sign=1):
+        self.n += sign
+        self.sum_x += sign * x
+        self.sum_y += sign * y
+        self.sum_xy += sign * x * y
+        self.sum_xx += sign * x * x
+
+
+class ForecastChoice(models.Model):
+    """The forecasting model that backtested best on a user's buckets (see expenses/forecasting.py)."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='forecast_choices')
+    period = models.CharField(max_length=10, choices=PredictionLog.PERIOD_CHOICES)
+    model = models.CharField(max_length=30)
+    # Smoothing level, for exponential smoothing.
+    smoothing = models.FloatField(null=True, blank=True)
+    # Mean absolute one-step error in the backtest, of this model and of the linear trend.
+    error = models.FloatField()
+    trend_error = models.FloatField(null=True, blank=True)
+    backtested_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'period')
+
+    def __str__(self):
+        return f"{self.user_id} {self.period}: {self.model}"
+
+
+class TopExpenses(models.Model):
+    """
+    The largest expenses of a user in one calendar month, as [cents, id]
+    pairs sorted largest first. Holds at most TOP_EXPENSES_SIZE entries;
+    fewer means it holds every expense of the month.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='top_expenses')
+    month = models.DateField()  # first day of the month
+    entries = models.JSONField(default=list)
+
+    class Meta:
+        unique_together = ('user', 'month')
+
+    def __str__(self):
+        return f"{self.user_id} {self.month:%Y-%m}: {len(self.entries)} expense(s)"
+
+
+class Job(models.Model):
+    """Background job run by `manage.py run_jobs`. Lives on the default database only."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    # Jobs with the same non-empty key are not queued twice.
+    key = models.CharField(max_length=200, blank=True)
+    priority = models.SmallIntegerField(default=0)  # higher runs first
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_at = models.DateTimeField(default=now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)  # seconds, last attempt
+    last_error = models.TextField(blank=True)
+    result = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)  # handler's return value
+
+    class Meta:
+        ordering = ['-priority', 'run_at']
+        indexes = [
+            models.Index(fields=['status', 'priority', 'run_at']),
+            models.Index(fields=['key', 'status']),
+        ]
 
     def __str__(self):
-        return f"{self.user.username} - {self.title[:30]}"        
+        return f"{self.name} #{self.pk} ({self.status})"
@@ -0,0 +1,44 @@
+"""
+Process-pool helpers for batch jobs that fan out over users.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import connections
+
+
+def _init_worker():
+    # Spawned workers start from scratch and need Django configured; forked
+    # ones already are, and open their own connections on first use.
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def pool_map(func, items, workers=None):
+    """
+    Yield func(item) for every item, across `workers` processes. `func` must
+    be a module-level function. With workers == 1 everything runs inline.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # Children must never share the parent's database sockets.
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        yield from pool.map(func, items)
@@ -0,0 +1,104 @@
+"""
+Account balance reconciliation.
+
+An account's balance should always equal its opening balance plus income
+minus expenses over all its transactions, hot and archived. Accounts are
+walked in primary-key ranges on each shard. Per range, one grouped
+aggregation per table gives the net of every account in it. Those nets are
+compared with the stored balances, and fixed with one bulk_update when
+asked. When fixing, the range's account rows are locked first. Writers
+move a balance in the same transaction as the row they write, so a row
+counted by the aggregation always has its effect in the balance being
+replaced.
+
+Accounts that predate opening balances have none, so there is nothing to
+check them against. They are reported with the net of their transactions
+until an operator adopts their current balances as correct (`--adopt`),
+which sets their opening balance to balance minus net.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Sum, When
+from django.utils import timezone
+
+from .models import Account, ArchivedTransaction, Transaction
+from .parallel import pool_map
+
+SIGNED_AMOUNT = Case(
+    When(type='expense', then=-F('amount')), default=F('amount'),
+    output_field=DecimalField(max_digits=14, decimal_places=2),
+)
+
+
+def account_ranges(alias, chunk_size):
+    """Yield (first, last) account pks of consecutive chunks on `alias`."""
+    pks = Account.objects.using(alias).order_by('pk').values_list('pk', flat=True)
+    first = last = None
+    count = 0
+    for pk in pks.iterator(chunk_size=chunk_size):
+        if first is None:
+            first = pk
+        last = pk
+        count += 1
+        if count == chunk_size:
+            yield first, last
+            first, count = None, 0
+    if first is not None:
+        yield first, last
+
+
+def net_amounts(alias, first, last):
+    """Income minus expenses per account for accounts first..last."""
+    net = {}
+    for model in (Transaction, ArchivedTransaction):
+        rows = (
+            model.objects.using(alias).filter(account_id__gte=first, account_id__lte=last)
+            .order_by().values('account_id').annotate(net=Sum(SIGNED_AMOUNT)).values_list('account_id', 'net')
+        )
+        for account_id, amount in rows:
+            net[account_id] = net.get(account_id, 0) + amount
+    return net
+
+
+def reconcile_chunk(args):
+    """
+    Pool task: check accounts first..last on `alias`. Returns (checked,
+    [(pk, user_id, stored, expected)], [(pk, user_id, stored, net)]), the
+    last for accounts without an opening balance.
+    """
+    alias, first, last, fix, adopt = args
+    with transaction.atomic(using=alias):
+        accounts = Account.objects.using(alias).filter(pk__gte=first, pk__lte=last).order_by('pk')
+        if fix or adopt:
+            accounts = accounts.select_for_update()
+        accounts = list(accounts.only('pk', 'user_id', 'balance', 'opening_balance'))
+        net = net_amounts(alias, first, last)
+        drifted, unanchored, fixed, adopted = [], [], [], []
+        now = timezone.now()
+        for account in accounts:
+            amount = net.get(account.pk, 0)
+            if account.opening_balance is None:
+                unanchored.append((account.pk, account.user_id, account.balance, amount))
+                account.opening_balance = account.balance - amount
+                adopted.append(account)
+                continue
+            expected = account.opening_balance + amount
+            if account.balance != expected:
+                drifted.append((account.pk, account.user_id, account.balance, expected))
+                account.balance = expected
+                account.updated_at = now
+                fixed.append(account)
+        if fix and fixed:
+            Account.objects.using(alias).bulk_update(fixed, ['balance', 'updated_at'], batch_size=1000)
+        if adopt and adopted:
+            Account.objects.using(alias).bulk_update(adopted, ['opening_balance'], batch_size=1000)
+    return len(accounts), drifted, unanchored
+
+
+def reconcile_balances(fix=False, chunk_size=1000, workers=None, adopt=False):
+    """Yield (alias, checked, drifted, unanchored) per chunk of accounts on every shard."""
+    for alias in settings.DATABASE_SHARDS:
+        # Ranges are collected before the pool starts so no connection is open when it forks.
+        tasks = [(alias, first, last, fix, adopt) for first, last in account_ranges(alias, chunk_size)]
+        for checked, drifted, unanchored in pool_map(reconcile_chunk, tasks, workers):
+            yield alias, checked, drifted, unanchored
@@ -0,0 +1,139 @@
+"""
+Vectorized detection of recurring payments (subscriptions and bills).
+
+A user's expense history is loaded once into NumPy arrays and grouped by
+normalized title and amount band. The gaps between consecutive payments
+of every group are then tested against weekly, monthly and yearly periods
+with a handful of array operations, whatever the length of the history.
+"""
+import re
+from datetime import date, timedelta
+from decimal import Decimal
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from django.db import router, transaction
+from django.utils.timezone import now
+
+from tracker.routers import user_context
+from .models import RecurringPayment
+from .spending import spending
+
+# period -> (expected gap in days, tolerance in days, minimum payments)
+PERIODS = {
+    'weekly': (7, 1, 4),
+    'monthly': (30.44, 3.5, 3),
+    'yearly': (365.25, 7, 2),
+}
+NEXT_PAYMENT = {
+    'weekly': timedelta(days=7),
+    'monthly': relativedelta(months=1),
+    'yearly': relativedelta(years=1),
+}
+# Share of a group's gaps that must match the period.
+MIN_HIT_RATIO = 0.8
+# Width of an amount band, centred on the title's mean amount: payments
+# within about +-7% of it are treated as the same series.
+AMOUNT_BAND = np.log(1.15)
+
+_NOISE = re.compile(r'[^a-z ]+')
+
+
+def normalize_title(title):
+    """Lower-case and strip digits and punctuation, e.g. 'NETFLIX.COM #1234' -> 'netflix com'."""
+    return ' '.join(_NOISE.sub(' ', title.lower()).split())
+
+
+def load_history(user):
+    """Return (raw titles, categories, title codes, cents, date ordinals) for the user's expenses."""
+    rows = list(spending(user).order_by().values_list('title', 'description', 'category__name', 'amount', 'date'))
+    titles = [title or description or category for title, description, category, _, _ in rows]
+    categories = [row[2] for row in rows]
+    codes = np.unique(np.array([normalize_title(t) for t in titles], dtype=str), return_inverse=True)[1]
+    cents = np.fromiter((int(row[3] * 100) for row in rows), dtype=np.int64, count=len(rows))
+    days = np.fromiter((row[4].toordinal() for row in rows), dtype=np.int32, count=len(rows))
+    return titles, categories, codes.astype(np.int64), cents, days
+
+
+def detect(codes, cents, days, today):
+    """
+    Find periodic series. Returns dicts with the index of the latest payment
+    of the series ('index'), its period, occurrences, mean amount in cents
+    and the ordinal of that payment.
+    """
+    if len(cents) < 2:
+        return []
+    log_cents = np.log(np.maximum(cents, 1))
+    title_mean = np.bincount(codes, weights=log_cents) / np.maximum(np.bincount(codes), 1)
+    band = np.round((log_cents - title_mean[codes]) / AMOUNT_BAND).astype(np.int64)
+    order = np.lexsort((days, band, codes))
+    codes, band, days, cents = codes[order], band[order], days[order].astype(np.int64), cents[order]
+
+    starts = np.r_[True, (codes[1:] != codes[:-1]) | (band[1:] != band[:-1])]
+    group = np.cumsum(starts) - 1
+    n_groups = group[-1] + 1
+    sizes = np.bincount(group, minlength=n_groups)
+    first = np.flatnonzero(starts)
+    latest = np.r_[first[1:] - 1, len(days) - 1]
+    last = days[latest]
+    mean_cents = np.bincount(group, weights=cents, minlength=n_groups) / sizes
+
+    # Gaps inside each group; same-day duplicates are not a period.
+    gaps = np.diff(days).astype(np.float64)
+    inside = ~starts[1:] & (gaps > 0)
+    gap_group = group[1:][inside]
+    gaps = gaps[inside]
+    gap_count = np.bincount(gap_group, minlength=n_groups)
+
+    names = list(PERIODS)
+    best = np.full(n_groups, -1)
+    best_ratio = np.zeros(n_groups)
+    for i, name in enumerate(names):
+        expected, tolerance, minimum = PERIODS[name]
+        hits = np.bincount(gap_group, weights=np.abs(gaps - expected) <= tolerance, minlength=n_groups)
+        ratio = np.divide(hits, gap_count, out=np.zeros(n_groups), where=gap_count > 0)
+        matches = (
+            (ratio >= MIN_HIT_RATIO)
+            & (gap_count + 1 >= minimum)
+            & (today - last <= 2 * expected)  # still being paid
+            & (ratio > best_ratio)
+        )
+        best[matches] = i
+        best_ratio[matches] = ratio[matches]
+
+    return [{
+        'index': int(order[latest[g]]),
+        'period': names[best[g]],
+        'occurrences': int(gap_count[g] + 1),
+        'cents': int(round(mean_cents[g])),
+        'last': int(last[g]),
+    } for g in np.flatnonzero(best >= 0)]
+
+
+def refresh_user(user_id):
+    """Re-detect and store the recurring payments of one user. Returns how many were found."""
+    with user_context(user_id):
+        titles, categories, codes, cents, days = load_history(user_id)
+        found = detect(codes, cents, days, now().date().toordinal())
+        payments = []
+        for series in found:
+            last_date = date.fromordinal(series['last'])
+            payments.append(RecurringPayment(
+                user_id=user_id,
+                title=titles[series['index']][:255],
+                category=categories[series['index']],
+                amount=Decimal(series['cents']) / 100,
+                period=series['period'],
+                occurrences=series['occurrences'],
+                last_date=last_date,
+                next_date=last_date + NEXT_PAYMENT[series['period']],
+            ))
+        with transaction.atomic(using=router.db_for_write(RecurringPayment)):
+            RecurringPayment.objects.filter(user_id=user_id).delete()
+            RecurringPayment.objects.bulk_create(payments)
+    return len(payments)
+
+
+def refresh_users(user_ids):
+    """Pool task: refresh a chunk of users. Returns (users, series found)."""
+    return len(user_ids), sum(refresh_user(user_id) for user_id in user_ids)
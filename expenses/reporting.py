@@ -0,0 +1,150 @@
+"""
+Platform-wide operator reports.
+
+Users are walked in primary-key ranges. Each range is aggregated in the
+database on every shard (pool_map spreads ranges over processes) into a
+small partial result, and the partials are merged as they arrive, so
+memory stays bounded by the number of distinct categories, not by rows.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .ml_utils import PERIOD_DAYS, period_start
+from .models import MonthlySummary, PredictionLog, SpendingBucket, Transaction
+from .parallel import pool_map
+
+
+def user_ranges(chunk_size):
+    """Yield (first, last) user pks of consecutive chunks, streaming the key index."""
+    pks = get_user_model().objects.using('default').order_by('pk').values_list('pk', flat=True)
+    first = last = None
+    count = 0
+    for pk in pks.iterator(chunk_size=chunk_size):
+        if first is None:
+            first = pk
+        last = pk
+        count += 1
+        if count == chunk_size:
+            yield first, last
+            first, count = None, 0
+    if first is not None:
+        yield first, last
+
+
+def _target_bucket(log):
+    # Monthly predictions target "last month + 30 days", which can land on
+    # the 31st of the last month or a few days into the next; a few days'
+    # slack maps both to the month being predicted.
+    if log['period_type'] == 'monthly':
+        return period_start(log['target_period_start'] + timedelta(days=3), 'monthly')
+    return period_start(log['target_period_start'], 'weekly')
+
+
+def _empty():
+    return {
+        'users': 0,
+        'active_users': 0,
+        'volume': defaultdict(lambda: [0, 0]),  # (type, category) -> [total, count]
+        # period -> [predictions, sum of |error|, sum of |error| / actual, predictions with an actual]
+        'accuracy': {},
+        'pending_predictions': 0,
+    }
+
+
+def report_chunk(args):
+    """Pool task: partial report for users first..last on every shard."""
+    first, last, active_since, today = args
+    part = _empty()
+    for alias in settings.DATABASE_SHARDS:
+        in_range = {'user_id__gte': first, 'user_id__lte': last}
+        transactions = Transaction.objects.using(alias).filter(**in_range).order_by()
+        part['active_users'] += transactions.filter(date__gte=active_since).values('user_id').distinct().count()
+
+        for row in transactions.values('type', 'category__name').annotate(total=Sum('amount'), count=Count('id')):
+            volume = part['volume'][row['type'], row['category__name']]
+            volume[0] += row['total']
+            volume[1] += row['count']
+        summaries = MonthlySummary.objects.using(alias).filter(**in_range).order_by()
+        for row in summaries.values('type', 'category__name').annotate(total=Sum('total'), count=Sum('count')):
+            volume = part['volume'][row['type'], row['category__name']]
+            volume[0] += row['total']
+            volume[1] += row['count']
+
+        logs = list(
+            PredictionLog.objects.using(alias).filter(**in_range)
+            .values('user_id', 'period_type', 'predicted_amount', 'actual_amount', 'target_period_start')
+        )
+        targets = {_target_bucket(log) for log in logs}
+        buckets = {
+            (user_id, period, start): amount
+            for user_id, period, start, amount in SpendingBucket.objects.using(alias)
+            .filter(start__in=targets, **in_range).values_list('user_id', 'period', 'start', 'amount')
+        } if logs else {}
+        for log in logs:
+            start = _target_bucket(log)
+            if start + timedelta(days=PERIOD_DAYS[log['period_type']]) > today:
+                part['pending_predictions'] += 1
+                continue
+            actual = log['actual_amount']
+            if actual is None:
+                actual = buckets.get((log['user_id'], log['period_type'], start), 0)
+            error = abs(float(log['predicted_amount']) - float(actual))
+            accuracy = part['accuracy'].setdefault(log['period_type'], [0, 0.0, 0.0, 0])
+            accuracy[0] += 1
+            accuracy[1] += error
+            if actual:
+                accuracy[2] += error / float(actual)
+                accuracy[3] += 1
+
+    part['users'] = get_user_model().objects.using('default').filter(pk__gte=first, pk__lte=last).count()
+    part['volume'] = dict(part['volume'])
+    return part
+
+
+def merge(total, part):
+    total['users'] += part['users']
+    total['active_users'] += part['active_users']
+    total['pending_predictions'] += part['pending_predictions']
+    for key, (amount, count) in part['volume'].items():
+        volume = total['volume'][key]
+        volume[0] += amount
+        volume[1] += count
+    for period, values in part['accuracy'].items():
+        accuracy = total['accuracy'].setdefault(period, [0, 0.0, 0.0, 0])
+        for i, value in enumerate(values):
+            accuracy[i] += value
+    return total
+
+
+def build_report(active_days=30, chunk_size=1000, workers=None):
+    today = timezone.localdate()
+    total = _empty()
+    # Ranges are collected before the pool starts so no connection is open when it forks.
+    tasks = [(first, last, today - timedelta(days=active_days), today) for first, last in user_ranges(chunk_size)]
+    for part in pool_map(report_chunk, tasks, workers):
+        merge(total, part)
+
+    return {
+        'generated_at': timezone.now().isoformat(),
+        'users': total['users'],
+        'active_users': total['active_users'],
+        'active_days': active_days,
+        'volume': sorted((
+            {'type': type_, 'category': category, 'total': float(amount), 'count': count}
+            for (type_, category), (amount, count) in total['volume'].items()
+        ), key=lambda row: -row['total']),
+        'forecast_accuracy': {
+            period: {
+                'predictions': n,
+                'mean_absolute_error': round(abs_error / n, 2),
+                'mean_absolute_percentage_error': round(100 * pct_error / pct_n, 2) if pct_n else None,
+            }
+            for period, (n, abs_error, pct_error, pct_n) in total['accuracy'].items()
+        },
+        'pending_predictions': total['pending_predictions'],
+    }
@@ -1,8 +1,13 @@
 from rest_framework import serializers
-from .models import Expense, User, Account, Transaction, Budget, SavingsGoal, SavingsContribution, PredictionLog, Notification
+from .models import Expense, User, Account, Category, Transaction, Budget, SavingsGoal, SavingsContribution, PredictionLog, Notification, ArchivedTransaction, RecurringPayment
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
+from django.utils import timezone
+from .accounts import account_ids
+from .avatars import thumbnail_urls
+from .categorizer import DEFAULT_CATEGORY, predict_categories
+from .spending import GRANULARITIES, period_starts
 
 User = get_user_model()
 
@@ -14,13 +19,15 @@ class UserSerializer(serializers.ModelSerializer):
         validators=[validate_password]
     )
     password2 = serializers.CharField(write_only=True, required=True)
+    # {size in px: URL}; filled in shortly after a picture is uploaded
+    profile_thumbnails = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ('username', 'email', 'password', 'password2', 'profile_picture')
+        fields = ('username', 'email', 'password', 'password2', 'profile_picture', 'profile_thumbnails')
 
     def validate(self, attrs):
-        if attrs['password'] != attrs['password2']:
+        if attrs.get('password') != attrs.get('password2'):
             raise serializers.ValidationError({"password": "Password fields didn't match."})
         return attrs
 
@@ -33,7 +40,86 @@ class UserSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
-class ExpenseSerializer(serializers.ModelSerializer):
+    def get_profile_thumbnails(self, obj):
+        request = self.context.get('request')
+        urls = thumbnail_urls(obj)
+        return {size: request.build_absolute_uri(url) for size, url in urls.items()} if request else urls
+
+    def update(self, instance, validated_data):
+        validated_data.pop('password2', None)
+        password = validated_data.pop('password', None)
+        if password:
+            instance.set_password(password)
+        return super().update(instance, validated_data)
+
+class CategoryNameField(serializers.CharField):
+    """A Category, read and written by name."""
+    def to_representation(self, value):
+        return value.name
+
+class UserAccountField(serializers.PrimaryKeyRelatedField):
+    """
+    One of the requesting user's accounts, by id. Checked against the cached
+    ids of their accounts, looked up once per request (and again from the
+    database for an id they lack), so the account itself is never loaded:
+    the id is written to `account_id` and the account is read only if used.
+    """
+    def get_queryset(self):
+        return Account.objects.filter(user=self.context['request'].user)
+
+    def to_internal_value(self, data):
+        request = self.context['request']
+        ids, fresh = getattr(request, '_account_ids', (None, False))
+        if ids is None:
+            ids = account_ids(request.user.pk)
+        try:
+            if isinstance(data, bool):
+                raise TypeError
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in ids and not fresh:
+            # Perhaps added since the ids were cached.
+            ids, fresh = account_ids(request.user.pk, refresh=True), True
+        request._account_ids = ids, fresh
+        if pk not in ids:
+            self.fail('does_not_exist', pk_value=data)
+        return pk
+
+class AutoCategoryMixin:
+    """
+    Read and write the category by name, creating the user's category on
+    first use. Clients may omit it to have the auto-categorizer fill it in
+    (left to the caller with the `defer_category` context flag).
+    """
+    def get_fields(self):
+        fields = super().get_fields()
+        fields['category'] = CategoryNameField(max_length=100, required=False, allow_blank=True)
+        fields['account'] = UserAccountField(source='account_id')
+        return fields
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if self.context.get('defer_category'):
+            return attrs
+        if not attrs.get('category') and (self.instance is None or 'category' in attrs):
+            row = [attrs.get(name, getattr(self.instance, name, None)) for name in ('title', 'description', 'amount', 'type')]
+            attrs['category'] = predict_categories([row])[0] or DEFAULT_CATEGORY
+        return attrs
+
+    def create(self, validated_data):
+        validated_data['category'] = self._category(validated_data['user'].pk, validated_data['category'])
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        if 'category' in validated_data:
+            validated_data['category'] = self._category(instance.user_id, validated_data['category'])
+        return super().update(instance, validated_data)
+
+    def _category(self, user_id, name):
+        return Category.objects.get_or_create(user_id=user_id, name=name)[0]
+
+class ExpenseSerializer(AutoCategoryMixin, serializers.ModelSerializer):
     class Meta:
         model = Expense
         fields = ['id', 'account', 'amount', 'category', 'description', 'date']
@@ -44,12 +130,43 @@ class AccountSerializer(serializers.ModelSerializer):
         model = Account
         fields = ['id', 'bank_name', 'account_number', 'balance']
 
-class TransactionSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+        # Setting the balance by hand moves the opening balance with it, so
+        # reconciliation treats the new figure as correct.
+        if 'balance' in validated_data and instance.opening_balance is not None:
+            instance.opening_balance += validated_data['balance'] - instance.balance
+        return super().update(instance, validated_data)
+
+class TransactionSerializer(AutoCategoryMixin, serializers.ModelSerializer):
     class Meta:
         model = Transaction
         fields = ['id', 'account', 'amount', 'category', 'title', 'description', 'date', 'type']
         read_only_fields = ['user']
 
+class ArchivedExpenseSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='original_id', read_only=True)
+    category = serializers.CharField(source='category.name', read_only=True)
+    archived = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ArchivedTransaction
+        fields = ['id', 'account', 'amount', 'category', 'description', 'date', 'archived']
+
+    def get_archived(self, obj):
+        return True
+
+class ArchivedTransactionSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='original_id', read_only=True)
+    category = serializers.CharField(source='category.name', read_only=True)
+    archived = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ArchivedTransaction
+        fields = ['id', 'account', 'amount', 'category', 'title', 'description', 'date', 'type', 'archived']
+
+    def get_archived(self, obj):
+        return True
+
 class BudgetSerializer(serializers.ModelSerializer):
     class Meta:
         model = Budget
@@ -60,7 +177,8 @@ class SavingsGoalSerializer(serializers.ModelSerializer):
     class Meta:
         model = SavingsGoal
         fields = '__all__'
-        read_only_fields = ['user', 'created_at']
+        # saved only changes through contributions (SavingsContributionCreateView)
+        read_only_fields = ['user', 'created_at', 'saved', 'progress', 'projected_completion']
 
 class SavingsContributionSerializer(serializers.ModelSerializer):
     class Meta:
@@ -68,6 +186,16 @@ class SavingsContributionSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ['user', 'date']
 
+    def validate_goal(self, goal):
+        if goal.user_id != self.context['request'].user.id:
+            raise serializers.ValidationError('Invalid goal.')
+        return goal
+
+    def validate_amount(self, amount):
+        if amount <= 0:
+            raise serializers.ValidationError('Amount must be positive.')
+        return amount
+
 class PredictionLogSerializer(serializers.ModelSerializer):
     class Meta:
         model = PredictionLog
@@ -76,4 +204,29 @@ class PredictionLogSerializer(serializers.ModelSerializer):
 class NotificationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Notification
-        fields = ['id', 'title', 'message', 'created_at', 'is_read', 'is_active']
\ No newline at end of file
+        fields = ['id', 'title', 'message', 'created_at', 'is_read', 'is_active']
+
+class RecurringPaymentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RecurringPayment
+        fields = ['id', 'title', 'category', 'amount', 'period', 'occurrences', 'last_date', 'next_date', 'detected_at']
+
+class SpendingSeriesQuerySerializer(serializers.Serializer):
+    MAX_PERIODS = 1000
+
+    start = serializers.DateField()
+    end = serializers.DateField(required=False)
+    granularity = serializers.ChoiceField(choices=list(GRANULARITIES), default='month')
+    group_by = serializers.ChoiceField(choices=['category', 'account', 'type'], required=False)
+    type = serializers.ChoiceField(choices=['expense', 'income', 'all'], default='expense')
+    compare = serializers.ChoiceField(choices=['previous_period', 'previous_year'], required=False)
+
+    def validate(self, attrs):
+        attrs.setdefault('end', timezone.localdate())
+        if attrs['start'] > attrs['end']:
+            raise serializers.ValidationError({'start': 'Must not be after end.'})
+        if len(period_starts(attrs['start'], attrs['end'], attrs['granularity'])) > self.MAX_PERIODS:
+            raise serializers.ValidationError(
+                {'granularity': f'Too many periods in range; at most {self.MAX_PERIODS} are allowed.'}
+            )
+        return attrs
@@ -0,0 +1,127 @@
+"""
+Placement and movement of users across DATABASE_SHARDS.
+
+New users are placed on their rendezvous-hash home shard when they
+register. Users that existed before sharding was enabled stay on default
+until `manage.py rebalance_shards` moves them.
+"""
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+from tracker.routers import SHARD_KEY, home_shard, is_sharded, shard_for_user, sharding_enabled
+from .accounts import forget_accounts
+from .models import ShardAssignment
+from .snapshot import invalidate
+from .top_expenses import rebuild_top_expenses
+
+
+def sharded_models():
+    """Sharded models ordered so that each one follows the models it references."""
+    pending = [
+        model for model in apps.get_app_config('expenses').get_models()
+        if is_sharded(model) and not model._meta.proxy
+    ]
+    ordered = []
+    while pending:
+        for model in pending:
+            deps = {
+                field.related_model for field in model._meta.concrete_fields
+                if field.is_relation and field.related_model is not model and is_sharded(field.related_model)
+            }
+            if deps <= set(ordered):
+                ordered.append(model)
+                pending.remove(model)
+                break
+        else:
+            raise ImproperlyConfigured('Sharded models have circular foreign keys.')
+    return ordered
+
+
+def ensure_user_on_shard(user, alias):
+    """Create the stub user row that foreign keys on the shard point to."""
+    if alias != 'default':
+        get_user_model().objects.using(alias).update_or_create(
+            pk=user.pk, defaults={'username': user.username, 'password': '!'}
+        )
+
+
+def place_user(user, alias=None):
+    alias = alias or home_shard(user.pk)
+    ensure_user_on_shard(user, alias)
+    ShardAssignment.objects.using('default').update_or_create(user_id=user.pk, defaults={'alias': alias})
+    cache.delete(SHARD_KEY.format(user.pk))
+    return alias
+
+
+def move_user(user, target, batch_size=500):
+    """
+    Copy all of a user's rows to `target`, repoint the directory and delete
+    the originals. Primary keys are reassigned on the target, so clients
+    should resync the moved user's data.
+    """
+    source = shard_for_user(user.pk)
+    if source == target:
+        return {}
+
+    moved = {}
+    ensure_user_on_shard(user, target)
+    with transaction.atomic(using=target), transaction.atomic(using=source):
+        id_maps = {}
+        models = sharded_models()
+        for model in models:
+            rows = list(model.objects.using(source).filter(user_id=user.pk).order_by('pk'))
+            fk_fields = [f for f in model._meta.concrete_fields if f.is_relation and f.related_model in id_maps]
+            auto_fields = [
+                f.name for f in model._meta.concrete_fields
+                if getattr(f, 'auto_now', False) or getattr(f, 'auto_now_add', False)
+            ]
+            old_pks = [row.pk for row in rows]
+            originals = [[getattr(row, name) for name in auto_fields] for row in rows]
+            for row in rows:
+                row.pk = None
+                row._state.adding = True
+                for field in fk_fields:
+                    old_id = getattr(row, field.attname)
+                    setattr(row, field.attname, id_maps[field.related_model].get(old_id))
+            model.objects.using(target).bulk_create(rows, batch_size=batch_size)
+
+            # bulk_create stamps auto_now fields with the current time; keep the originals.
+            if auto_fields and rows:
+                for row, values in zip(rows, originals):
+                    for name, value in zip(auto_fields, values):
+                        setattr(row, name, value)
+                model.objects.using(target).bulk_update(rows, auto_fields, batch_size=batch_size)
+
+            id_maps[model] = dict(zip(old_pks, (row.pk for row in rows)))
+            moved[model._meta.label] = len(rows)
+
+        # Raw deletes: the rows were moved, so delete receivers must not
+        # adjust anything derived from them.
+        for model in reversed(models):
+            model.objects.using(source).filter(user_id=user.pk)._raw_delete(source)
+        if source != 'default':
+            get_user_model().objects.using(source).filter(pk=user.pk).delete()
+        place_user(user, target)
+        # The copied top lists hold the source's row ids.
+        rebuild_top_expenses(target, [user.pk])
+    # Row ids changed on the target.
+    invalidate([user.pk])
+    forget_accounts(user.pk)
+    return moved
+
+
+def _user_saved(sender, instance, created, using, **kwargs):
+    if created and using == 'default' and sharding_enabled():
+        place_user(instance)
+
+
+def _user_deleting(sender, instance, using, **kwargs):
+    # Deleting the stub cascades to the user's rows on their shard.
+    if using == 'default' and sharding_enabled():
+        alias = shard_for_user(instance.pk)
+        if alias != 'default':
+            get_user_model().objects.using(alias).filter(pk=instance.pk).delete()
+        cache.delete(SHARD_KEY.format(instance.pk))
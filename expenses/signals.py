@@ -0,0 +1,61 @@
+"""
+Receivers that keep derived spending data current as transactions change.
+
+Bulk writes (bulk_create, update(), raw deletes) bypass these receivers;
+code that uses them must call the same functions itself.
+"""
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .anomalies import observe_expense, rebuild_stats, record_stats_change
+from .ml_utils import rebuild_forecast_stats, record_spending_change
+from .models import Account
+from .snapshot import invalidate, record_delete, record_save
+from .sync import _deleted_from
+from .top_expenses import rebuild_top_expenses, record_top_change
+
+
+def _spending(state):
+    # Buckets and top lists do not depend on the category.
+    return state and state[:3]
+
+
+def transaction_saved(sender, instance, created, raw=False, using=None, **kwargs):
+    if raw:
+        return
+    if created and instance.type == 'expense':
+        observe_expense(instance)
+
+    old = None if created else getattr(instance, '_loaded_spending', None)
+    new = instance.spending_state()
+    if not created:
+        record_stats_change(old, new, using)
+    if _spending(old) != _spending(new):
+        record_spending_change(old, new, using)
+        record_top_change(instance.pk, old, new, using)
+    instance._loaded_spending = new
+    record_save(instance, using)
+
+
+def transaction_deleted(sender, instance, using, origin=None, **kwargs):
+    # Everything derived from a deleted user's transactions goes with them.
+    # Deleting an account rebuilds it once afterwards rather than row by row
+    # (account_deleted).
+    if issubclass(_deleted_from(origin), (get_user_model(), Account)):
+        return
+    state = getattr(instance, '_loaded_spending', None) or instance.spending_state()
+    if state is not None:
+        record_spending_change(state, None, using)
+        record_top_change(instance.pk, state, None, using)
+        record_stats_change(state, None, using)
+    record_delete(instance, using)
+
+
+def account_deleted(sender, instance, using, origin=None, **kwargs):
+    if issubclass(_deleted_from(origin), get_user_model()):
+        return
+    # Runs in the delete's transaction, after the account's transactions are gone.
+    rebuild_forecast_stats(instance.user_id, using)
+    rebuild_stats(using, [instance.user_id])
+    rebuild_top_expenses(using, [instance.user_id])
+    transaction.on_commit(lambda: invalidate([instance.user_id]), using=using)
@@ -0,0 +1,238 @@
+"""
+Per-user columnar snapshots of transaction history.
+
+A snapshot holds a user's transactions as NumPy arrays (ids, amounts in
+integer cents, date ordinals, category and account ids and an expense
+flag) sorted by date, plus the monthly summaries of archived rows. Analytics and forecasting run
+vectorized over it instead of materializing model instances.
+
+Each worker keeps snapshots in an LRU cache bounded by
+SNAPSHOT_CACHE_BYTES. They are built on first use. Writes patch the
+writing worker's copy once they commit, and bump a per-user version in
+the shared cache. Any other worker sees the version change and rebuilds
+its copy. Bulk writes that skip the save and delete receivers must call
+invalidate().
+
+Without a shared cache a version bump never leaves the writing worker, so
+snapshots are instead rebuilt once they are SNAPSHOT_LOCAL_SECONDS old.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import BigIntegerField, F
+from django.db.models.functions import Cast, Round
+
+from tracker.checks import cache_is_shared
+from tracker.routers import shard_for_user
+from .models import MonthlySummary, Transaction
+
+VERSION_KEY = 'snapshot:{}'
+# Per transaction, sorted by date.
+COLUMNS = ('ids', 'cents', 'days', 'categories', 'accounts', 'expense')
+# Per archived (month, type, category) summary.
+ARCHIVE_COLUMNS = ('archived_months', 'archived_cents', 'archived_categories', 'archived_expense')
+
+
+class Snapshot:
+    __slots__ = ('version', 'built') + COLUMNS + ARCHIVE_COLUMNS
+
+    def __init__(self, version, built=None, **columns):
+        self.version = version
+        self.built = time.monotonic() if built is None else built
+        for name in COLUMNS + ARCHIVE_COLUMNS:
+            setattr(self, name, columns[name])
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in COLUMNS + ARCHIVE_COLUMNS)
+
+    def rows(self, start=None, end=None):
+        """Slice of the transactions with start <= date <= end."""
+        lo = 0 if start is None else np.searchsorted(self.days, start.toordinal(), 'left')
+        hi = len(self.days) if end is None else np.searchsorted(self.days, end.toordinal(), 'right')
+        return slice(lo, hi)
+
+    def expenses(self, start=None, end=None):
+        """Indexes of expenses with start <= date <= end, in date order."""
+        rows = self.rows(start, end)
+        return rows.start + np.flatnonzero(self.expense[rows])
+
+    def _replace(self, **columns):
+        columns = {name: columns.get(name, getattr(self, name)) for name in COLUMNS + ARCHIVE_COLUMNS}
+        return Snapshot(self.version, self.built, **columns)
+
+    def without(self, pk):
+        keep = self.ids != pk
+        return self._replace(**{name: getattr(self, name)[keep] for name in COLUMNS})
+
+    def with_row(self, pk, cents, day, category, account, expense):
+        at = np.searchsorted(self.days, day, 'right')
+        values = dict(zip(COLUMNS, (pk, cents, day, category, account, expense)))
+        return self._replace(**{name: np.insert(getattr(self, name), at, values[name]) for name in COLUMNS})
+
+
+def _column(values, dtype):
+    values = list(values)
+    return np.fromiter(values, dtype=dtype, count=len(values))
+
+
+def build(user_id, version):
+    alias = shard_for_user(user_id)
+    if alias == 'default':
+        # No dedicated shard, so the replica can serve it on a listed route.
+        alias = router.db_for_read(Transaction)
+    rows = list(
+        Transaction.objects.using(alias).filter(user_id=user_id)
+        .annotate(cents=Cast(Round(F('amount') * 100), BigIntegerField()))
+        .order_by('date', 'pk').values_list('pk', 'cents', 'date', 'category_id', 'account_id', 'type')
+    )
+    summaries = list(
+        MonthlySummary.objects.using(alias).filter(user_id=user_id)
+        .order_by('month').values_list('month', 'total', 'category_id', 'type')
+    )
+    return Snapshot(
+        version,
+        ids=_column((row[0] for row in rows), np.int64),
+        cents=_column((row[1] for row in rows), np.int64),
+        days=_column((row[2].toordinal() for row in rows), np.int64),
+        categories=_column((row[3] for row in rows), np.int64),
+        accounts=_column((row[4] for row in rows), np.int64),
+        expense=_column((row[5] == 'expense' for row in rows), bool),
+        archived_months=_column((row[0].toordinal() for row in summaries), np.int64),
+        archived_cents=_column((round(row[1] * 100) for row in summaries), np.int64),
+        archived_categories=_column((row[2] for row in summaries), np.int64),
+        archived_expense=_column((row[3] == 'expense' for row in summaries), bool),
+    )
+
+
+class SnapshotCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, user_id):
+        with self._lock:
+            snapshot = self._entries.get(user_id)
+            if snapshot is not None:
+                self._entries.move_to_end(user_id)
+            return snapshot
+
+    def put(self, user_id, snapshot):
+        with self._lock:
+            self._pop(user_id)
+            self._entries[user_id] = snapshot
+            self._bytes += snapshot.nbytes
+            while self._bytes > settings.SNAPSHOT_CACHE_BYTES and len(self._entries) > 1:
+                self._pop(next(iter(self._entries)))
+
+    def discard(self, user_id):
+        with self._lock:
+            self._pop(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _pop(self, user_id):
+        snapshot = self._entries.pop(user_id, None)
+        if snapshot is not None:
+            self._bytes -= snapshot.nbytes
+
+
+snapshots = SnapshotCache()
+
+
+def _fresh_version():
+    # A random base keeps a counter that fell out of the cache from
+    # restarting at a value some worker's snapshot already has.
+    return random.getrandbits(62)
+
+
+def shared_version(user_id):
+    key = VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _fresh_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def _expired(snapshot):
+    # Patches keep the build time: they cover this worker's writes, not the others'.
+    return not cache_is_shared() and time.monotonic() - snapshot.built > settings.SNAPSHOT_LOCAL_SECONDS
+
+
+def get_snapshot(user):
+    """The user's snapshot, built if this worker has none or another worker has written since."""
+    user_id = getattr(user, 'pk', user)
+    version = shared_version(user_id)
+    snapshot = snapshots.get(user_id)
+    if snapshot is None or snapshot.version != version or _expired(snapshot):
+        snapshot = build(user_id, version)
+        snapshots.put(user_id, snapshot)
+    return snapshot
+
+
+def _bump(user_id):
+    key = VERSION_KEY.format(user_id)
+    cache.add(key, _fresh_version(), None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return None
+
+
+def _patch(user_id, pk, row):
+    version = _bump(user_id)
+    snapshot = snapshots.get(user_id)
+    if snapshot is None:
+        return
+    # Only patch if no other write happened in between; otherwise rebuild on next use.
+    if version is None or snapshot.version != version - 1:
+        snapshots.discard(user_id)
+        return
+    snapshot = snapshot.without(pk)
+    if row is not None:
+        snapshot = snapshot.with_row(pk, *row)
+    snapshot.version = version
+    snapshots.put(user_id, snapshot)
+
+
+def record_save(instance, using):
+    fields = instance.__dict__
+    if all(name in fields for name in ('amount', 'date', 'category_id', 'account_id', 'type')):
+        day = fields['date']
+        if isinstance(day, datetime):
+            day = day.date()
+        row = (
+            round(Decimal(str(fields['amount'])) * 100),
+            day.toordinal(),
+            fields['category_id'],
+            fields['account_id'],
+            fields['type'] == 'expense',
+        )
+        transaction.on_commit(lambda: _patch(instance.user_id, instance.pk, row), using=using)
+    else:
+        transaction.on_commit(lambda: invalidate([instance.user_id]), using=using)
+
+
+def record_delete(instance, using):
+    pk = instance.pk
+    transaction.on_commit(lambda: _patch(instance.user_id, pk, None), using=using)
+
+
+def invalidate(user_ids):
+    """Make every worker rebuild these users' snapshots."""
+    for user_id in user_ids:
+        _bump(user_id)
+        snapshots.discard(user_id)
@@ -0,0 +1,184 @@
+"""
+Spending query layer.
+
+All spending lives in Transaction rows with type='expense' (Expense is a
+proxy over them). Analytics and forecasting read spending only through
+these helpers. Aggregates are computed with NumPy over the user's
+columnar snapshot (see snapshot.py), which also carries the monthly
+summaries left behind by archival; spending() is the queryset for the
+few callers that need whole rows.
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+from .models import Category, Transaction
+from .snapshot import get_snapshot
+
+# np.datetime64 day 0 as a date ordinal.
+UNIX_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def spending(user, start=None, end=None):
+    """Expense transactions of `user`, optionally limited to start <= date <= end."""
+    queryset = Transaction.objects.filter(user=user, type='expense')
+    if start is not None:
+        queryset = queryset.filter(date__gte=start)
+    if end is not None:
+        queryset = queryset.filter(date__lte=end)
+    return queryset
+
+
+def _amount(cents):
+    return Decimal(int(cents)) / 100
+
+
+def daily_totals(user, start, end):
+    """{date: total} for every day with spending between start and end."""
+    snapshot = get_snapshot(user)
+    rows = snapshot.expenses(start, end)
+    offsets = snapshot.days[rows] - start.toordinal()
+    totals = np.bincount(offsets, weights=snapshot.cents[rows], minlength=(end - start).days + 1)
+    counts = np.bincount(offsets, minlength=len(totals))
+    return {start + timedelta(days=int(i)): _amount(totals[i]) for i in np.flatnonzero(counts)}
+
+
+def category_totals(user, start=None, end=None):
+    """[{'category', 'amount'}] summed over the range, largest first, with category names."""
+    snapshot = get_snapshot(user)
+    rows = snapshot.expenses(start, end)
+    categories, inverse = np.unique(snapshot.categories[rows], return_inverse=True)
+    totals = np.bincount(inverse, weights=snapshot.cents[rows], minlength=len(categories))
+    names = dict(Category.objects.filter(pk__in=categories.tolist()).values_list('pk', 'name'))
+    return [
+        {'category': names[int(categories[i])], 'amount': _amount(totals[i])}
+        for i in np.argsort(-totals, kind='stable')
+    ]
+
+
+def top_expenses(user, start=None, end=None, limit=5):
+    """The `limit` largest expenses in the range, as Transaction instances."""
+    snapshot = get_snapshot(user)
+    rows = snapshot.expenses(start, end)
+    ids = snapshot.ids[rows[np.argsort(-snapshot.cents[rows], kind='stable')[:limit]]].tolist()
+    found = spending(user).select_related('category').in_bulk(ids)
+    return [found[pk] for pk in ids if pk in found]
+
+
+def recent_amounts(user, end, limit):
+    """Amounts of the `limit` latest expenses up to `end`, newest first."""
+    snapshot = get_snapshot(user)
+    rows = snapshot.expenses(end=end)[::-1][:limit]
+    return [_amount(cents) for cents in snapshot.cents[rows]]
+
+
+def period_totals(user, period, include_archived_months=False):
+    """
+    (period starts as datetime64[D], totals in cents) of the user's hot
+    expenses per week (starting Monday) or calendar month. With
+    include_archived_months the archived monthly totals are added, which
+    is exact for monthly periods only.
+    """
+    snapshot = get_snapshot(user)
+    rows = snapshot.expenses()
+    days, cents = snapshot.days[rows], snapshot.cents[rows]
+    if include_archived_months:
+        archived = snapshot.archived_expense
+        days = np.concatenate([days, snapshot.archived_months[archived]])
+        cents = np.concatenate([cents, snapshot.archived_cents[archived]])
+    dates = (days - UNIX_EPOCH).astype('datetime64[D]')
+    if period == 'weekly':
+        # 1970-01-01 was a Thursday.
+        starts = dates - ((dates.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+    else:
+        starts = dates.astype('datetime64[M]').astype('datetime64[D]')
+    starts, inverse = np.unique(starts, return_inverse=True)
+    return starts, np.bincount(inverse, weights=cents, minlength=len(starts)).astype(np.int64)
+
+
+GRANULARITIES = {'day': 'D', 'week': 'W', 'month': 'M', 'year': 'Y'}
+
+
+def _to_dates(ordinals):
+    return (np.asarray(ordinals) - UNIX_EPOCH).astype('datetime64[D]')
+
+
+def _bucket(dates, granularity):
+    """Start of the period of `granularity` that contains each datetime64[D]."""
+    if granularity == 'day':
+        return dates
+    if granularity == 'week':
+        # 1970-01-01 was a Thursday.
+        return dates - ((dates.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+    unit = GRANULARITIES[granularity]
+    return dates.astype(f'datetime64[{unit}]').astype('datetime64[D]')
+
+
+def period_starts(start, end, granularity):
+    """datetime64[D] starts of every period of `granularity` that overlaps start..end."""
+    first, last = _bucket(_to_dates([start.toordinal(), end.toordinal()]), granularity)
+    if granularity in ('day', 'week'):
+        step = 1 if granularity == 'day' else 7
+        return np.arange(first, last + 1, step, dtype='datetime64[D]')
+    unit = GRANULARITIES[granularity]
+    return np.arange(first.astype(f'datetime64[{unit}]'), last.astype(f'datetime64[{unit}]') + 1).astype('datetime64[D]')
+
+
+def series(user, start, end, granularity, group_by=None, type='expense'):
+    """
+    Totals in cents of the user's transactions between start and end, per
+    period of `granularity` and optionally per category, account or type.
+
+    `type` is 'expense', 'income' or 'all'. Returns (periods, keys, totals):
+    the period starts as dates, the group keys (category or account ids,
+    'income'/'expense', or [None] when not grouped) and a
+    len(keys) x len(periods) matrix of totals.
+
+    Monthly and yearly series include archived months as a whole. Archived
+    summaries have no account, so they are keyed None when grouping by account.
+    """
+    snapshot = get_snapshot(user)
+    rows = snapshot.rows(start, end)
+    days, cents, expense = snapshot.days[rows], snapshot.cents[rows], snapshot.expense[rows]
+    groups = {
+        'category': snapshot.categories[rows], 'account': snapshot.accounts[rows], 'type': expense,
+        None: np.zeros(len(days), dtype=np.int64),
+    }[group_by]
+
+    if granularity in ('month', 'year'):
+        month = start.replace(day=1).toordinal()
+        archived = (snapshot.archived_months >= month) & (snapshot.archived_months <= end.toordinal())
+        days = np.concatenate([days, snapshot.archived_months[archived]])
+        cents = np.concatenate([cents, snapshot.archived_cents[archived]])
+        archived_expense = snapshot.archived_expense[archived]
+        archived_groups = {
+            'category': snapshot.archived_categories[archived],
+            'account': np.full(archived.sum(), -1, dtype=np.int64),
+            'type': archived_expense,
+            None: np.zeros(archived.sum(), dtype=np.int64),
+        }[group_by]
+        expense = np.concatenate([expense, archived_expense])
+        groups = np.concatenate([groups, archived_groups])
+
+    if type != 'all':
+        wanted = expense if type == 'expense' else ~expense
+        days, cents, groups = days[wanted], cents[wanted], groups[wanted]
+
+    periods = period_starts(start, end, granularity)
+    index = np.searchsorted(periods, _bucket(_to_dates(days), granularity))
+    if group_by is None:
+        codes, inverse = np.zeros(1, dtype=np.int64), groups
+    else:
+        codes, inverse = np.unique(groups, return_inverse=True)
+    totals = np.bincount(
+        inverse * len(periods) + index, weights=cents, minlength=len(codes) * len(periods)
+    ).reshape(len(codes), len(periods)).astype(np.int64)
+
+    if group_by == 'type':
+        keys = ['expense' if code else 'income' for code in codes]
+    elif group_by in ('category', 'account'):
+        keys = [None if code < 0 else int(code) for code in codes]
+    else:
+        keys = [None]
+    return periods.astype(object), keys, totals
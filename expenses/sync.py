@@ -0,0 +1,120 @@
+"""
+Delta sync: the rows a client needs to catch up since its last sync.
+
+Synced models carry an auto_now `updated_at`, and deleting one leaves a
+Tombstone. A sync reads the rows updated and the tombstones written since
+the client's cursor through (user, updated_at) and (user, deleted_at)
+indexes, so its cost follows what changed, not the size of the history.
+
+The cursor is a signed timestamp plus the user's shard. A row is stamped
+before its transaction commits, so each sync looks back
+SYNC_CURSOR_OVERLAP_SECONDS past the cursor to catch rows that committed
+late; clients apply rows by id, so receiving one twice is harmless. A
+client without a cursor, with one older than the tombstones kept, or with
+one from before the user moved shard (which renumbers rows) gets all rows
+and `reset`, and should replace what it has.
+
+Writes that bypass save() must set updated_at themselves, and deletes
+that bypass the delete receivers must call record_deletions(). Archiving
+is not a deletion: archived transactions stay on the clients that have
+them.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from tracker.routers import shard_for_user
+from .models import Account, Notification, SavingsGoal, Tombstone, Transaction
+from .serializers import AccountSerializer, NotificationSerializer, SavingsGoalSerializer, TransactionSerializer
+
+CURSOR_SALT = 'expenses.sync'
+
+# kind -> (model, serializer, related rows the serializer reads)
+SYNCED = {
+    'transactions': (Transaction, TransactionSerializer, ('category',)),
+    'accounts': (Account, AccountSerializer, ()),
+    'savings_goals': (SavingsGoal, SavingsGoalSerializer, ()),
+    'notifications': (Notification, NotificationSerializer, ()),
+}
+KINDS = {model: kind for kind, (model, _, _) in SYNCED.items()}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def make_cursor(at, alias):
+    return signing.dumps({'at': at.timestamp(), 'shard': alias}, salt=CURSOR_SALT)
+
+
+def read_cursor(cursor):
+    try:
+        data = signing.loads(cursor, salt=CURSOR_SALT)
+        return datetime.fromtimestamp(data['at'], dt_timezone.utc), data['shard']
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise InvalidCursor('Invalid cursor.')
+
+
+def record_deletions(kind, user_id, ids, using):
+    Tombstone.objects.using(using).bulk_create(
+        [Tombstone(user_id=user_id, kind=kind, object_id=pk) for pk in ids], batch_size=1000
+    )
+
+
+def _deleted_from(origin):
+    """The model whose delete() started a delete, whether of an instance or a queryset."""
+    return origin.model if isinstance(origin, QuerySet) else type(origin)
+
+
+def account_deleting(sender, instance, using, origin=None, **kwargs):
+    # Tombstones for the account's transactions in one go, rather than one
+    # per row from row_deleted as the delete cascades.
+    if issubclass(_deleted_from(origin), get_user_model()):
+        return
+    ids = Transaction.objects.using(using).filter(account_id=instance.pk).values_list('pk', flat=True)
+    record_deletions('transactions', instance.user_id, ids, using)
+
+
+def row_deleted(sender, instance, using, origin=None, **kwargs):
+    # A deleted user's tombstones would go with them.
+    deleted_from = _deleted_from(origin)
+    if issubclass(deleted_from, get_user_model()):
+        return
+    if issubclass(deleted_from, Account) and not isinstance(instance, Account):
+        return
+    Tombstone.objects.using(using).create(
+        user_id=instance.user_id, kind=KINDS[sender._meta.concrete_model], object_id=instance.pk
+    )
+
+
+def changes(request, cursor=None):
+    """The sync response for request.user since `cursor` (None for everything)."""
+    user = request.user
+    alias = shard_for_user(user.pk)
+    # Taken before reading, so anything written while we read is in the next sync.
+    now = timezone.now()
+    since = None
+    if cursor:
+        at, shard = read_cursor(cursor)
+        at -= timedelta(seconds=settings.SYNC_CURSOR_OVERLAP_SECONDS)
+        # Tombstones before the retention window may have been pruned.
+        if shard == alias and at > now - timedelta(days=settings.SYNC_TOMBSTONE_DAYS):
+            since = at
+
+    changed, deleted = {}, {}
+    for kind, (model, serializer_class, related) in SYNCED.items():
+        rows = model.objects.filter(user=user).select_related(*related).order_by('pk')
+        if since is not None:
+            rows = rows.filter(updated_at__gte=since)
+        changed[kind] = serializer_class(rows, many=True, context={'request': request}).data
+        deleted[kind] = []
+    if since is not None:
+        tombstones = Tombstone.objects.filter(user=user, deleted_at__gte=since).order_by('pk')
+        for kind, object_id in tombstones.values_list('kind', 'object_id'):
+            deleted[kind].append(object_id)
+
+    return {'cursor': make_cursor(now, alias), 'reset': since is None, 'changed': changed, 'deleted': deleted}
@@ -0,0 +1,41 @@
+"""
+Background job handlers. Queue them with expenses.jobs.enqueue(name, payload).
+"""
+from tracker.routers import shard_for_user, user_context
+from .anomalies import rebuild_stats
+from .avatars import process_profile_picture
+from .jobs import job
+from .ml_utils import rebuild_forecast_stats
+from .recurring import refresh_user
+from .reporting import build_report
+
+
+@job('avatars.process')
+def process_avatar(user_id, stale=()):
+    process_profile_picture(user_id, stale)
+
+
+@job('recurring.refresh_user')
+def refresh_recurring(user_id):
+    refresh_user(user_id)
+
+
+@job('forecast.rebuild')
+def rebuild_forecast(user_id):
+    with user_context(user_id):
+        rebuild_forecast_stats(user_id, shard_for_user(user_id))
+
+
+@job('anomalies.rebuild')
+def rebuild_anomaly_stats(user_ids):
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for_user(user_id), []).append(user_id)
+    for alias, ids in by_shard.items():
+        rebuild_stats(alias, ids)
+
+
+@job('ops.report')
+def ops_report(active_days):
+    # One process: the worker may be running next to request workers.
+    return build_report(active_days, workers=1)
@@ -1,3 +1,1147 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import date, timedelta
+from decimal import Decimal
+from importlib import import_module, reload
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, connections, router
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from tracker.checks import warn_unshared_cache
+from tracker.routers import home_shard, shard_for_user, user_context
+from tracker import metrics
+from tracker.metrics import MetricsMiddleware, _QueryTimer, query_shape
+from .models import (
+    Account, ArchivedTransaction, Budget, Category, CategoryStats, Expense, ForecastChoice, Job, LegacyExpenseId,
+    MonthlySummary, Notification, PredictionLog, RecurringPayment, SavingsContribution, SavingsGoal, SpendingBucket,
+    TopExpenses, Transaction, User,
+)
+from .anomalies import rebuild_stats
+from .archive import archive_history
+from .avatars import process_profile_picture, render_thumbnails
+from .categorizer import predict_categories, save_model, train
+from .forecasting import MODELS, _linear_trend, _smoothing, align, select
+from .ml_utils import rebuild_forecast_stats
+from .snapshot import get_snapshot, snapshots
+from .serializers import TransactionSerializer
+from .sync import make_cursor
+from .sharding import move_user, place_user, sharded_models
+from .top_expenses import derive, month_top, rebuild_top_expenses
+from .urls import urlpatterns
+
+SMALL, LARGE = 6, 30
+
+
+def seed(name, n):
+    """A user with roughly `n` rows of everything an endpoint can list or aggregate."""
+    today = timezone.localdate()
+    user = User.objects.create_user(name, f'{name}@example.com', 'pw-12345!', is_staff=True)
+    account = Account.objects.create(user=user, bank_name='Bank', account_number=f'{name}-1', balance=1000)
+    categories = [Category.objects.create(user=user, name=f'cat{i}') for i in range(n // 2 + 1)]
+    for i in range(n):
+        Transaction.objects.create(
+            user=user, account=account, amount=Decimal(10 + i), category=categories[i % len(categories)],
+            title=f'Shop {i % 4}', date=today - timedelta(days=i * 13), type='expense' if i % 3 else 'income',
+        )
+    old = today.replace(day=1) - timedelta(days=800)
+    ArchivedTransaction.objects.bulk_create(
+        ArchivedTransaction(
+            original_id=10_000 + i, user=user, account=account, amount=Decimal(5), category=categories[i % len(categories)],
+            date=old - timedelta(days=i), type='expense',
+        ) for i in range(n)
+    )
+    MonthlySummary.objects.bulk_create(
+        MonthlySummary(user=user, month=(old - timedelta(days=31 * i)).replace(day=1), type='expense',
+                       category=categories[0], total=Decimal(50), count=3) for i in range(n)
+    )
+    for i in range(n // 3 + 1):
+        goal = SavingsGoal.objects.create(user=user, title=f'Goal {i}', target=Decimal(500))
+        for _ in range(3):
+            SavingsContribution.objects.create(goal=goal, user=user, amount=Decimal(20))
+    Budget.objects.create(user=user, month=today.month, year=today.year, amount=Decimal(900))
+    PredictionLog.objects.bulk_create(
+        PredictionLog(user=user, period_type='weekly', predicted_amount=Decimal(40), target_period_start=today)
+        for _ in range(n)
+    )
+    Notification.objects.bulk_create(Notification(user=user, title=f'N{i}', message='m') for i in range(n))
+    RecurringPayment.objects.bulk_create(
+        RecurringPayment(user=user, title=f'Sub {i}', amount=Decimal(9), period='monthly', occurrences=3,
+                         last_date=today, next_date=today + timedelta(days=30)) for i in range(n)
+    )
+    return user
+
+
+def cases(user):
+    """(route name, method, path, data) for every route, against `user`'s rows."""
+    expense = Transaction.objects.filter(user=user, type='expense').first()
+    income = Transaction.objects.filter(user=user, type='income').first()
+    account = Account.objects.get(user=user)
+    goal = SavingsGoal.objects.filter(user=user).first()
+    notification = Notification.objects.filter(user=user).first()
+    # Rows the two histories share, so a batch touches buckets in the same state.
+    recent, earlier = Transaction.objects.filter(user=user).order_by('-date')[2:4]
+    new_row = {'account': account.pk, 'amount': '12.50', 'category': 'cat0', 'title': 'Lunch', 'type': 'expense'}
+    today = timezone.localdate()
+    return [
+        ('expense-list', 'get', reverse('expense-list'), None),
+        ('expense-list', 'get', reverse('expense-list') + '?include_archived=true', None),
+        ('expense-list', 'post', reverse('expense-list'), {**new_row, 'description': 'x'}),
+        ('expense-detail', 'get', reverse('expense-detail', args=[expense.pk]), None),
+        ('expense-detail', 'patch', reverse('expense-detail', args=[expense.pk]), {'amount': '11.00'}),
+        ('expense-detail', 'delete', reverse('expense-detail', args=[expense.pk]), None),
+        ('total-balance', 'get', reverse('total-balance'), None),
+        ('account-list-create', 'get', reverse('account-list-create'), None),
+        ('account-list-create', 'post', reverse('account-list-create'),
+         {'bank_name': 'Other', 'account_number': f'{user.username}-2'}),
+        ('api_token_auth', 'post', reverse('api_token_auth'), {'username': user.username, 'password': 'pw-12345!'}),
+        ('register', 'post', reverse('register'), {
+            'username': f'{user.username}-new', 'email': 'new@example.com',
+            'password': 'Str0ng-pass!', 'password2': 'Str0ng-pass!',
+        }),
+        ('login', 'post', reverse('login'), {'username': user.username, 'password': 'pw-12345!'}),
+        ('user-detail', 'get', reverse('user-detail'), None),
+        ('transaction-list-create', 'get', reverse('transaction-list-create'), None),
+        ('transaction-list-create', 'get', reverse('transaction-list-create') + '?include_archived=true', None),
+        ('transaction-list-create', 'post', reverse('transaction-list-create'), new_row),
+        ('transaction-detail', 'get', reverse('transaction-detail', args=[income.pk]), None),
+        ('transaction-detail', 'patch', reverse('transaction-detail', args=[income.pk]), {'amount': '99.00'}),
+        ('transaction-detail', 'delete', reverse('transaction-detail', args=[income.pk]), None),
+        ('transaction-batch', 'post', reverse('transaction-batch'), {'operations': [
+            {'op': 'create', 'data': new_row},
+            {'op': 'update', 'id': recent.pk, 'data': {'amount': '3.00', 'category': 'cat1'}},
+            {'op': 'delete', 'id': earlier.pk},
+        ]}),
+        ('sync', 'get', reverse('sync'), None),
+        ('sync', 'get', reverse('sync') + f'?cursor={make_cursor(timezone.now(), "default")}', None),
+        ('google-auth', 'post', reverse('google-auth'), {'token': 'token'}),
+        ('current-budget', 'get', reverse('current-budget'), None),
+        ('current-budget', 'post', reverse('current-budget'), {'amount': '950.00'}),
+        ('savings-list-create', 'get', reverse('savings-list-create'), None),
+        ('savings-list-create', 'post', reverse('savings-list-create'), {'title': 'Car', 'target': '3000.00'}),
+        ('savings-detail', 'get', reverse('savings-detail', args=[goal.pk]), None),
+        ('savings-detail', 'patch', reverse('savings-detail', args=[goal.pk]), {'title': 'Trip'}),
+        ('savings-contribute', 'post', reverse('savings-contribute'), {'goal': goal.pk, 'amount': '15.00'}),
+        ('analytics-weekly', 'get', reverse('analytics-weekly'), None),
+        ('analytics-top', 'get', reverse('analytics-top'), None),
+        ('analytics-category', 'get', reverse('analytics-category'), None),
+        ('analytics-series', 'get', reverse('analytics-series') + (
+            f'?start={today - timedelta(days=900)}&granularity=month&group_by=category&compare=previous_year'), None),
+        ('analytics-prediction', 'get', reverse('analytics-prediction'), None),
+        ('predict-weekly', 'get', reverse('predict-weekly'), None),
+        ('predict-monthly', 'get', reverse('predict-monthly'), None),
+        ('prediction-history', 'get', reverse('prediction-history'), None),
+        ('recurring-payments', 'get', reverse('recurring-payments'), None),
+        ('recurring-payments', 'get', reverse('recurring-payments') + '?refresh=true', None),
+        ('ops-report', 'get', reverse('ops-report'), None),
+        ('notifications', 'get', reverse('notifications'), None),
+        ('notification-read', 'post', reverse('notification-read', args=[notification.pk]), None),
+        ('notification-delete', 'delete', reverse('notification-delete', args=[notification.pk]), None),
+        ('account-detail', 'get', reverse('account-detail', args=[account.pk]), None),
+        ('account-detail', 'patch', reverse('account-detail', args=[account.pk]), {'bank_name': 'Renamed'}),
+        ('account-detail', 'delete', reverse('account-detail', args=[account.pk]), None),
+        ('user-profile', 'get', reverse('user-profile'), None),
+        ('user-profile', 'patch', reverse('user-profile'), {'email': 'changed@example.com'}),
+    ]
+
+
+class QueryCountTests(TestCase):
+    """Every endpoint runs the same number of queries for a small and a large history."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.small = seed('small', SMALL)
+        cls.large = seed('large', LARGE)
+
+    def run_case(self, user, method, path, data):
+        cache.clear()
+        snapshots.clear()
+        Job.objects.all().delete()
+        client = APIClient()
+        client.force_authenticate(user)
+        google = {'iss': 'accounts.google.com', 'email': user.email}
+        fmt = 'multipart' if path == reverse('user-profile') else 'json'
+        with mock.patch('expenses.views.id_token.verify_oauth2_token', return_value=google), \
+                CaptureQueriesContext(connection) as queries:
+            response = getattr(client, method)(path, data, format=fmt)
+        self.assertLess(response.status_code, 500, f'{method.upper()} {path}: {response.content[:200]}')
+        return queries
+
+    def test_every_route_is_covered(self):
+        covered = {name for name, *_ in cases(self.small)}
+        self.assertEqual(covered, {pattern.name for pattern in urlpatterns})
+
+    def test_query_count_does_not_grow_with_rows(self):
+        for (name, method, small_path, data), (_, _, large_path, large_data) in zip(cases(self.small), cases(self.large)):
+            with self.subTest(route=name, method=method, path=small_path):
+                small = self.run_case(self.small, method, small_path, data)
+                large = self.run_case(self.large, method, large_path, large_data)
+                self.assertEqual(
+                    len(small), len(large),
+                    f'{method.upper()} {name}: {len(small)} queries for {SMALL} rows, {len(large)} for {LARGE}.\n'
+                    + '\n'.join(query['sql'] for query in large.captured_queries),
+                )
+
+
+class TransactionBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed('batch', LARGE)
+        cls.account = Account.objects.get(user=cls.user)
+
+    def post(self, operations):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(reverse('transaction-batch'), {'operations': operations}, format='json')
+        return response, len(queries)
+
+    def operations(self, rows, n):
+        new = {'account': self.account.pk, 'amount': '4.00', 'type': 'expense'}
+        return (
+            [{'op': 'create', 'data': {**new, 'category': f'cat{i % 3}'}} for i in range(n)]
+            + [{'op': 'update', 'id': row.pk, 'data': {'amount': '2.50'}} for row in rows[:n]]
+            + [{'op': 'delete', 'id': row.pk} for row in rows[n:2 * n]]
+        )
+
+    def test_query_count_does_not_grow_with_operations(self):
+        # One day and three categories: the batch touches the same buckets
+        # and month however many operations it has.
+        categories = list(Category.objects.filter(user=self.user, name__in=['cat0', 'cat1', 'cat2']).order_by('name'))
+        rows = [
+            Transaction.objects.create(user=self.user, account=self.account, amount=Decimal(5 + i),
+                                       category=categories[i % 3], type='expense')
+            for i in range(40)
+        ]
+        few, few_queries = self.post(self.operations(rows[:4], 2))
+        many, many_queries = self.post(self.operations(rows[4:], 12))
+        self.assertEqual(few.status_code, 200, few.data)
+        self.assertEqual(many.status_code, 200, many.data)
+        self.assertEqual(few_queries, many_queries)
+
+    def test_balance_is_adjusted_by_the_net_change(self):
+        expense = Transaction.objects.filter(user=self.user, type='expense').first()
+        before = Account.objects.get(pk=self.account.pk).balance
+        response, _ = self.post([
+            {'op': 'create', 'data': {'account': self.account.pk, 'amount': '10.00', 'type': 'income', 'category': 'Pay'}},
+            {'op': 'update', 'id': expense.pk, 'data': {'amount': str(expense.amount + 5)}},
+            {'op': 'delete', 'id': expense.pk},
+        ])
+        self.assertEqual([result['status'] for result in response.data['results']], ['created', 'updated', 'deleted'])
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, before + 10 + expense.amount)
+        self.assertFalse(Transaction.objects.filter(pk=expense.pk).exists())
+
+    def test_derived_data_matches_a_rebuild(self):
+        def rebuilt():
+            rebuild_forecast_stats(self.user.pk, 'default')
+            rebuild_stats('default', [self.user.pk])
+            rebuild_top_expenses('default', [self.user.pk])
+            return derived()
+
+        def derived():
+            return (
+                sorted(SpendingBucket.objects.filter(user=self.user).values_list('period', 'start', 'amount', 'count')),
+                sorted(CategoryStats.objects.filter(user=self.user).values_list('category_id', 'count')),
+                sorted(TopExpenses.objects.filter(user=self.user).values_list('month', 'entries')),
+            )
+
+        rebuilt()
+        rows = list(Transaction.objects.filter(user=self.user).order_by('pk'))
+        expense = next(row for row in rows if row.type == 'expense')
+        response, _ = self.post(self.operations(rows[1:], 5) + [
+            {'op': 'update', 'id': expense.pk, 'data': {'type': 'income', 'date': '2020-01-15'}},
+        ])
+        self.assertEqual(response.status_code, 200, response.data)
+        maintained = derived()
+        self.assertEqual(maintained, rebuilt())
+
+    def test_invalid_operation_rejects_the_whole_batch(self):
+        count = Transaction.objects.filter(user=self.user).count()
+        response, _ = self.post([
+            {'op': 'create', 'data': {'account': self.account.pk, 'amount': '1.00', 'type': 'expense'}},
+            {'op': 'delete', 'id': 0},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.data['applied'])
+        self.assertEqual(response.data['results'][1], {'index': 1, 'errors': {'id': ['Not found.']}})
+        self.assertEqual(Transaction.objects.filter(user=self.user).count(), count)
+
+
+SHARD = 'shard_test'
+
+
+def add_database(alias, config):
+    """Configure a database the settings do not define, such as a second shard."""
+    databases = connections.configure_settings({'default': connections.settings['default'], alias: config})
+    settings.DATABASES[alias] = connections.settings[alias] = databases[alias]
+
+
+def remove_database(alias):
+    connections[alias].close()
+    del connections[alias]
+    settings.DATABASES.pop(alias, None)
+    connections.settings.pop(alias, None)
+
+
+@override_settings(DATABASE_SHARDS=['default', SHARD])
+class ShardTestCase(TestCase):
+    """Runs with a second SQLite shard, migrated into a temporary file for the class."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shard_dir = tempfile.TemporaryDirectory()
+        add_database(SHARD, {'ENGINE': 'django.db.backends.sqlite3', 'NAME': f'{cls.shard_dir.name}/shard.sqlite3'})
+        call_command('migrate', database=SHARD, verbosity=0)
+        # Set here rather than on the class: the runner only sets up the
+        # databases the settings define.
+        cls.databases = {'default', SHARD}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        remove_database(SHARD)
+        cls.shard_dir.cleanup()
+
+    def setUp(self):
+        cache.clear()
+
+
+class SnapshotTests(TestCase):
+    def test_per_process_cache_snapshots_age_out(self):
+        user = seed('aging', SMALL)
+        snapshots.clear()
+        count = len(get_snapshot(user).ids)
+        # Another worker's write: it can only bump the version in its own cache.
+        Transaction.objects.bulk_create([Transaction(
+            user=user, account=Account.objects.get(user=user), amount=Decimal(5), type='expense',
+            category=Category.objects.filter(user=user).first(),
+        )])
+        self.assertEqual(len(get_snapshot(user).ids), count)
+        with mock.patch('expenses.snapshot.time.monotonic', return_value=float('inf')):
+            self.assertEqual(len(get_snapshot(user).ids), count + 1)
+
+
+class AccountIdsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'pw-12345!')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, account):
+        return self.client.post(reverse('transaction-list-create'), {
+            'account': account.pk, 'amount': '5.00', 'type': 'expense', 'category': 'Food',
+        }, format='json')
+
+    @mock.patch('expenses.accounts.cache_is_shared', return_value=True)
+    def test_account_missing_from_the_cached_ids_is_checked_again(self, shared):
+        first = Account.objects.create(user=self.user, bank_name='Bank', account_number='owner-1')
+        self.assertEqual(self.post(first).status_code, 201)
+        # Added by another worker whose cache is not this one.
+        second, = Account.objects.bulk_create([Account(user=self.user, bank_name='Bank', account_number='owner-2')])
+        self.assertEqual(self.post(second).status_code, 201)
+        self.assertEqual(self.post(Account(pk=0)).status_code, 400)
+
+    def test_per_process_cache_does_not_keep_account_ids(self):
+        account = Account.objects.create(user=self.user, bank_name='Bank', account_number='owner-1')
+        self.assertEqual(self.post(account).status_code, 201)
+        self.assertIsNone(cache.get(f'accounts:{self.user.pk}'))
+
+    def test_saved_transaction_reads_the_real_account(self):
+        account = Account.objects.create(user=self.user, bank_name='Bank', account_number='owner-1', balance=Decimal('50.00'))
+        request = RequestFactory().post('/')
+        request.user = self.user
+        serializer = TransactionSerializer(data={
+            'account': account.pk, 'amount': '5.00', 'type': 'expense', 'category': 'Food',
+        }, context={'request': request})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        created = serializer.save(user=self.user)
+        self.assertEqual(created.account_id, account.pk)
+        self.assertEqual((created.account.bank_name, created.account.balance), ('Bank', Decimal('50.00')))
+        self.assertEqual(serializer.data['account'], account.pk)
+
+
+class CategoryStatsTests(TestCase):
+    def test_edits_and_deletes_keep_running_stats_equal_to_a_rebuild(self):
+        user = User.objects.create_user('steady', 'steady@example.com', 'pw-12345!')
+        account = Account.objects.create(user=user, bank_name='Bank', account_number='steady-1')
+        food, fuel = (Category.objects.create(user=user, name=name) for name in ('Food', 'Fuel'))
+        rows = [
+            Transaction.objects.create(user=user, account=account, category=food, type='expense', amount=Decimal(amount))
+            for amount in (10, 25, 40, 70)
+        ]
+        rows[0].amount = Decimal(15)
+        rows[0].save()
+        moved = Transaction.objects.get(pk=rows[1].pk)
+        moved.category = fuel
+        moved.save()
+        Transaction.objects.get(pk=rows[2].pk).delete()
+        rows[3].type = 'income'
+        rows[3].save()
+
+        running = {stat.category_id: (stat.count, stat.mean, stat.m2) for stat in CategoryStats.objects.filter(user=user)}
+        rebuild_stats('default', [user.pk])
+        rebuilt = {stat.category_id: (stat.count, stat.mean, stat.m2) for stat in CategoryStats.objects.filter(user=user)}
+        self.assertEqual(running.keys(), rebuilt.keys())
+        for category_id, values in rebuilt.items():
+            for value, expected in zip(running[category_id], values):
+                self.assertAlmostEqual(value, expected)
+
+
+class AccountDeleteTests(TestCase):
+    def test_deleting_an_account_anywhere_rebuilds_derived_data(self):
+        user = User.objects.create_user('closer', 'closer@example.com', 'pw-12345!')
+        food = Category.objects.create(user=user, name='Food')
+        accounts = [
+            Account.objects.create(user=user, bank_name='Bank', account_number=f'closer-{i}') for i in range(3)
+        ]
+        day = date(2024, 5, 10)
+        rows = [
+            Transaction.objects.create(user=user, account=account, category=food, type='expense',
+                                       amount=Decimal(10 * (i + 1)), date=day)
+            for i, account in enumerate(accounts)
+        ]
+        accounts[0].delete()
+        # As the admin's bulk delete action does.
+        Account.objects.filter(pk=accounts[1].pk).delete()
+
+        self.assertEqual(SpendingBucket.objects.get(user=user, period='monthly').amount, Decimal(30))
+        self.assertEqual(TopExpenses.objects.get(user=user).entries, [[3000, rows[2].pk]])
+        self.assertEqual(CategoryStats.objects.get(user=user, category=food).count, 1)
+
+
+class AvatarTests(TestCase):
+    def test_thumbnails_of_a_replaced_picture_are_not_left_behind(self):
+        user = User.objects.create_user('pictured', 'pictured@example.com', 'pw-12345!')
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            image = BytesIO()
+            Image.new('RGB', (300, 200), 'teal').save(image, 'PNG')
+            user.profile_picture = default_storage.save('profile_pics/first.png', ContentFile(image.getvalue()))
+            user.save()
+
+            def replaced_while_rendering(source):
+                User.objects.filter(pk=user.pk).update(profile_picture='profile_pics/second.png')
+                return render_thumbnails(source)
+
+            with mock.patch('expenses.avatars.render_thumbnails', side_effect=replaced_while_rendering):
+                process_profile_picture(user.pk)
+            self.assertEqual(User.objects.get(pk=user.pk).profile_thumbnails, {})
+            self.assertEqual(default_storage.listdir(f'avatars/{user.pk}')[1], [])
+
+    def test_only_the_development_server_serves_thumbnails(self):
+        def route_names():
+            return {getattr(pattern, 'name', None) for pattern in reload(import_module('tracker.urls')).urlpatterns}
+
+        try:
+            self.assertNotIn('avatar', route_names())
+            with override_settings(DEBUG=True):
+                self.assertIn('avatar', route_names())
+        finally:
+            reload(import_module('tracker.urls'))
+            clear_url_caches()
+
+
+class SavingsGoalTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('saver', 'saver@example.com', 'pw-12345!')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        goal = self.client.post(reverse('savings-list-create'), {'title': 'Bike', 'target': '1000.00'}, format='json')
+        self.goal = SavingsGoal.objects.get(pk=goal.data['id'])
+        self.client.post(reverse('savings-contribute'), {'goal': self.goal.pk, 'amount': '100.00'}, format='json')
+
+    def test_editing_a_goal_keeps_saved_and_reprojects(self):
+        response = self.client.patch(reverse('savings-detail', args=[self.goal.pk]),
+                                     {'target': '50.00', 'saved': '999.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['saved'], '100.00')
+        self.assertEqual(response.data['projected_completion'], str(timezone.localdate()))
+
+    def test_migration_backfills_the_projection(self):
+        SavingsGoal.objects.filter(pk=self.goal.pk).update(progress=[], projected_completion=None)
+        migration = import_module('expenses.migrations.0012_savings_progress')
+        migration.backfill_progress(django_apps, mock.Mock(connection=connection))
+        goal = SavingsGoal.objects.get(pk=self.goal.pk)
+        self.assertEqual(goal.progress, [[str(timezone.localdate()), '100.00']])
+        self.assertEqual(goal.projected_completion, goal.project_completion())
+        self.assertIsNotNone(goal.projected_completion)
+
+
+class CategorizerTests(TestCase):
+    def test_training_streams_in_batches(self):
+        rows = [('Food', 'grocery store'), ('Travel', 'airline ticket'), ('Other', 'misc')] * 2
+        for i in range(3):
+            user = User.objects.create_user(f'learner{i}', f'learner{i}@example.com', 'pw-12345!')
+            account = Account.objects.create(user=user, bank_name='Bank', account_number=f'learner-{i}')
+            # A name only the first user has, with plenty of examples.
+            names = rows + [('Alice', 'gift for alice')] * 6 * (i == 0)
+            categories = {name: Category.objects.get_or_create(user=user, name=name)[0] for name, _ in names}
+            Transaction.objects.bulk_create([Transaction(
+                user=user, account=account, amount=Decimal(10), type='expense', title=title, category=categories[name],
+            ) for name, title in names])
+
+        with CaptureQueriesContext(connection) as queries:
+            model, samples = train(['default'], min_samples=5, batch_size=4, epochs=2, min_users=2)
+        self.assertEqual(samples, 12)
+        self.assertEqual(list(model.classes_), ['Food', 'Travel'])
+        # A count, then per epoch the 18 categorized rows in batches of 4 and an empty read.
+        self.assertEqual(len(queries), 1 + 2 * 6)
+        with tempfile.TemporaryDirectory() as tmp, override_settings(
+            CATEGORIZER_MODEL_PATH=f'{tmp}/model.joblib', CATEGORIZER_MIN_CONFIDENCE=0,
+        ):
+            save_model(model)
+            self.assertEqual(
+                predict_categories([('grocery store', '', 10, 'expense'), ('airline ticket', '', 10, 'expense')]),
+                ['Food', 'Travel'],
+            )
+
+
+@override_settings(TOP_EXPENSES_SIZE=3)
+class TopExpensesTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('spender', 'spender@example.com', 'pw-12345!')
+        self.food = Category.objects.create(user=self.user, name='Food')
+        self.account = Account.objects.create(user=self.user, bank_name='Bank', account_number='spender-1')
+        self.month = date(2024, 5, 1)
+        self.rows = [self.expense(amount) for amount in (10, 20, 30, 40)]
+
+    def expense(self, amount, account=None, day=None):
+        return Transaction.objects.create(
+            user=self.user, account=account or self.account, category=self.food, type='expense',
+            amount=Decimal(amount), date=day or self.month.replace(day=10),
+        )
+
+    def edit(self, row, **fields):
+        row = Transaction.objects.get(pk=row.pk)
+        for name, value in fields.items():
+            setattr(row, name, value)
+        row.save()
+
+    def assertTop(self, rows, month=None, using='default'):
+        month = month or self.month
+        entries = TopExpenses.objects.using(using).get(user=self.user, month=month).entries
+        self.assertEqual(entries, derive(self.user.pk, month, using))
+        self.assertEqual([pk for _, pk in entries], [row.pk for row in rows])
+
+    def test_new_and_grown_expenses_are_merged_in(self):
+        ten, twenty, thirty, forty = self.rows
+        self.assertTop([forty, thirty, twenty])
+        self.edit(ten, amount=Decimal(35))
+        self.assertTop([forty, ten, thirty])
+
+    def test_member_leaving_a_full_list_rederives_it(self):
+        ten, twenty, thirty, forty = self.rows
+        forty.delete()
+        self.assertTop([thirty, twenty, ten])
+
+    def test_member_shrinking_below_a_non_member_rederives_it(self):
+        ten, twenty, thirty, forty = self.rows
+        self.edit(thirty, amount=Decimal(5))
+        self.assertTop([forty, twenty, ten])
+
+    def test_change_of_month_or_type_moves_the_expense(self):
+        ten, twenty, thirty, forty = self.rows
+        earlier = date(2024, 4, 20)
+        self.edit(forty, date=earlier)
+        self.assertTop([thirty, twenty, ten])
+        self.assertTop([forty], month=earlier.replace(day=1))
+
+        self.edit(thirty, type='income')
+        self.assertTop([twenty, ten])
+        self.edit(forty, type='income')
+        self.assertFalse(TopExpenses.objects.filter(month=earlier.replace(day=1)).exists())
+
+    def test_account_delete_rebuilds(self):
+        ten, twenty, thirty, forty = self.rows
+        other = Account.objects.create(user=self.user, bank_name='Bank', account_number='spender-2')
+        big = [self.expense(amount, account=other) for amount in (50, 60)]
+        self.assertTop([big[1], big[0], forty])
+        other.delete()
+        self.assertTop([forty, thirty, twenty])
+
+    def test_archive_drops_archived_months(self):
+        ten, twenty, thirty, forty = self.rows
+        old = self.expense(70, day=date(2024, 3, 5))
+        self.assertTop([old], month=date(2024, 3, 1))
+        archive_history('default', date(2024, 4, 1))
+        self.assertFalse(TopExpenses.objects.filter(month=date(2024, 3, 1)).exists())
+        self.assertEqual(month_top(self.user.pk, date(2024, 3, 1), 3), [])
+        self.assertTop([forty, thirty, twenty])
+
+
+
+class ShardingTests(ShardTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('sharded', 'sharded@example.com', 'pw-12345!')
+        place_user(self.user, SHARD)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.account = self.client.post(reverse('account-list-create'), {
+            'bank_name': 'Bank', 'account_number': 'sharded-1', 'balance': '100.00',
+        }, format='json').data['id']
+
+    def spend(self, amount):
+        return self.client.post(reverse('transaction-list-create'), {
+            'account': self.account, 'amount': amount, 'type': 'expense', 'category': 'Food',
+        }, format='json')
+
+    def test_requests_use_the_users_shard(self):
+        self.assertEqual(self.spend('30.00').status_code, 201)
+        self.assertEqual(Transaction.objects.using(SHARD).filter(user=self.user).count(), 1)
+        self.assertFalse(Transaction.objects.using('default').exists())
+        self.assertEqual(Account.objects.using(SHARD).get(pk=self.account).balance, Decimal('70.00'))
+        self.assertEqual(len(self.client.get(reverse('transaction-list-create')).data), 1)
+
+    def test_row_and_balance_are_written_in_one_transaction(self):
+        with mock.patch('expenses.views.adjust_balance', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            self.spend('30.00')
+        self.assertFalse(Transaction.objects.using(SHARD).exists())
+
+    def test_goal_writes_lock_and_commit_on_the_shard(self):
+        goal = self.client.post(reverse('savings-list-create'), {'title': 'Bike', 'target': '1000.00'}, format='json').data
+        with mock.patch.object(SavingsGoal, 'add_contribution', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            self.client.post(reverse('savings-contribute'), {'goal': goal['id'], 'amount': '100.00'}, format='json')
+        self.assertFalse(SavingsContribution.objects.using(SHARD).exists())
+
+        self.client.post(reverse('savings-contribute'), {'goal': goal['id'], 'amount': '100.00'}, format='json')
+        with CaptureQueriesContext(connections[SHARD]) as queries:
+            response = self.client.patch(reverse('savings-detail', args=[goal['id']]), {'target': '50.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['saved'], '100.00')
+        self.assertTrue(any(query['sql'].startswith('SAVEPOINT') for query in queries))
+        self.assertEqual(SavingsGoal.objects.using(SHARD).get(pk=goal['id']).target, Decimal('50.00'))
+
+    def test_move_user_copies_rows_and_rebuilds_top_lists(self):
+        for amount in ('10.00', '30.00', '20.00'):
+            self.spend(amount)
+        counts = {
+            model._meta.label: model.objects.using(SHARD).filter(user_id=self.user.pk).count()
+            for model in sharded_models()
+        }
+
+        moved = move_user(self.user, 'default')
+        self.assertEqual(moved, counts)
+        self.assertEqual(shard_for_user(self.user.pk), 'default')
+        self.assertFalse(Transaction.objects.using(SHARD).exists())
+        self.assertFalse(User.objects.using(SHARD).filter(pk=self.user.pk).exists())
+        self.assertEqual(Account.objects.using('default').get(user=self.user).balance, Decimal('40.00'))
+        # The copied top list held the shard's row ids.
+        month = timezone.localdate().replace(day=1)
+        entries = TopExpenses.objects.using('default').get(user=self.user, month=month).entries
+        self.assertEqual(entries, derive(self.user.pk, month, 'default'))
+        self.assertEqual(len(self.client.get(reverse('transaction-list-create')).data), 3)
+
+    def test_rebalance_moves_users_to_their_home_shard(self):
+        users = [self.user] + [
+            User.objects.create_user(f'rebalance{i}', f'rebalance{i}@example.com', 'pw-12345!') for i in range(4)
+        ]
+        for user in users[1:]:
+            place_user(user, next(alias for alias in settings.DATABASE_SHARDS if alias != home_shard(user.pk)))
+            with user_context(user.pk):
+                Transaction.objects.create(
+                    user=user, account=Account.objects.create(user=user, bank_name='Bank', account_number=user.username),
+                    category=Category.objects.create(user=user, name='Food'), amount=Decimal(5), type='expense',
+                )
+        away = [user for user in users if shard_for_user(user.pk) != home_shard(user.pk)]
+
+        out = StringIO()
+        call_command('rebalance_shards', '--dry-run', stdout=out)
+        self.assertIn(f'would move {len(away)} user(s)', out.getvalue())
+        self.assertEqual([shard_for_user(user.pk) != home_shard(user.pk) for user in users], [user in away for user in users])
+
+        call_command('rebalance_shards', stdout=StringIO())
+        for user in users:
+            home = home_shard(user.pk)
+            self.assertEqual(shard_for_user(user.pk), home)
+            self.assertEqual(Account.objects.using(home).filter(user=user).count(), 1)
+            for alias in settings.DATABASE_SHARDS:
+                if alias != home:
+                    self.assertFalse(Account.objects.using(alias).filter(user_id=user.pk).exists())
+
+
+@override_settings(DATABASE_REPLICA_ALIAS='replica')
+class ReplicaTests(TransactionTestCase):
+    """Reads and writes against a replica that mirrors the test database, as DATABASE_REPLICA_URL sets it up."""
+
+    @classmethod
+    def setUpClass(cls):
+        add_database('replica', dict(connections['default'].settings_dict, TEST={'MIRROR': 'default'}))
+        cls.databases = {'default', 'replica'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        remove_database('replica')
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'pw-12345!')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.account = Account.objects.create(user=self.user, bank_name='Bank', account_number='reader-1')
+
+    def replica_reads(self, name, *args):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual(self.client.get(reverse(name, args=args)).status_code, 200)
+        return len(queries)
+
+    def test_listed_routes_read_from_the_replica(self):
+        Transaction.objects.create(
+            user=self.user, account=self.account, category=Category.objects.create(user=self.user, name='Food'),
+            amount=Decimal(5), type='expense',
+        )
+        self.assertIn('transaction-list-create', settings.REPLICA_READ_ROUTES)
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.get(reverse('transaction-list-create'))
+        self.assertGreater(len(queries), 0)
+        self.assertEqual(len(response.data), 1)
+        self.assertNotIn('account-detail', settings.REPLICA_READ_ROUTES)
+        self.assertEqual(self.replica_reads('account-detail', self.account.pk), 0)
+
+    def test_a_write_pins_the_users_reads_to_the_primary(self):
+        response = self.client.post(reverse('transaction-list-create'), {
+            'account': self.account.pk, 'amount': '30.00', 'type': 'expense', 'category': 'Food',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.replica_reads('transaction-list-create'), 0)
+
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user('other', 'other@example.com', 'pw-12345!'))
+        with CaptureQueriesContext(connections['replica']) as queries:
+            other.get(reverse('transaction-list-create'))
+        self.assertGreater(len(queries), 0)
+
+    def test_analytics_snapshots_are_built_from_the_replica(self):
+        snapshots.clear()
+        self.assertIn('analytics-weekly', settings.REPLICA_READ_ROUTES)
+        with CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual(self.client.get(reverse('analytics-weekly')).status_code, 200)
+        self.assertTrue(any('"expenses_transaction"' in query['sql'] for query in queries))
+
+    @override_settings(DATABASE_REPLICA_ALIAS=None)
+    def test_without_a_replica_reads_use_the_primary(self):
+        self.assertEqual(self.replica_reads('transaction-list-create'), 0)
+        self.assertEqual(router.db_for_read(Transaction), 'default')
+
+
+class ExpenseMergeTests(TestCase):
+    """Runs migration 0011 on a separate SQLite database that still has the Expense table."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db_dir = tempfile.TemporaryDirectory()
+        add_database('legacy', {'ENGINE': 'django.db.backends.sqlite3', 'NAME': f'{cls.db_dir.name}/legacy.sqlite3'})
+        call_command('migrate', 'expenses', '0010', database='legacy', verbosity=0)
+        old = MigrationExecutor(connections['legacy']).loader.project_state(('expenses', '0010_archive')).apps
+        user = old.get_model('expenses', 'User').objects.using('legacy').create(username='legacy')
+        account = old.get_model('expenses', 'Account').objects.using('legacy').create(
+            user=user, bank_name='Bank', account_number='legacy-1', balance=0,
+        )
+        # Transaction ids 1 and 2 are taken, so the expenses cannot keep theirs.
+        for amount in (100, 200):
+            old.get_model('expenses', 'Transaction').objects.using('legacy').create(
+                user=user, account=account, amount=amount, category='Pay', type='income',
+            )
+        Expense = old.get_model('expenses', 'Expense')
+        cls.expenses = {
+            Expense.objects.using('legacy').create(user=user, account=account, amount=amount, category='Food').pk: amount
+            for amount in (5, 7)
+        }
+        call_command('migrate', 'expenses', '0011', database='legacy', verbosity=0)
+        cls.merged = MigrationExecutor(connections['legacy']).loader.project_state(
+            ('expenses', '0011_merge_expenses_into_transactions')
+        ).apps
+        cls.databases = {'default', 'legacy'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        remove_database('legacy')
+        cls.db_dir.cleanup()
+
+    def test_old_expense_ids_map_to_their_transactions(self):
+        LegacyExpenseId = self.merged.get_model('expenses', 'LegacyExpenseId')
+        mapped = {
+            row.expense_id: row.transaction
+            for row in LegacyExpenseId.objects.using('legacy').select_related('transaction')
+        }
+        self.assertEqual(set(mapped), set(self.expenses))
+        for expense_id, amount in self.expenses.items():
+            self.assertEqual((mapped[expense_id].type, mapped[expense_id].amount), ('expense', amount))
+            self.assertNotEqual(mapped[expense_id].pk, expense_id)
+
+    def test_expenses_can_be_found_by_their_old_id(self):
+        user = seed('remapped', SMALL)
+        expense = Expense.objects.filter(user=user).first()
+        LegacyExpenseId.objects.create(user=user, transaction=expense, expense_id=1)
+        client = APIClient()
+        client.force_authenticate(user)
+        found = client.get(reverse('expense-list'), {'legacy_id': 1}).data
+        self.assertEqual([row['id'] for row in found], [expense.pk])
+        self.assertEqual(client.get(reverse('expense-list'), {'legacy_id': 'x'}).status_code, 400)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.enterContext(override_settings(METRICS_DIR=self.directory))
+
+    def test_scrapes_need_the_token_unless_debug(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with override_settings(DEBUG=True):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+        with override_settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret')
+            self.assertEqual(response.status_code, 200)
+
+    def test_files_of_exited_workers_are_dropped(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        stale = {'counters': [['tracker_jobs_total', [['job', 'old']], 5]], 'histograms': []}
+        for name in (f'metrics-{exited.pid}-1.json', f'metrics-{os.getpid()}-1.json'):
+            with open(os.path.join(self.directory, name), 'w') as fh:
+                json.dump(stale, fh)
+        metrics.inc('tracker_jobs_total', [('job', 'live')])
+        metrics.flush()
+
+        counters, _ = metrics.collect()
+        self.assertNotIn(('tracker_jobs_total', (('job', 'old'),)), counters)
+        self.assertIn(('tracker_jobs_total', (('job', 'live'),)), counters)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+
+class OpsReportTests(TestCase):
+    def test_report_built_by_a_worker_is_served_to_other_processes(self):
+        client = APIClient()
+        client.force_authenticate(seed('operator', SMALL))
+        self.assertEqual(client.get(reverse('ops-report')).status_code, 202)
+        call_command('run_jobs', '--burst', stdout=StringIO())
+
+        # The worker is another process: nothing it cached is visible here.
+        cache.clear()
+        response = client.get(reverse('ops-report'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['users'], 1)
+        self.assertEqual(Job.objects.filter(name='ops.report').count(), 1)
+
+
+class ReconcileBalancesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('ledger', 'ledger@example.com', 'pw-12345!')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        response = self.client.post(reverse('account-list-create'), {
+            'bank_name': 'Bank', 'account_number': 'ledger-1', 'balance': '100.00',
+        }, format='json')
+        self.account = Account.objects.get(pk=response.data['id'])
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command('reconcile_balances', '--workers=1', *args, stdout=out)
+        return out.getvalue()
+
+    def test_api_writes_keep_balances_reconciled(self):
+        expense = self.client.post(reverse('expense-list'), {
+            'account': self.account.pk, 'amount': '30.00', 'category': 'Food',
+        }, format='json').data
+        self.client.post(reverse('transaction-list-create'), {
+            'account': self.account.pk, 'amount': '50.00', 'type': 'income', 'category': 'Pay',
+        }, format='json')
+        self.client.patch(reverse('expense-detail', args=[expense['id']]), {'amount': '20.00'}, format='json')
+        self.client.patch(reverse('account-detail', args=[self.account.pk]), {'balance': '500.00'}, format='json')
+        self.client.delete(reverse('expense-detail', args=[expense['id']]))
+
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, Decimal('520.00'))
+        self.assertIn('found 0 with drift', self.reconcile())
+
+    def test_drift_is_reported_and_fixed(self):
+        Transaction.objects.create(
+            user=self.user, account=self.account, amount=Decimal('12.50'),
+            category=Category.objects.create(user=self.user, name='Food'), type='expense',
+        )
+        self.assertIn(f'account {self.account.pk} (user {self.user.pk}) stored 100.00, expected 87.50', self.reconcile())
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, Decimal('100.00'))
+
+        self.assertIn('fixed 1 with drift totalling 12.50', self.reconcile('--fix'))
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, Decimal('87.50'))
+        self.assertIn('found 0 with drift', self.reconcile())
+
+    def test_accounts_without_an_opening_balance_are_reported_until_adopted(self):
+        # As migrated: nothing says whether today's balance is right.
+        Account.objects.filter(pk=self.account.pk).update(opening_balance=None)
+        Transaction.objects.create(
+            user=self.user, account=self.account, amount=Decimal('12.50'),
+            category=Category.objects.create(user=self.user, name='Food'), type='expense',
+        )
+        out = self.reconcile('--fix')
+        self.assertIn(f'account {self.account.pk} (user {self.user.pk}) has no opening balance; '
+                      'stored 100.00, transactions net -12.50', out)
+        self.assertIn('fixed 0 with drift', out)
+        self.assertIsNone(Account.objects.get(pk=self.account.pk).opening_balance)
+
+        self.assertIn('Adopted the current balances of 1 account(s)', self.reconcile('--adopt'))
+        self.assertEqual(Account.objects.get(pk=self.account.pk).opening_balance, Decimal('112.50'))
+        self.assertIn('found 0 with drift', self.reconcile())
+
+
+class SyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = seed('syncing', SMALL)
+        cls.account = Account.objects.get(user=cls.user)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, cursor=None):
+        response = self.client.get(reverse('sync'), {'cursor': cursor} if cursor else {})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_first_sync_returns_everything(self):
+        data = self.sync()
+        self.assertTrue(data['reset'])
+        self.assertEqual(len(data['changed']['transactions']), SMALL)
+        self.assertEqual(len(data['changed']['notifications']), SMALL)
+        self.assertEqual(data['changed']['accounts'][0]['id'], self.account.pk)
+
+    @override_settings(SYNC_CURSOR_OVERLAP_SECONDS=0)
+    def test_later_syncs_return_only_changes(self):
+        past = timezone.now() - timedelta(hours=1)
+        for model in (Transaction, Account, SavingsGoal, Notification):
+            model.objects.filter(user=self.user).update(updated_at=past)
+        cursor = make_cursor(past + timedelta(minutes=1), 'default')
+
+        created = self.client.post(reverse('transaction-list-create'), {
+            'account': self.account.pk, 'amount': '5.00', 'type': 'expense', 'category': 'cat0',
+        }, format='json').data
+        notification = Notification.objects.filter(user=self.user).first()
+        self.client.delete(reverse('notification-delete', args=[notification.pk]))
+        batch_deleted = Transaction.objects.filter(user=self.user).exclude(pk=created['id']).first()
+        self.client.post(reverse('transaction-batch'), {'operations': [{'op': 'delete', 'id': batch_deleted.pk}]},
+                         format='json')
+
+        data = self.sync(cursor)
+        self.assertFalse(data['reset'])
+        self.assertEqual([row['id'] for row in data['changed']['transactions']], [created['id']])
+        # The balance moved with both writes.
+        self.assertEqual([row['id'] for row in data['changed']['accounts']], [self.account.pk])
+        self.assertEqual(data['changed']['savings_goals'], [])
+        self.assertEqual(data['deleted']['notifications'], [notification.pk])
+        self.assertEqual(data['deleted']['transactions'], [batch_deleted.pk])
+
+        data = self.sync(data['cursor'])
+        self.assertEqual(sum(len(rows) for rows in data['changed'].values()), 0)
+        self.assertEqual(sum(len(ids) for ids in data['deleted'].values()), 0)
+
+    def test_cursor_from_another_shard_resets(self):
+        self.assertTrue(self.sync(make_cursor(timezone.now(), 'shard_1'))['reset'])
+
+    def test_tampered_cursor_is_rejected(self):
+        response = self.client.get(reverse('sync'), {'cursor': make_cursor(timezone.now(), 'default') + 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.user = seed('retrying', SMALL)
+        self.account = Account.objects.get(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, name, data, key):
+        return self.client.post(reverse(name), data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_without_writing_again(self):
+        data = {'account': self.account.pk, 'amount': '7.00', 'type': 'expense', 'category': 'cat0'}
+        count = Transaction.objects.filter(user=self.user).count()
+        first = self.post('transaction-list-create', data, 'k1')
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.post('transaction-list-create', data, 'k1')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((retry.status_code, retry.data), (201, first.data))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(Transaction.objects.filter(user=self.user).count(), count + 1)
+        self.assertEqual(Account.objects.get(pk=self.account.pk).balance, self.account.balance - 7)
+
+    def test_key_reused_for_another_request_is_refused(self):
+        goal = SavingsGoal.objects.filter(user=self.user).first()
+        self.assertEqual(self.post('savings-contribute', {'goal': goal.pk, 'amount': '5.00'}, 'k2').status_code, 201)
+        response = self.post('savings-contribute', {'goal': goal.pk, 'amount': '6.00'}, 'k2')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(SavingsGoal.objects.get(pk=goal.pk).saved, goal.saved + 5)
+
+    def test_failed_request_does_not_keep_the_key(self):
+        self.assertEqual(self.post('expense-list', {'account': 0, 'amount': '3.00'}, 'k3').status_code, 400)
+        response = self.post('expense-list', {'account': self.account.pk, 'amount': '3.00'}, 'k3')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_other_users_keys_are_separate(self):
+        other = User.objects.create_user('other', 'other@example.com', 'pw-12345!')
+        Account.objects.create(user=other, bank_name='Bank', account_number='other-1')
+        self.post('transaction-batch', {'operations': [{'op': 'delete', 'id': 0}]}, 'shared')
+        self.client.force_authenticate(other)
+        response = self.post('transaction-batch', {'operations': [{'op': 'delete', 'id': 0}]}, 'shared')
+        self.assertNotIn('Idempotent-Replayed', response)
+
+
+@override_settings(THROTTLE_BUCKETS={'default': (120, 2.0), 'analytics': (10, 0.5)},
+                   THROTTLE_ROUTES={'analytics-top': ('analytics', 4)})
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('busy', 'busy@example.com', 'pw-12345!'))
+
+    def test_expensive_routes_run_out_first_and_refill(self):
+        with mock.patch('tracker.throttling.time.time', return_value=1000.0):
+            self.assertEqual(self.client.get(reverse('analytics-top')).status_code, 200)
+            self.assertEqual(self.client.get(reverse('analytics-top')).status_code, 200)
+            refused = self.client.get(reverse('analytics-top'))
+            # Other routes draw on their own budget.
+            self.assertEqual(self.client.get(reverse('notifications')).status_code, 200)
+        self.assertEqual(refused.status_code, 429)
+        self.assertEqual(refused['Retry-After'], '4')
+
+        with mock.patch('tracker.throttling.time.time', return_value=1004.0):
+            self.assertEqual(self.client.get(reverse('analytics-top')).status_code, 200)
+
+    @override_settings(DEBUG=False)
+    def test_servers_warn_about_a_per_process_cache(self):
+        with self.assertLogs('tracker.checks', 'WARNING'):
+            warn_unshared_cache()
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}}), \
+                self.assertNoLogs('tracker.checks'):
+            warn_unshared_cache()
+
+
+class ForecastingTests(TestCase):
+    def test_backtest_picks_the_model_that_fits(self):
+        t = np.arange(48)
+        seasonal = 500 + 300 * np.sin(2 * np.pi * t / 12)
+        trending = 100 + 20.0 * t
+        best, _, predicted, _ = select(align([seasonal, trending[-20:]]), 'monthly')
+        self.assertEqual([MODELS[i] for i in best], ['seasonal_naive', 'linear_trend'])
+        self.assertAlmostEqual(predicted[0], seasonal[36])
+        self.assertAlmostEqual(predicted[1], 100 + 20.0 * 48)
+
+        best, _, predicted, _ = select(align([[1.0, 2.0]]), 'monthly')
+        self.assertEqual(best[0], -1)
+        self.assertTrue(np.isnan(predicted[0]))
+
+    def test_vectorized_forecasts_match_a_refit_per_origin(self):
+        rng = np.random.default_rng(1)
+        series = [rng.uniform(0, 100, length) for length in (30, 12, 5)]
+        Y = align(series)
+        trend = _linear_trend(Y, 'monthly')
+        smoothed = _smoothing(Y, [0.2, 0.7])
+        for row, values in enumerate(series):
+            offset = Y.shape[1] - len(values)
+            for origin in range(3, len(values) + 1):
+                slope, intercept = np.polyfit(np.arange(origin), values[:origin], 1)
+                self.assertAlmostEqual(trend[row, offset + origin], intercept + slope * origin)
+            for level, alpha in enumerate([0.2, 0.7]):
+                expected = values[0]
+                for value in values[1:]:
+                    expected = alpha * value + (1 - alpha) * expected
+                self.assertAlmostEqual(smoothed[level, row, -1], expected)
+
+    def test_prediction_uses_the_backtested_model(self):
+        user = User.objects.create_user('seasons', 'seasons@example.com', 'pw-12345!')
+        account = Account.objects.create(user=user, bank_name='Bank', account_number='seasons-1', balance=0)
+        food = Category.objects.create(user=user, name='Food')
+        for i in range(36):
+            Transaction.objects.create(
+                user=user, account=account, category=food, type='expense',
+                amount=Decimal(900 if i % 12 == 11 else 100), date=date(2020 + i // 12, i % 12 + 1, 1),
+            )
+        out = StringIO()
+        call_command('backtest_forecasts', '--workers=1', '--period=monthly', stdout=out)
+        self.assertIn('seasonal_naive: 1', out.getvalue())
+
+        client = APIClient()
+        client.force_authenticate(user)
+        data = client.get(reverse('predict-monthly')).data
+        self.assertEqual(data['model'], ForecastChoice.objects.get(user=user, period='monthly').model)
+        self.assertEqual(data['prediction'], 100)
+
+
+class RepeatedQueryDetectorTests(TestCase):
+    def test_shape_folds_literals_and_in_lists(self):
+        self.assertEqual(
+            query_shape('SELECT * FROM t WHERE id IN (%s, %s, %s) LIMIT 21'),
+            query_shape('SELECT * FROM t WHERE id IN (%s) LIMIT 1'),
+        )
+
+    def test_timer_reports_repeated_shapes(self):
+        user = seed('detector', SMALL)
+        timer = _QueryTimer(shapes=True)
+        with connection.execute_wrapper(timer):
+            for contribution in SavingsContribution.objects.filter(user=user):
+                contribution.goal.title
+        (count, shape), = timer.repeated(3)
+        self.assertEqual(count, SavingsContribution.objects.filter(user=user).count())
+        self.assertIn('expenses_savingsgoal', shape)
+
+    def test_timer_ignores_transaction_control(self):
+        # What one atomic block per shard, or nested blocks, run per request.
+        timer = _QueryTimer(shapes=True)
+        for _ in range(5):
+            for sql in ('BEGIN', 'SAVEPOINT "s1_x1"', 'RELEASE SAVEPOINT "s1_x1"', 'ROLLBACK TO SAVEPOINT "s1_x1"', 'COMMIT'):
+                timer(lambda *args: None, sql, None, False, {})
+        self.assertEqual(len(timer.durations), 25)
+        self.assertEqual(timer.repeated(3), [])
+
+    @override_settings(DEBUG=True, QUERY_REPEAT_THRESHOLD=3)
+    def test_middleware_logs_repeated_shapes(self):
+        user = seed('logged', SMALL)
+
+        def view(request):
+            for contribution in SavingsContribution.objects.filter(user=user):
+                contribution.goal.title
+            return HttpResponse()
+
+        with self.assertLogs('tracker.metrics', 'WARNING') as logs:
+            MetricsMiddleware(view)(RequestFactory().get('/contributions/'))
+        self.assertIn('possible N+1', logs.output[0])
+
+    @override_settings(DEBUG=True, QUERY_REPEAT_THRESHOLD=3)
+    def test_middleware_is_quiet_for_list_endpoints(self):
+        user = seed('quiet', LARGE)
+        client = APIClient()
+        client.force_authenticate(user)
+        with self.assertNoLogs('tracker.metrics', 'WARNING'):
+            client.get(reverse('transaction-list-create'))
+            client.get(reverse('savings-list-create'))
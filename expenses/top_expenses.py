@@ -0,0 +1,129 @@
+"""
+Per-month top expenses, kept current as expenses change.
+
+Each (user, month) has a TopExpenses row with up to TOP_EXPENSES_SIZE
+[cents, id] pairs. A new or grown expense is merged in; the list only has
+to be re-derived from the month's rows when a member leaves a full list
+or shrinks below an expense that was left out.
+"""
+from decimal import Decimal
+
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber, TruncMonth
+
+from .models import TopExpenses, Transaction
+
+
+def _cents(amount):
+    return round(Decimal(str(amount)) * 100)
+
+
+def _sort(entries):
+    entries.sort(key=lambda entry: (-entry[0], entry[1]))
+    return entries
+
+
+def derive(user_id, month, using=None):
+    """The month's top entries, read from its transactions."""
+    rows = (
+        Transaction.objects.using(using)
+        .filter(user_id=user_id, type='expense', date__gte=month, date__lt=month + relativedelta(months=1))
+        .order_by(F('amount').desc(), 'pk').values_list('amount', 'pk')[:settings.TOP_EXPENSES_SIZE]
+    )
+    return [[_cents(amount), pk] for amount, pk in rows]
+
+
+def derive_all(expenses):
+    """Top entries of every (user, month) in an expense queryset, in one query."""
+    ranked = expenses.annotate(
+        month=TruncMonth('date'),
+        rank=Window(RowNumber(), partition_by=[F('user_id'), TruncMonth('date')], order_by=[F('amount').desc(), 'pk']),
+    ).filter(rank__lte=settings.TOP_EXPENSES_SIZE).order_by()
+    lists = {}
+    for user_id, month, amount, pk in ranked.values_list('user_id', 'month', 'amount', 'pk'):
+        lists.setdefault((user_id, month), []).append([_cents(amount), pk])
+    return {key: _sort(entries) for key, entries in lists.items()}
+
+
+def _apply(user_id, month, pk, cents, using):
+    """Set expense pk's amount in the month to `cents`, or remove it with None."""
+    size = settings.TOP_EXPENSES_SIZE
+    tops = TopExpenses.objects.db_manager(using).select_for_update()
+    with transaction.atomic(using=using):
+        if cents is None:
+            top, created = tops.filter(user_id=user_id, month=month).first(), False
+            if top is None:
+                return
+        else:
+            top, created = tops.get_or_create(user_id=user_id, month=month)
+
+        if created:
+            # No list yet: read one, which already reflects this write.
+            top.entries = derive(user_id, month, using)
+        else:
+            before = top.entries
+            old = next((entry[0] for entry in before if entry[1] == pk), None)
+            entries = [entry for entry in before if entry[1] != pk]
+            if cents is not None:
+                entries = _sort(entries + [[cents, pk]])[:size]
+            # Expenses left out of a full list are at most its smallest amount;
+            # if a member dropped out or below that, one of them may belong in.
+            if len(before) >= size and old is not None and (len(entries) < size or entries[-1][0] < before[-1][0]):
+                entries = derive(user_id, month, using)
+            top.entries = entries
+        if top.entries:
+            top.save()
+        else:
+            top.delete()
+
+
+def record_top_change(pk, old, new, using):
+    """
+    Update the top lists for expense pk going from `old` to `new`, each a
+    Transaction.spending_state() tuple or None.
+    """
+    targets = {}
+    if old is not None:
+        targets[old[0], old[1].replace(day=1)] = None
+    if new is not None:
+        targets[new[0], new[1].replace(day=1)] = _cents(new[2])
+    for (user_id, month), cents in targets.items():
+        _apply(user_id, month, pk, cents, using)
+
+
+def month_top(user_id, month, limit, using=None):
+    """Ids of the month's `limit` largest expenses, largest first."""
+    entries = TopExpenses.objects.using(using).filter(user_id=user_id, month=month).values_list('entries', flat=True).first()
+    if entries is None:
+        # An empty month, or one whose list was dropped by a bulk change.
+        entries = derive(user_id, month, using)
+    return [pk for _, pk in entries[:limit]]
+
+
+def rebuild_top_expenses(alias, user_ids):
+    """Recompute the top lists of the given users on `alias`, after writes that skipped the receivers."""
+    lists = derive_all(Transaction.objects.using(alias).filter(user_id__in=user_ids, type='expense'))
+    with transaction.atomic(using=alias):
+        TopExpenses.objects.using(alias).filter(user_id__in=user_ids).delete()
+        TopExpenses.objects.using(alias).bulk_create(
+            [TopExpenses(user_id=user_id, month=month, entries=entries) for (user_id, month), entries in lists.items()],
+            batch_size=1000,
+        )
+
+
+def rebuild_months(alias, user_id, months):
+    """Recompute the user's top lists of the given months, after bulk writes to them."""
+    if not months:
+        return
+    in_months = Q()
+    for month in months:
+        in_months |= Q(date__gte=month, date__lt=month + relativedelta(months=1))
+    lists = derive_all(Transaction.objects.using(alias).filter(in_months, user_id=user_id, type='expense'))
+    with transaction.atomic(using=alias):
+        TopExpenses.objects.using(alias).filter(user_id=user_id, month__in=months).delete()
+        TopExpenses.objects.using(alias).bulk_create(
+            [TopExpenses(user_id=user_id, month=month, entries=entries) for (_, month), entries in lists.items()]
+        )
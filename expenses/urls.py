@@ -8,6 +8,8 @@ from .views import (
     UserDetailView,
     TransactionListCreateView,
     TransactionDetailView,
+    TransactionBatchView,
+    SyncView,
     GoogleAuthView,
     CurrentBudgetView,
     SavingsGoalListCreateView,
@@ -19,9 +21,11 @@ from .views import (
     MarkNotificationReadView,
     AccountDetailView,                # <-- add this import
     UserProfileView,
+    RecurringPaymentListView,
+    OpsReportView,
 )
 from rest_framework.authtoken.views import obtain_auth_token
-from .analytics import WeeklySpendingView, TopExpensesView, CategorySpendingView, PredictionView, WeeklyPredictionView, MonthlyPredictionView
+from .analytics import WeeklySpendingView, TopExpensesView, CategorySpendingView, SpendingSeriesView, PredictionView, WeeklyPredictionView, MonthlyPredictionView
 
 urlpatterns = [
     path('expenses/', ExpenseListCreateView.as_view(), name='expense-list'),
@@ -34,6 +38,8 @@ urlpatterns = [
     path('user/', UserDetailView.as_view(), name='user-detail'),
     path('transactions/', TransactionListCreateView.as_view(), name='transaction-list-create'),
     path('transactions/<int:pk>/', TransactionDetailView.as_view(), name='transaction-detail'),
+    path('transactions/batch/', TransactionBatchView.as_view(), name='transaction-batch'),
+    path('sync/', SyncView.as_view(), name='sync'),
     path('auth/google/', GoogleAuthView.as_view(), name='google-auth'),
     path('budget/current/', CurrentBudgetView.as_view(), name='current-budget'),
     path('savings/', SavingsGoalListCreateView.as_view(), name='savings-list-create'),
@@ -42,10 +48,13 @@ urlpatterns = [
     path('analytics/weekly-spending/', WeeklySpendingView.as_view(), name='analytics-weekly'),
     path('analytics/top-expenses/', TopExpensesView.as_view(), name='analytics-top'),
     path('analytics/by-category/', CategorySpendingView.as_view(), name='analytics-category'),
+    path('analytics/series/', SpendingSeriesView.as_view(), name='analytics-series'),
     path('analytics/prediction/', PredictionView.as_view(), name='analytics-prediction'),
     path('analytics/predict-weekly/', WeeklyPredictionView.as_view(), name='predict-weekly'),
     path('analytics/predict-monthly/', MonthlyPredictionView.as_view(), name='predict-monthly'),
     path('analytics/predictions/history/', PredictionLogListView.as_view(), name='prediction-history'),
+    path('recurring/', RecurringPaymentListView.as_view(), name='recurring-payments'),
+    path('ops/report/', OpsReportView.as_view(), name='ops-report'),
     path('notifications/', NotificationListView.as_view(), name='notifications'),
     path('notifications/<int:pk>/', NotificationDeleteView.as_view(), name='notification-delete'),
     path('notifications/<int:pk>/read/', MarkNotificationReadView.as_view(), name='notification-read'),
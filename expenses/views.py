@@ -1,7 +1,14 @@
+from datetime import timedelta
+
 from rest_framework import generics, permissions
-from .models import Expense, Account, Transaction, Budget, SavingsGoal, SavingsContribution, PredictionLog, Notification
-from .serializers import ExpenseSerializer, AccountSerializer, TransactionSerializer, BudgetSerializer, SavingsGoalSerializer, SavingsContributionSerializer, PredictionLogSerializer, NotificationSerializer
-from django.db import transaction
+from .models import Expense, Account, Transaction, Budget, SavingsGoal, SavingsContribution, PredictionLog, Notification, ArchivedTransaction, RecurringPayment, Job
+from .serializers import ExpenseSerializer, AccountSerializer, TransactionSerializer, BudgetSerializer, SavingsGoalSerializer, SavingsContributionSerializer, PredictionLogSerializer, NotificationSerializer, ArchivedTransactionSerializer, ArchivedExpenseSerializer, RecurringPaymentSerializer
+from . import batch, sync
+from .accounts import adjust_balance, balance_delta
+from .idempotency import idempotent
+from .jobs import enqueue
+from django.db import router, transaction
+from django.db.models import Sum
 from rest_framework.views import APIView
 from django.contrib.auth import get_user_model
 from rest_framework.response import Response
@@ -14,6 +21,7 @@ from rest_framework.authtoken.models import Token
 from rest_framework.permissions import IsAuthenticated
 from django.utils import timezone
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import MultiPartParser, FormParser
 
 
@@ -41,35 +49,87 @@ class RegisterView(generics.CreateAPIView):
 
     
 
-class ExpenseListCreateView(generics.ListCreateAPIView):
+class ArchiveListMixin:
+    """Appends archived rows to the list when called with ?include_archived=true."""
+    archive_serializer_class = None
+    archive_types = ('income', 'expense')
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('include_archived', '').lower() not in ('1', 'true', 'yes'):
+            return super().list(request, *args, **kwargs)
+        hot = self.get_serializer(self.get_queryset(), many=True).data
+        archived = self.archive_serializer_class(
+            ArchivedTransaction.objects.filter(user=request.user, type__in=self.archive_types)
+            .select_related('category').order_by('-date'),
+            many=True,
+        ).data
+        return Response(sorted(hot + archived, key=lambda row: row['date'], reverse=True))
+
+
+class AccountBalanceMixin:
+    """Moves the account balance with every create, update and delete, in the same transaction."""
+
+    def perform_create(self, serializer):
+        with transaction.atomic(using=router.db_for_write(Transaction)):
+            created = serializer.save(user=self.request.user)
+            adjust_balance(created.account_id, balance_delta(created.type, created.amount))
+
+    def perform_update(self, serializer):
+        with transaction.atomic(using=router.db_for_write(Transaction)):
+            # serializer.instance is the row as loaded; save() updates it in place
+            original = serializer.instance
+            old_account, old_delta = original.account_id, balance_delta(original.type, original.amount)
+            updated = serializer.save()
+            new_delta = balance_delta(updated.type, updated.amount)
+            if updated.account_id == old_account:
+                adjust_balance(old_account, new_delta - old_delta)
+            else:
+                adjust_balance(old_account, -old_delta)
+                adjust_balance(updated.account_id, new_delta)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic(using=router.db_for_write(Transaction)):
+            # Reverse the transaction's balance effect before deletion
+            adjust_balance(instance.account_id, -balance_delta(instance.type, instance.amount))
+            instance.delete()
+
+
+class ExpenseListCreateView(AccountBalanceMixin, ArchiveListMixin, generics.ListCreateAPIView):
     serializer_class = ExpenseSerializer
+    archive_serializer_class = ArchivedExpenseSerializer
+    archive_types = ('expense',)
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
-    def perform_create(self, serializer):
-        expense = serializer.save(user=self.request.user)
-        expense.account.balance -= expense.amount
-        expense.account.save()
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
 
     def get_queryset(self):
-        return Expense.objects.filter(user=self.request.user).order_by('-date')
+        expenses = Expense.objects.filter(user=self.request.user).select_related('category').order_by('-date')
+        legacy_id = self.request.query_params.get('legacy_id')
+        if legacy_id is not None:
+            # Ids stored before expenses moved into Transaction (migration 0011).
+            if not legacy_id.isdigit():
+                raise ValidationError({'legacy_id': 'Must be an integer.'})
+            expenses = expenses.filter(legacy_id__expense_id=legacy_id)
+        return expenses
 
 
-class ExpenseDetailView(generics.RetrieveUpdateDestroyAPIView):
+class ExpenseDetailView(AccountBalanceMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = ExpenseSerializer
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Expense.objects.filter(user=self.request.user)
+        return Expense.objects.filter(user=self.request.user).select_related('category')
 
 
 class TotalBalanceView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     
     def get(self, request):
-        accounts = Account.objects.filter(user=request.user)
-        total_balance = sum(account.balance for account in accounts)
+        total_balance = Account.objects.filter(user=request.user).aggregate(total=Sum('balance'))['total'] or 0
         return Response({'total_balance': total_balance})
 
 
@@ -102,84 +162,75 @@ class UserDetailView(generics.RetrieveAPIView):
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
-class TransactionListCreateView(generics.ListCreateAPIView):
+class TransactionListCreateView(AccountBalanceMixin, ArchiveListMixin, generics.ListCreateAPIView):
     serializer_class = TransactionSerializer
+    archive_serializer_class = ArchivedTransactionSerializer
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
-    def perform_create(self, serializer):
-        with transaction.atomic():
-            new_transaction = serializer.save(user=self.request.user)
-            self._update_account_balance(new_transaction, 'create')
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
 
     def get_queryset(self):
-        return Transaction.objects.filter(user=self.request.user).order_by('-date')
-
-    def _update_account_balance(self, transaction_obj, operation):
-        """Update account balance based on transaction type and operation"""
-        account = transaction_obj.account
-        amount = transaction_obj.amount
-        
-        if operation == 'create':
-            if transaction_obj.type == 'expense':
-                account.balance -= amount
-            elif transaction_obj.type == 'income':
-                account.balance += amount
-        elif operation == 'delete':
-            # Reverse the original transaction
-            if transaction_obj.type == 'expense':
-                account.balance += amount  # Add back the expense
-            elif transaction_obj.type == 'income':
-                account.balance -= amount  # Subtract the income
-        
-        account.save()
-
-class TransactionDetailView(generics.RetrieveUpdateDestroyAPIView):
+        return Transaction.objects.filter(user=self.request.user).select_related('category').order_by('-date')
+
+class TransactionDetailView(AccountBalanceMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = TransactionSerializer
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Transaction.objects.filter(user=self.request.user)
-
-    def perform_update(self, serializer):
-        with transaction.atomic():
-            # Get the original transaction to reverse its effect
-            original_transaction = self.get_object()
-            
-            # Reverse the original transaction's balance effect
-            self._update_account_balance(original_transaction, 'delete')
-            
-            # Save the updated transaction
-            updated_transaction = serializer.save()
-            
-            # Apply the new transaction's balance effect
-            self._update_account_balance(updated_transaction, 'create')
+        return Transaction.objects.filter(user=self.request.user).select_related('category')
+
+class TransactionBatchView(APIView):
+    """
+    Create, update and delete many transactions at once:
+    {"operations": [{"op": "create", "data": {...}}, {"op": "update", "id": 1, "data": {...}},
+    {"op": "delete", "id": 2}]}. All or nothing; the response lists one result per operation.
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
 
-    def perform_destroy(self, instance):
-        with transaction.atomic():
-            # Reverse the transaction's balance effect before deletion
-            self._update_account_balance(instance, 'delete')
-            instance.delete()
+    @idempotent
+    def post(self, request):
+        operations = request.data.get('operations') if isinstance(request.data, dict) else None
+        if not isinstance(operations, list) or not operations:
+            return Response({'operations': 'A non-empty list is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(operations) > settings.TRANSACTION_BATCH_MAX:
+            return Response({'operations': f'At most {settings.TRANSACTION_BATCH_MAX} operations per batch.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        items, errors = batch.validate(request, operations)
+        if errors:
+            results = [
+                {'index': index, 'errors': errors[index]} if index in errors else {'index': index, 'status': 'valid'}
+                for index in range(len(operations))
+            ]
+            return Response({'applied': False, 'results': results}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = []
+        for index, (op, row) in enumerate(batch.apply(request.user, items)):
+            result = {'index': index, 'status': f'{op}d', 'id': row.pk}
+            if op != 'delete':
+                result['data'] = TransactionSerializer(row, context={'request': request}).data
+            results.append(result)
+        return Response({'applied': True, 'results': results})
+
+class SyncView(APIView):
+    """
+    Rows changed since ?cursor=, and the ids deleted since then, per kind.
+    Apply `changed` by id, then drop `deleted`; with `reset` set, replace
+    everything held instead. Pass the returned cursor to the next sync.
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
 
-    def _update_account_balance(self, transaction_obj, operation):
-        """Update account balance based on transaction type and operation"""
-        account = transaction_obj.account
-        amount = transaction_obj.amount
-        
-        if operation == 'create':
-            if transaction_obj.type == 'expense':
-                account.balance -= amount
-            elif transaction_obj.type == 'income':
-                account.balance += amount
-        elif operation == 'delete':
-            # Reverse the original transaction
-            if transaction_obj.type == 'expense':
-                account.balance += amount  # Add back the expense
-            elif transaction_obj.type == 'income':
-                account.balance -= amount  # Subtract the income
-        
-        account.save()
+    def get(self, request):
+        try:
+            return Response(sync.changes(request, request.query_params.get('cursor')))
+        except sync.InvalidCursor as exc:
+            return Response({'cursor': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
 class GoogleAuthView(APIView):
     permission_classes = [permissions.AllowAny]
@@ -266,16 +317,37 @@ class SavingsGoalDetailView(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         return SavingsGoal.objects.filter(user=self.request.user)
 
+    def perform_update(self, serializer):
+        # Locked like a contribution, and only the sent fields are written, so
+        # a concurrent contribution's saved and progress are not overwritten.
+        using = router.db_for_write(SavingsGoal)
+        with transaction.atomic(using=using):
+            goal = SavingsGoal.objects.using(using).select_for_update().get(pk=serializer.instance.pk)
+            fields = list(serializer.validated_data)
+            for name, value in serializer.validated_data.items():
+                setattr(goal, name, value)
+            if 'target' in fields:
+                goal.projected_completion = goal.project_completion()
+                fields.append('projected_completion')
+            goal.save(update_fields=fields + ['updated_at'])
+        serializer.instance = goal
+
 class SavingsContributionCreateView(generics.CreateAPIView):
     serializer_class = SavingsContributionSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @idempotent
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
     def perform_create(self, serializer):
-        contribution = serializer.save(user=self.request.user)
-        # Update the saved amount on the related SavingsGoal
-        goal = contribution.goal
-        goal.saved += contribution.amount
-        goal.save()
+        using = router.db_for_write(SavingsGoal)
+        with transaction.atomic(using=using):
+            # Lock the goal so concurrent contributions are applied one after another
+            goal = SavingsGoal.objects.using(using).select_for_update().get(pk=serializer.validated_data['goal'].pk)
+            contribution = serializer.save(user=self.request.user, goal=goal)
+            goal.add_contribution(contribution.amount, contribution.date)
+            goal.save(update_fields=['saved', 'progress', 'projected_completion', 'updated_at'])
 
 class PredictionLogListView(generics.ListAPIView):
     serializer_class = PredictionLogSerializer
@@ -284,6 +356,42 @@ class PredictionLogListView(generics.ListAPIView):
     def get_queryset(self):
         return PredictionLog.objects.filter(user=self.request.user)        
 
+class RecurringPaymentListView(generics.ListAPIView):
+    serializer_class = RecurringPaymentSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        # ?refresh=true queues detection for this user; the list updates once it has run
+        if self.request.query_params.get('refresh', '').lower() in ('1', 'true', 'yes'):
+            user_id = self.request.user.pk
+            enqueue('recurring.refresh_user', {'user_id': user_id}, priority=10, key=f'recurring:{user_id}')
+        return RecurringPayment.objects.filter(user=self.request.user)
+
+class OpsReportView(APIView):
+    """
+    Platform-wide report for staff, built by a background job and served
+    from its result for OPS_REPORT_CACHE_SECONDS; until then the response is 202.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        try:
+            active_days = int(request.query_params.get('active_days', 30))
+        except ValueError:
+            return Response({'active_days': 'Must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        key = f'ops-report:{active_days}'
+        built = None
+        if request.query_params.get('refresh', '').lower() not in ('1', 'true', 'yes'):
+            fresh = timezone.now() - timedelta(seconds=settings.OPS_REPORT_CACHE_SECONDS)
+            built = (
+                Job.objects.using('default').filter(key=key, status='done', finished_at__gte=fresh)
+                .order_by('-finished_at').first()
+            )
+        if built is None:
+            enqueue('ops.report', {'active_days': active_days}, key=key)
+            return Response({'status': 'pending'}, status=status.HTTP_202_ACCEPTED)
+        return Response(built.result)
+
 class NotificationListView(generics.ListAPIView):
     serializer_class = NotificationSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -319,4 +427,14 @@ class UserProfileView(generics.RetrieveUpdateAPIView):
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
         serializer = self.get_serializer(instance)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+    def perform_update(self, serializer):
+        if 'profile_picture' not in serializer.validated_data:
+            serializer.save()
+            return
+        # Thumbnails of the old picture no longer apply; the job makes new
+        # ones and deletes the old files.
+        stale = list(serializer.instance.profile_thumbnails.values())
+        user = serializer.save(profile_thumbnails={})
+        transaction.on_commit(lambda: enqueue('avatars.process', {'user_id': user.pk, 'stale': stale}, priority=5))
\ No newline at end of file
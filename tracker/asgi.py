@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tracker.settings')
 
 application = get_asgi_application()
+
+from tracker.checks import warn_unshared_cache  # noqa: E402  needs the settings loaded
+
+warn_unshared_cache()
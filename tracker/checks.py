@@ -0,0 +1,46 @@
+"""
+Checks that the cache is shared by every process.
+
+Replica pins, snapshot versions, account ids and throttle budgets live in
+the default cache, so that a write in one worker is seen by the others.
+A per-process backend (the LocMemCache default) only works properly with a
+single process, such as the development server. `manage.py` warns about
+it, and the WSGI and ASGI applications log a warning at startup. They
+still start, and each worker then throttles and caches on its own.
+"""
+import logging
+
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+logger = logging.getLogger(__name__)
+
+# Backends whose entries each process keeps to itself.
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def cache_is_shared():
+    return settings.CACHES['default']['BACKEND'] not in PER_PROCESS_CACHES
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    if cache_is_shared():
+        return []
+    return [Warning(
+        'The default cache is local to each process, so workers do not see each other\'s writes.',
+        hint='Set CACHE_BACKEND to a shared backend, e.g. django.core.cache.backends.redis.RedisCache, '
+             'before running more than one process.',
+        id='tracker.W001',
+    )]
+
+
+def warn_unshared_cache():
+    if not settings.DEBUG and not cache_is_shared():
+        logger.warning(
+            'The default cache is local to each process, so each worker throttles on its own budget '
+            'and may serve stale snapshots. Set CACHE_BACKEND to a shared backend (tracker.W001).'
+        )
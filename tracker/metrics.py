@@ -0,0 +1,308 @@
+"""
+Prometheus metrics for the tracker project.
+
+Every thread records into its own in-memory registry, so recording a
+request never takes a lock. Each worker process periodically dumps the
+merged registries of its threads into a JSON file under METRICS_DIR and
+the /metrics view sums the files of all workers, which lets gunicorn
+workers share one scrape target without a separate exporter. Files of
+workers that have exited are deleted at the next scrape, so their counts
+drop out of the totals (Prometheus sees a counter reset).
+
+Scrapes need METRICS_TOKEN as a bearer token; without one, /metrics only
+answers with DEBUG on.
+"""
+import atexit
+import bisect
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+QUERY_DURATION_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+METRIC_HELP = {
+    'tracker_http_requests_total': ('counter', 'Total HTTP requests by route, method and status.'),
+    'tracker_http_errors_total': ('counter', 'Unhandled exceptions raised by views.'),
+    'tracker_http_request_duration_seconds': ('histogram', 'Request latency by route.'),
+    'tracker_db_queries_per_request': ('histogram', 'Database queries issued per request.'),
+    'tracker_db_query_duration_seconds': ('histogram', 'Duration of individual database queries.'),
+    'tracker_jobs_total': ('counter', 'Background jobs run, by job and outcome (done, retry, failed).'),
+    'tracker_job_duration_seconds': ('histogram', 'Run time of background jobs.'),
+    'tracker_job_wait_seconds': ('histogram', 'Time background jobs waited past their run time before starting.'),
+    'tracker_throttled_requests_total': ('counter', 'API requests refused by throttling, by route and bucket group.'),
+}
+
+
+class Registry:
+    """Counters and histograms owned by a single thread."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [list(buckets), [0] * (len(buckets) + 1), 0.0]
+        hist[1][bisect.bisect_left(buckets, value)] += 1
+        hist[2] += value
+
+
+_local = threading.local()
+_registries = []
+_started = time.time()
+_last_flush = time.monotonic()
+
+
+def _registry():
+    registry = getattr(_local, 'registry', None)
+    if registry is None:
+        registry = _local.registry = Registry()
+        _registries.append(registry)
+    return registry
+
+
+def inc(name, labels=(), value=1):
+    _registry().inc(name, tuple(labels), value)
+
+
+def observe(name, labels, value, buckets):
+    _registry().observe(name, tuple(labels), value, buckets)
+
+
+def _metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'tracker-metrics')
+
+
+def snapshot():
+    """Merge the registries of every thread in this process."""
+    counters, histograms = {}, {}
+    for registry in list(_registries):
+        for key, value in registry.counters.copy().items():
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, counts, total) in registry.histograms.copy().items():
+            merged = histograms.setdefault(key, [buckets, [0] * len(counts), 0.0])
+            merged[1] = [a + b for a, b in zip(merged[1], counts)]
+            merged[2] += total
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels)] + hist for (name, labels), hist in histograms.items()],
+    }
+
+
+def flush():
+    """Write this process' metrics to its file in METRICS_DIR."""
+    global _last_flush
+    _last_flush = time.monotonic()
+    directory = _metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'metrics-{os.getpid()}-{int(_started)}.json')
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(snapshot(), fh)
+    os.replace(tmp_path, path)
+
+
+def maybe_flush():
+    if time.monotonic() - _last_flush >= getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+        flush()
+
+
+atexit.register(lambda: _registries and flush())
+
+
+_FILE_NAME = re.compile(r'metrics-(\d+)-(\d+)\.json$')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # it exists, under another user
+    return True
+
+
+def prune(directory, names):
+    """Delete the files of exited workers. Returns the names that are left."""
+    latest = {}
+    for filename in names:
+        match = _FILE_NAME.match(filename)
+        if match:
+            pid, started = map(int, match.groups())
+            if started > latest.get(pid, -1):
+                latest[pid] = started
+    left = []
+    for filename in names:
+        match = _FILE_NAME.match(filename)
+        if not match:
+            continue
+        pid, started = map(int, match.groups())
+        # A reused pid leaves the earlier process' file behind with an older start.
+        if _alive(pid) and started == latest[pid]:
+            left.append(filename)
+            continue
+        try:
+            os.remove(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+    return left
+
+
+def collect():
+    """Sum the files written by all live worker processes."""
+    counters, histograms = {}, {}
+    directory = _metrics_dir()
+    names = prune(directory, os.listdir(directory)) if os.path.isdir(directory) else []
+    for filename in names:
+        try:
+            with open(os.path.join(directory, filename)) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in data['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, counts, total in data['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [buckets, [0] * len(counts), 0.0])
+            merged[1] = [a + b for a, b in zip(merged[1], counts)]
+            merged[2] += total
+    return counters, histograms
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def render(counters, histograms):
+    """Render collected metrics in the Prometheus text exposition format."""
+    lines = []
+    seen = set()
+
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), (buckets, counts, total) in sorted(histograms.items()):
+        header(name)
+        cumulative = 0
+        for bound, count in zip(list(buckets) + ['+Inf'], counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+_IN_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+# Transaction control repeats with every atomic block, not with every row.
+_TRANSACTION_CONTROL = re.compile(r'\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|START TRANSACTION)\b', re.IGNORECASE)
+
+
+def query_shape(sql):
+    """SQL with literals and IN lists folded, so per-row variants of a query compare equal."""
+    return _NUMBER.sub('N', _IN_LIST.sub('(...)', sql))
+
+
+class _QueryTimer:
+    """
+    execute_wrapper that times every query of the current request. With
+    `shapes`, it also counts queries by shape to spot N+1 patterns.
+    """
+
+    def __init__(self, shapes=False):
+        self.durations = []
+        self.shapes = {} if shapes else None
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.shapes is not None and not _TRANSACTION_CONTROL.match(sql):
+            shape = query_shape(sql)
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.durations.append(time.perf_counter() - start)
+
+    def repeated(self, threshold):
+        """(count, shape) of shapes run at least `threshold` times, most frequent first."""
+        return sorted(((n, shape) for shape, n in (self.shapes or {}).items() if n >= threshold), reverse=True)
+
+
+class MetricsMiddleware:
+    """Records latency, status and database usage for every request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        timer = _QueryTimer(shapes=settings.DEBUG)
+        with ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(timer))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        route = (('route', match.route if match else 'unmatched'),)
+        inc('tracker_http_requests_total', route + (('method', request.method), ('status', response.status_code)))
+        observe('tracker_http_request_duration_seconds', route, elapsed, LATENCY_BUCKETS)
+        observe('tracker_db_queries_per_request', route, len(timer.durations), QUERY_COUNT_BUCKETS)
+        for duration in timer.durations:
+            observe('tracker_db_query_duration_seconds', route, duration, QUERY_DURATION_BUCKETS)
+        for count, shape in timer.repeated(settings.QUERY_REPEAT_THRESHOLD):
+            logger.warning('%s %s ran the same query %d times (possible N+1): %s',
+                           request.method, request.path, count, shape)
+        maybe_flush()
+        return response
+
+    def process_exception(self, request, exception):
+        match = getattr(request, 'resolver_match', None)
+        inc('tracker_http_errors_total', (
+            ('route', match.route if match else 'unmatched'),
+            ('exception', type(exception).__name__),
+        ))
+
+
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            return HttpResponseForbidden()
+    elif not settings.DEBUG:
+        return HttpResponseForbidden()
+    flush()
+    body = render(*collect())
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,190 @@
+"""
+Database routing for the tracker project.
+
+DatabaseRoutingMiddleware publishes the current request to the routers
+through a context variable. ReplicaRouter sends reads from whitelisted
+GET routes to DATABASE_REPLICA_ALIAS, unless the user wrote something in
+the last REPLICA_STICKY_SECONDS, in which case they keep reading from the
+primary so they always see their own writes.
+
+ShardRouter places every user's expenses rows on one of DATABASE_SHARDS.
+Users and the placement directory stay on default; each shard holds a
+stub copy of its users so foreign keys resolve locally.
+"""
+import contextvars
+import hashlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+REPLICA_PIN_KEY = 'replica-pin:{}'
+SHARD_KEY = 'shard:{}'
+SHARD_CACHE_SECONDS = 60
+
+# Models that live on default only; everything else in expenses is sharded.
+GLOBAL_MODELS = {'expenses.shardassignment', 'expenses.job'}
+
+_current_request = contextvars.ContextVar('tracker_current_request', default=None)
+_current_user_id = contextvars.ContextVar('tracker_current_user_id', default=None)
+
+
+def current_request():
+    return _current_request.get()
+
+
+@contextmanager
+def user_context(user_id):
+    """Route unhinted queries outside a request (commands, jobs) to a user's shard."""
+    token = _current_user_id.set(user_id)
+    try:
+        yield
+    finally:
+        _current_user_id.reset(token)
+
+
+def sharding_enabled():
+    return len(settings.DATABASE_SHARDS) > 1
+
+
+def home_shard(user_id):
+    """Rendezvous hash of the user over DATABASE_SHARDS; adding a shard only moves ~1/N users."""
+    return max(
+        settings.DATABASE_SHARDS,
+        key=lambda alias: hashlib.blake2b(f'{alias}:{user_id}'.encode(), digest_size=8).digest(),
+    )
+
+
+def shard_for_user(user_id):
+    """Current placement of the user; users never placed still live on default."""
+    if not sharding_enabled():
+        return 'default'
+    key = SHARD_KEY.format(user_id)
+    alias = cache.get(key)
+    if alias is None:
+        from expenses.models import ShardAssignment
+        alias = (
+            ShardAssignment.objects.using('default')
+            .filter(user_id=user_id).values_list('alias', flat=True).first()
+        ) or 'default'
+        cache.set(key, alias, SHARD_CACHE_SECONDS)
+    return alias
+
+
+def is_sharded(model):
+    meta = model._meta
+    return (
+        meta.app_label == 'expenses'
+        and meta.label_lower != settings.AUTH_USER_MODEL.lower()
+        and meta.label_lower not in GLOBAL_MODELS
+    )
+
+
+def pin_to_primary(user_id):
+    """Keep the user's reads on the primary for REPLICA_STICKY_SECONDS."""
+    cache.set(REPLICA_PIN_KEY.format(user_id), True, settings.REPLICA_STICKY_SECONDS)
+
+
+class DatabaseRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _current_request.set(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_request.reset(token)
+
+        wrote = request.method not in SAFE_METHODS or getattr(request, '_db_wrote', False)
+        user = getattr(request, 'user', None)
+        if wrote and response.status_code < 400 and user is not None and user.is_authenticated:
+            pin_to_primary(user.pk)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        request._replica_reads = (
+            request.method in SAFE_METHODS
+            and match is not None
+            and match.url_name in settings.REPLICA_READ_ROUTES
+        )
+
+
+class ShardRouter:
+    """Routes every sharded expenses query to the shard of the user it belongs to."""
+
+    def _shard(self, model, hints):
+        if not sharding_enabled():
+            return None
+        if not is_sharded(model):
+            return 'default' if model._meta.app_label == 'expenses' else None
+
+        instance = hints.get('instance')
+        if instance is not None:
+            if is_sharded(type(instance)) and instance._state.db:
+                return instance._state.db
+            user_id = instance.pk if instance._meta.label_lower == settings.AUTH_USER_MODEL.lower() \
+                else getattr(instance, 'user_id', None)
+            if user_id is not None:
+                return shard_for_user(user_id)
+
+        user_id = _current_user_id.get()
+        if user_id is None:
+            request = _current_request.get()
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                user_id = user.pk
+        return shard_for_user(user_id) if user_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if sharding_enabled() and not (is_sharded(type(obj1)) and is_sharded(type(obj2))):
+            return True
+        return None
+
+
+class ReplicaRouter:
+    """Routes safe reads of the expenses app to the read replica."""
+
+    def _replica_alias(self):
+        alias = getattr(settings, 'DATABASE_REPLICA_ALIAS', None)
+        return alias if alias in settings.DATABASES else None
+
+    def db_for_read(self, model, **hints):
+        alias = self._replica_alias()
+        request = _current_request.get()
+        if alias is None or request is None or not getattr(request, '_replica_reads', False):
+            return None
+        # The user model is excluded so that authenticating the request,
+        # which happens lazily inside the view, never recurses in here.
+        if model._meta.app_label != 'expenses' or model._meta.label == settings.AUTH_USER_MODEL:
+            return None
+        if getattr(request, '_db_wrote', False):
+            return None
+
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            return None
+        pinned = getattr(request, '_replica_pinned', None)
+        if pinned is None:
+            pinned = request._replica_pinned = bool(cache.get(REPLICA_PIN_KEY.format(user.pk)))
+        return None if pinned else alias
+
+    def db_for_write(self, model, **hints):
+        request = _current_request.get()
+        if request is not None:
+            request._db_wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        alias = self._replica_alias()
+        if alias is not None and {obj1._state.db, obj2._state.db} <= {'default', alias}:
+            return True
+        return None
@@ -60,6 +60,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tracker.metrics.MetricsMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -68,6 +69,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'tracker.routers.DatabaseRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'tracker.urls'
@@ -94,6 +96,31 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_THROTTLE_CLASSES': [
+        'tracker.throttling.TokenBucketThrottle',
+    ],
+}
+
+# API throttling (tracker/throttling.py). Each client has a token bucket
+# per group, given as (capacity, tokens refilled per second). A request
+# costs its route's tokens from its group; other routes cost 1 from
+# 'default'. Analytics and forecasts run pandas and scikit-learn, so they
+# cost more from a smaller, slower bucket.
+
+THROTTLE_BUCKETS = {
+    'default': (120, 2.0),
+    'analytics': (60, 0.5),
+}
+THROTTLE_ROUTES = {
+    'analytics-weekly': ('analytics', 2),
+    'analytics-top': ('analytics', 1),
+    'analytics-category': ('analytics', 2),
+    'analytics-series': ('analytics', 5),
+    'analytics-prediction': ('analytics', 10),
+    'predict-weekly': ('analytics', 10),
+    'predict-monthly': ('analytics', 10),
+    'transaction-batch': ('default', 10),
+    'sync': ('default', 5),
 }
 
 
@@ -109,6 +136,61 @@ DATABASES = {
     )
 }
 
+# Optional read replica. Safe GETs on the routes below read from it, except
+# for users who wrote within the last REPLICA_STICKY_SECONDS. Locally a
+# second SQLite file works: DATABASE_REPLICA_URL=sqlite:///replica.sqlite3
+
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+DATABASE_REPLICA_ALIAS = None
+if DATABASE_REPLICA_URL:
+    DATABASE_REPLICA_ALIAS = 'replica'
+    DATABASES['replica'] = dj_database_url.parse(DATABASE_REPLICA_URL)
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+# Optional sharding by user. DATABASE_SHARD_URLS is a comma separated list of
+# extra databases (shard_1, shard_2, ...); with default they form the shard
+# set. Users and shard assignments stay on default. Use a shared cache when
+# sharding so every worker sees placement changes. Locally, e.g.:
+# DATABASE_SHARD_URLS=sqlite:///shard1.sqlite3,sqlite:///shard2.sqlite3
+
+DATABASE_SHARDS = ['default']
+for index, url in enumerate(filter(None, os.environ.get('DATABASE_SHARD_URLS', '').split(',')), start=1):
+    DATABASES[f'shard_{index}'] = dj_database_url.parse(url)
+    DATABASE_SHARDS.append(f'shard_{index}')
+
+DATABASE_ROUTERS = ['tracker.routers.ShardRouter', 'tracker.routers.ReplicaRouter']
+
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+REPLICA_READ_ROUTES = [
+    'expense-list',
+    'transaction-list-create',
+    'account-list-create',
+    'total-balance',
+    'savings-list-create',
+    'notifications',
+    'analytics-weekly',
+    'analytics-top',
+    'analytics-category',
+    'analytics-series',
+    'analytics-prediction',
+    'prediction-history',
+]
+
+
+# Cache
+# Use a shared backend in production (e.g. CACHE_BACKEND=
+# django.core.cache.backends.redis.RedisCache) so that every worker sees the
+# same replica pins, snapshot versions, account ids and throttle budgets;
+# the per-process default is for a single development process (tracker.W001).
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -149,12 +231,106 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-# Add this to allow user-uploaded files (profile pictures) to be served in development
-if DEBUG:
-    from django.conf import settings
-    from django.conf.urls.static import static
-    urlpatterns = []
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Profile pictures are re-encoded as WebP thumbnails of these sizes (px).
+# Thumbnail names are content hashes, so they are served as immutable.
+
+AVATAR_SIZES = (40, 96, 256)
+AVATAR_QUALITY = 80
+AVATAR_CACHE_SECONDS = 365 * 24 * 60 * 60
+
+# Transactions and expenses older than this many days are moved to the
+# archive tables by `manage.py archive_history`, leaving monthly summaries.
+
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 730))
+
+# A new expense is flagged as unusual when its category has at least
+# ANOMALY_MIN_SAMPLES past expenses and the amount is ANOMALY_Z_THRESHOLD
+# standard deviations and ANOMALY_MIN_RATIO times above the category mean.
+
+ANOMALY_MIN_SAMPLES = 5
+ANOMALY_Z_THRESHOLD = 3.0
+ANOMALY_MIN_RATIO = 2.0
+
+# Each worker keeps columnar snapshots of recently used histories for
+# analytics, evicting the least recently used past this many bytes.
+
+SNAPSHOT_CACHE_BYTES = int(os.environ.get('SNAPSHOT_CACHE_BYTES', 64 * 1024 * 1024))
+
+# With a per-process cache, workers cannot tell each other about writes,
+# so snapshots are rebuilt after this many seconds instead.
+
+SNAPSHOT_LOCAL_SECONDS = 5
+
+# Ids of each user's accounts are cached in a shared cache for validating
+# transaction writes; adding or deleting an account clears the entry.
+
+ACCOUNT_CACHE_SECONDS = 24 * 60 * 60
+
+# Largest expenses kept per user and month for the top-expenses widget.
+# Room beyond what the widget shows means fewer re-derivations on deletes.
+
+TOP_EXPENSES_SIZE = 10
+
+# Most operations accepted by one POST /api/transactions/batch/.
+
+TRANSACTION_BATCH_MAX = 1000
+
+# Delta sync (/api/sync/). Each sync looks back SYNC_CURSOR_OVERLAP_SECONDS
+# past its cursor for rows whose write committed late; it must exceed the
+# longest write transaction plus clock skew between servers. Tombstones
+# are kept SYNC_TOMBSTONE_DAYS (`manage.py prune_tombstones`); older
+# cursors get a full resync.
+
+SYNC_CURSOR_OVERLAP_SECONDS = 60
+SYNC_TOMBSTONE_DAYS = int(os.environ.get('SYNC_TOMBSTONE_DAYS', 90))
+
+# How long the first response to a POST with an Idempotency-Key is
+# replayed to retries (`manage.py prune_idempotency_keys` drops the rest).
+
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', 24 * 60 * 60))
+
+# Background jobs (`manage.py run_jobs`). A job is retried with
+# exponential backoff up to JOB_MAX_ATTEMPTS times and interrupted after
+# JOB_TIMEOUT seconds.
+
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 900))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE_SECONDS = 10
+JOB_RETRY_MAX_SECONDS = 3600
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 1))
+
+# Staff report at /api/ops/report/ (or `manage.py ops_report`); the
+# endpoint serves the last report a job built for this long.
+
+OPS_REPORT_CACHE_SECONDS = int(os.environ.get('OPS_REPORT_CACHE_SECONDS', 300))
+
+# Auto-categorization
+# `manage.py categorize_transactions --train` writes the model to
+# CATEGORIZER_MODEL_PATH; each worker memory-maps it on first use. Rows are
+# only categorized when the model is at least CATEGORIZER_MIN_CONFIDENCE sure.
+# Training only learns category names at least CATEGORIZER_MIN_USERS users
+# share, so one user's private names are never suggested to others.
+
+CATEGORIZER_MODEL_PATH = os.environ.get(
+    'CATEGORIZER_MODEL_PATH', os.path.join(BASE_DIR, 'artifacts', 'categorizer.joblib')
+)
+CATEGORIZER_MIN_CONFIDENCE = float(os.environ.get('CATEGORIZER_MIN_CONFIDENCE', 0.5))
+CATEGORIZER_MIN_USERS = int(os.environ.get('CATEGORIZER_MIN_USERS', 5))
+CATEGORIZER_BATCH_SIZE = 50000
+
+# Metrics
+# Each worker flushes its counters to METRICS_DIR; /metrics merges them and
+# deletes the files of exited workers. Scrapes must send
+# "Authorization: Bearer <METRICS_TOKEN>"; without a token, /metrics is
+# refused unless DEBUG is on.
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(BASE_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# With DEBUG on, a request that runs one query shape this many times is
+# logged as a likely N+1 (logger tracker.metrics).
+QUERY_REPEAT_THRESHOLD = int(os.environ.get('QUERY_REPEAT_THRESHOLD', 5))
 
 GOOGLE_CLIENT_ID = "229716200894-s5qp9sofhrh9diu39que111jlnhljg4q.apps.googleusercontent.com"
 
@@ -0,0 +1,59 @@
+"""
+Cost-weighted token-bucket throttling for the API.
+
+Every client (the user, or the address of an anonymous request) has a
+bucket per group in THROTTLE_BUCKETS that holds up to `capacity` tokens and
+refills at `rate` tokens a second. A request takes its route's cost from
+its group's bucket (THROTTLE_ROUTES; other routes cost 1 from 'default'),
+so a forecast fit spends much more of a much smaller budget than a list.
+A request that would overdraw is refused with 429 and a Retry-After of
+the time until enough tokens have refilled; refused requests cost nothing.
+
+The arithmetic runs in the worker and the bucket lives in the cache,
+which must be shared (tracker.checks) for all workers to draw on one
+budget per client; with a per-process cache each worker has its own.
+Reading and writing it is not atomic: workers racing on the same client
+can each get one request past an empty bucket.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+
+BUCKET_KEY = 'throttle:{}:{}'
+
+
+def route_cost(url_name):
+    """(group, cost) of a request to the named route."""
+    return settings.THROTTLE_ROUTES.get(url_name, ('default', 1))
+
+
+class TokenBucketThrottle(BaseThrottle):
+    wait_seconds = None
+
+    def allow_request(self, request, view):
+        match = request.resolver_match
+        route = match.url_name if match is not None else None
+        group, cost = route_cost(route)
+        capacity, rate = settings.THROTTLE_BUCKETS[group]
+        user = request.user
+        client = f'user:{user.pk}' if user is not None and user.is_authenticated else f'ip:{self.get_ident(request)}'
+        key = BUCKET_KEY.format(group, client)
+
+        now = time.time()
+        tokens, updated = cache.get(key) or (capacity, now)
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens < cost:
+            self.wait_seconds = (cost - tokens) / rate
+            metrics.inc('tracker_throttled_requests_total', [('route', route or ''), ('group', group)])
+            return False
+        # Once it would have refilled completely the entry is no longer needed.
+        cache.set(key, (tokens - cost, now), math.ceil(capacity / rate) + 1)
+        return True
+
+    def wait(self):
+        return self.wait_seconds
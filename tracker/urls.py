@@ -14,10 +14,32 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import os
+
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path,include
+from django.views.decorators.cache import cache_control
+from django.views.static import serve
+from expenses.avatars import AVATAR_DIR
+from .metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
      path('api/', include('expenses.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
+
+# Media, in development only, as static() does. In production the web
+# server or CDN serves MEDIA_ROOT, and the avatar prefix with the same
+# far-future header (see the README).
+if settings.DEBUG:
+    # Content-hashed thumbnails never change.
+    urlpatterns.append(path(
+        f"{settings.MEDIA_URL.strip('/')}/{AVATAR_DIR}/<path:path>",
+        cache_control(public=True, max_age=settings.AVATAR_CACHE_SECONDS, immutable=True)(serve),
+        {'document_root': os.path.join(settings.MEDIA_ROOT, AVATAR_DIR)},
+        name='avatar',
+    ))
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
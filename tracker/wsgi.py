@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tracker.settings')
 
 application = get_wsgi_application()
+
+from tracker.checks import warn_unshared_cache  # noqa: E402  needs the settings loaded
+
+warn_unshared_cache()